@@ -12,6 +12,23 @@ python manage.py collectstatic --no-input
 # Aplica migraciones
 python manage.py migrate
 
+# Reconstruye el grafo de productos relacionados (barato; se mantiene luego con señales)
+python manage.py reconstruir_relacionados
+
+# Completa los totales guardados de pedidos antiguos (solo los que aún no los tienen)
+python manage.py recalcular_totales_pedidos
+
+# Libera las reservas de stock vencidas. Render no arranca las líneas `worker:` del Procfile:
+# el barrido periódico se despliega como cron job aparte (cada 5 min:
+# python manage.py liberar_reservas) con las mismas variables de entorno que el web.
+# Si no corre, la tienda igual descuenta solo reservas vigentes (se liberan al leer stock).
+python manage.py liberar_reservas
+
+# Resuelve modelo/endpoint de cada clave Gemini (lo que usa el chat para llamar una sola vez).
+# Además conviene programarlo cada hora (cron job: python manage.py check_ai_keys --provider gemini).
+# No debe frenar el deploy si la API no responde.
+python manage.py check_ai_keys --provider gemini || echo "check_ai_keys falló; el chat sondeará modelos hasta la próxima ejecución"
+
 # Registrar información de build (fallback si no hay variables de entorno en runtime)
 COMMIT_SHA=$(git rev-parse --short HEAD 2>/dev/null || echo "")
 BRANCH=$(git rev-parse --abbrev-ref HEAD 2>/dev/null || echo "")
@@ -204,10 +204,10 @@ class DetallePedidoInline(admin.TabularInline):
 
 @admin.register(PedidoWhatsApp)
 class PedidoWhatsAppAdmin(admin.ModelAdmin):
-    list_display = ('codigo_pedido', 'user', 'fecha_creacion', 'total')
+    list_display = ('codigo_pedido', 'user', 'fecha_creacion', 'item_count', 'subtotal', 'total')
     list_filter = ('fecha_creacion',)
     search_fields = ('codigo_pedido', 'user__username')
-    readonly_fields = ('id', 'codigo_pedido', 'fecha_creacion', 'total', 'subtotal', 'costo_envio')
+    readonly_fields = ('id', 'codigo_pedido', 'fecha_creacion', 'total', 'subtotal', 'costo_envio', 'item_count')
     inlines = [DetallePedidoInline]
 
 # --- Formulario con selectores de color para la configuración ---
@@ -472,7 +472,9 @@ class GeminiApiKeyAdmin(admin.ModelAdmin):
     list_filter = ('activa',)
     search_fields = ('key', 'notas')
     list_editable = ('activa',)
-    fields = ('key', 'activa', 'notas')
+    fields = ('key', 'activa', 'notas', 'gemini_modelo_pedido', 'gemini_modelo', 'gemini_endpoint', 'gemini_system_instruction', 'gemini_resuelto_en')
+    # Resolución que guarda `manage.py check_ai_keys`
+    readonly_fields = ('gemini_modelo_pedido', 'gemini_modelo', 'gemini_endpoint', 'gemini_system_instruction', 'gemini_resuelto_en')
     actions = ['validar_claves']
     def get_queryset(self, request):
         return super().get_queryset(request).filter(provider='gemini')
@@ -0,0 +1,153 @@
+# mi_app/autocomplete.py
+"""Autocompletado tolerante a errores basado en trigramas.
+
+Indexa `Producto.nombre_norm` y los nombres de categoría. La similitud es la
+fracción de trigramas de la consulta presentes en el texto (equivalente a
+`word_similarity` de pg_trgm), así "lencria", "bodi" o "brasie" encuentran
+"lenceria", "body" o "brasier".
+
+- Postgres: los productos se consultan con el operador `<%` de pg_trgm sobre
+  un índice GIN (gin_trgm_ops).
+- Resto de motores: índice invertido trigrama -> entradas en memoria del
+  proceso, reconstruido cuando cambia la versión 'catalogo' (o tras
+  INDEX_TTL segundos como red de seguridad entre workers).
+
+Las categorías (pocas filas) siempre se resuelven con el índice en memoria.
+"""
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+
+from django.db import connection
+from django.db.models import BooleanField, F, FloatField
+from django.db.models.expressions import RawSQL
+
+from .models import Categoria, Producto
+from .versioning import CATALOGO, get_version
+
+SIMILARITY_THRESHOLD = 0.5
+INDEX_TTL = 300
+
+Entry = namedtuple('Entry', 'kind pk label norm trigrams data')
+
+_lock = threading.Lock()
+_state = {'version': None, 'built_at': 0.0, 'index': None}
+
+
+def trigrams(text):
+    """Trigramas estilo pg_trgm: cada palabra se rellena con '  ' delante y ' ' detrás."""
+    grams = set()
+    for word in re.split(r'[^a-z0-9]+', text or ''):
+        if not word:
+            continue
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _effective_price(precio, precio_oferta):
+    return precio_oferta if (precio_oferta and precio_oferta < precio) else precio
+
+
+def use_pg_trgm():
+    return connection.vendor == 'postgresql'
+
+
+class TrigramIndex:
+    """Índice invertido trigrama -> posiciones en `entries`."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.postings = {}
+        for pos, entry in enumerate(entries):
+            for gram in entry.trigrams:
+                self.postings.setdefault(gram, []).append(pos)
+
+    def search(self, query_norm, kind=None, limit=5, threshold=SIMILARITY_THRESHOLD):
+        q_grams = trigrams(query_norm)
+        if not q_grams:
+            return []
+        hits = Counter()
+        for gram in q_grams:
+            hits.update(self.postings.get(gram, ()))
+        scored = []
+        for pos, shared in hits.items():
+            entry = self.entries[pos]
+            if kind and entry.kind != kind:
+                continue
+            score = shared / len(q_grams)
+            if score < threshold:
+                continue
+            # Desempate: similitud completa (penaliza nombres largos) y coincidencia de prefijo
+            jaccard = shared / (len(q_grams) + len(entry.trigrams) - shared)
+            prefix = entry.norm.startswith(query_norm)
+            scored.append((score, prefix, jaccard, entry.pk, entry))
+        scored.sort(key=lambda s: (s[0], s[1], s[2], s[3]), reverse=True)
+        return [(s[4], s[0]) for s in scored[:limit]]
+
+
+def build_index(include_products=True):
+    entries = []
+    for pk, nombre, slug in Categoria.objects.values_list('pk', 'nombre', 'slug'):
+        norm = Producto._normalize_text(nombre)
+        entries.append(Entry('categoria', pk, nombre, norm, frozenset(trigrams(norm)), {'slug': slug}))
+    if include_products:
+        rows = Producto.objects.values_list(
+            'pk', 'nombre', 'nombre_norm', 'precio', 'precio_oferta', 'imagen_principal'
+        )
+        for pk, nombre, norm, precio, precio_oferta, imagen in rows:
+            norm = norm or Producto._normalize_text(nombre)
+            entries.append(Entry('producto', pk, nombre, norm, frozenset(trigrams(norm)), {
+                'price': _effective_price(precio, precio_oferta),
+                'image': imagen or '',
+            }))
+    return TrigramIndex(entries)
+
+
+def get_index():
+    """Índice en memoria vigente para la versión actual del catálogo."""
+    version = get_version(CATALOGO)
+    now = time.monotonic()
+    state = _state
+    if state['index'] is None or state['version'] != version or now - state['built_at'] > INDEX_TTL:
+        with _lock:
+            if state['index'] is None or state['version'] != version or now - state['built_at'] > INDEX_TTL:
+                state['index'] = build_index(include_products=not use_pg_trgm())
+                state['version'] = version
+                state['built_at'] = now
+    return state['index']
+
+
+def _pg_products(query_norm, limit):
+    """Productos por similitud de palabra con pg_trgm (usa el índice GIN con `<%`)."""
+    rows = (
+        Producto.objects
+        .filter(RawSQL('%s <%% "mi_app_producto"."nombre_norm"', (query_norm,), output_field=BooleanField()))
+        .annotate(similitud=RawSQL('word_similarity(%s, "mi_app_producto"."nombre_norm")', (query_norm,), output_field=FloatField()))
+        .order_by(F('similitud').desc(), '-id')
+        .values_list('pk', 'nombre', 'precio', 'precio_oferta', 'imagen_principal', 'similitud')[:limit]
+    )
+    return [
+        (Entry('producto', pk, nombre, '', frozenset(), {
+            'price': _effective_price(precio, precio_oferta),
+            'image': imagen or '',
+        }), similitud)
+        for pk, nombre, precio, precio_oferta, imagen, similitud in rows
+    ]
+
+
+def suggest(query, limit=5, category_limit=2):
+    """Devuelve (categorias, productos, hay_mas) ordenados por similitud.
+
+    Cada elemento es un par (Entry, similitud). Se pide un producto extra
+    para saber si hay más resultados sin ejecutar un COUNT.
+    """
+    query_norm = Producto._normalize_text(query)
+    index = get_index()
+    categorias = index.search(query_norm, kind='categoria', limit=category_limit)
+    if use_pg_trgm():
+        productos = _pg_products(query_norm, limit + 1)
+    else:
+        productos = index.search(query_norm, kind='producto', limit=limit + 1)
+    return categorias, productos[:limit], len(productos) > limit
@@ -0,0 +1,344 @@
+# mi_app/cart.py
+"""Servicio de carrito: una sola puerta para la sesión, Carrito/CarritoItem y las reservas.
+
+En sesión se guarda una forma compacta por variante:
+    session['cart'] = {'<variante_id>': {'q': cantidad, 'p': 'precio', 'o': 'precio_original' | None, 'a': epoch}}
+Nombre, color e imagen se hidratan con una sola consulta cuando una vista los
+necesita (lines()). Las reservas de stock se ajustan al momento con
+reservations.py; los cambios a CarritoItem se acumulan y save() los escribe
+al final de la vista en un lote (upsert + borrado), junto con la sesión.
+
+Para usuarios autenticados la sesión es un espejo del carrito persistente:
+sync() lo recarga solo si Carrito.updated_at avanzó (cambios desde otro
+dispositivo), en lugar de reconstruirlo en cada vista.
+"""
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import reservations
+from .models import Carrito, CarritoItem, ColorVariante
+
+SESSION_KEY = 'cart'
+SYNC_KEY = 'cart_sync'
+RESERVA_KEY = 'cart_reserva_sk'
+EXPIRACION = timedelta(hours=24)
+
+
+def get_cart(request):
+    """Carrito del request (uno por request, compartido entre vista y context processors)."""
+    cart = getattr(request, '_cart', None)
+    if cart is None:
+        cart = request._cart = Cart(request)
+    return cart
+
+
+def on_login(request, user):
+    """Receptor de user_logged_in: carrito nuevo con el usuario ya autenticado + fusión."""
+    cart = request._cart = Cart(request, user=user)
+    cart.merge_on_login()
+    return cart
+
+
+def _price_str(value):
+    return None if value in (None, '') else str(value)
+
+
+def _compact(item):
+    """Ítem de sesión en forma compacta (convierte el formato antiguo con claves largas)."""
+    if 'q' in item:
+        return item
+    added = int(time.time())
+    if item.get('added_at'):
+        try:
+            added = int(datetime.fromisoformat(item['added_at']).timestamp())
+        except ValueError:
+            pass
+    return {
+        'q': int(item.get('quantity') or 0),
+        'p': str(item.get('price') or '0'),
+        'o': _price_str(item.get('original_price')),
+        'a': added,
+    }
+
+
+class Cart:
+    def __init__(self, request, user=None):
+        self.request = request
+        if user is None:
+            user = getattr(request, 'user', None)
+        self.user = user if user is not None and user.is_authenticated else None
+        raw = request.session.get(SESSION_KEY) or {}
+        self._items = {str(pk): _compact(item) for pk, item in raw.items()}
+        # Sesiones con el formato antiguo se reescriben en el primer save()
+        self._session_dirty = any('q' not in item for item in raw.values())
+        self._upserts = set()
+        self._deletes = set()
+        self._variantes = {}
+        self._lines = None
+        self._totals = None
+
+    # --- lectura ---
+
+    def __contains__(self, variante_id):
+        return str(variante_id) in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def quantity(self, variante_id):
+        item = self._items.get(str(variante_id))
+        return item['q'] if item else 0
+
+    def _compute_totals(self):
+        if self._totals is None:
+            count = 0
+            total = Decimal('0')
+            for item in self._items.values():
+                count += item['q']
+                total += Decimal(item['p']) * item['q']
+            self._totals = (count, total)
+        return self._totals
+
+    @property
+    def count(self):
+        return self._compute_totals()[0]
+
+    def badge_state(self):
+        """(conteo, versión) para el contador de la cabecera, sin leer CarritoItem.
+
+        Autenticado: Carrito.item_count y updated_at en una consulta; anónimo: la sesión.
+        """
+        if self.user is not None:
+            row = Carrito.objects.filter(user=self.user).values_list('item_count', 'updated_at').first()
+            if row is not None:
+                return row[0], int(row[1].timestamp() * 1000)
+        return self.count, self.count
+
+    @property
+    def total(self):
+        return self._compute_totals()[1]
+
+    def subtotal(self, variante_id):
+        item = self._items.get(str(variante_id))
+        return Decimal(item['p']) * item['q'] if item else Decimal('0')
+
+    def lines(self):
+        """Ítems hidratados (formato de las plantillas y de orders.py), con una consulta."""
+        if self._lines is None:
+            variantes = self._load_variantes(self._items)
+            lines = []
+            for key, item in list(self._items.items()):
+                variante = variantes.get(key)
+                if variante is None:
+                    # La variante ya no existe: quitarla del carrito
+                    self.remove(key)
+                    continue
+                lines.append({
+                    'id': key,
+                    'product_id': variante.producto_id,
+                    'name': variante.producto.nombre,
+                    'price': item['p'],
+                    'original_price': item['o'],
+                    'color': variante.codigo or variante.color,
+                    'image_url': self._image_url(variante),
+                    'quantity': item['q'],
+                    'subtotal': float(self.subtotal(key)),
+                    'added_at': datetime.fromtimestamp(item['a'], tz=dt_timezone.utc).isoformat(),
+                })
+            self._lines = lines
+        return self._lines
+
+    def items_for_order(self):
+        """{variante_id: ítem hidratado} para orders.checkout_cart / order_from_cart."""
+        return {line['id']: line for line in self.lines()}
+
+    # --- escritura ---
+
+    def _changed(self, key):
+        self._session_dirty = True
+        self._lines = None
+        self._totals = None
+        if key is not None and self.user is not None:
+            if key in self._items:
+                self._upserts.add(key)
+                self._deletes.discard(key)
+            else:
+                self._deletes.add(key)
+                self._upserts.discard(key)
+
+    def set(self, variante, quantity, price=None, original_price=None, touch=False):
+        """Fija la cantidad de la variante (y su precio si se indica) y actualiza la reserva."""
+        key = str(variante.pk)
+        now = int(time.time())
+        item = self._items.get(key) or {'q': 0, 'p': str(price or '0'), 'o': None, 'a': now}
+        if price is not None:
+            item['p'] = str(price)
+            item['o'] = _price_str(original_price)
+        if touch:
+            item['a'] = now
+        item['q'] = quantity
+        self._items[key] = item
+        self._variantes[key] = variante
+        self._ensure_session_key()
+        reservations.set_reservation(variante, self.request.session.session_key, quantity, user=self.user)
+        self._remember_session_key()
+        self._changed(key)
+
+    def remove(self, variante_id):
+        key = str(variante_id)
+        if self._items.pop(key, None) is None:
+            return False
+        if self.request.session.session_key:
+            reservations.release(int(key), session_key=self.request.session.session_key)
+        self._changed(key)
+        return True
+
+    def clear(self, persisted=True):
+        """Vacía el carrito. persisted=False si CarritoItem ya se borró (p.ej. orders.checkout_cart)."""
+        keys = list(self._items)
+        self._items = {}
+        for key in keys:
+            self._changed(key if persisted else None)
+
+    def expire(self):
+        """Quita los ítems con más de 24 h (liberando su reserva). Devuelve sus nombres."""
+        limite = time.time() - EXPIRACION.total_seconds()
+        vencidos = [key for key, item in self._items.items() if item['a'] < limite]
+        if not vencidos:
+            return []
+        variantes = self._load_variantes(vencidos)
+        nombres = [variantes[key].producto.nombre for key in vencidos if key in variantes]
+        for key in vencidos:
+            self.remove(key)
+        return nombres
+
+    def sync(self):
+        """Recarga desde Carrito si se modificó en otra sesión/dispositivo (una consulta)."""
+        if self.user is None:
+            return False
+        updated_at = Carrito.objects.filter(user=self.user).values_list('updated_at', flat=True).first()
+        if updated_at is None:
+            return False
+        synced = self.request.session.get(SYNC_KEY)
+        if synced is not None and updated_at.timestamp() <= synced:
+            return False
+        self.reload(updated_at)
+        return True
+
+    def reload(self, updated_at=None):
+        """Reemplaza el espejo de sesión por el contenido de CarritoItem."""
+        now = int(time.time())
+        previos = self._items
+        self._items = {}
+        rows = CarritoItem.objects.filter(carrito__user=self.user).values_list(
+            'variante_id', 'quantity', 'price', 'original_price'
+        )
+        for variante_id, quantity, price, original_price in rows:
+            key = str(variante_id)
+            self._items[key] = {
+                'q': quantity,
+                'p': str(price),
+                'o': _price_str(original_price),
+                'a': previos.get(key, {}).get('a', now),
+            }
+        self._upserts.clear()
+        self._deletes.clear()
+        self._changed(None)
+        self.request.session[SYNC_KEY] = (updated_at or timezone.now()).timestamp()
+
+    def merge_on_login(self):
+        """Al iniciar sesión: suma el carrito anónimo al persistente y deja la sesión como espejo.
+
+        Por conjuntos: variantes con in_bulk, reservas con reservations.consolidate
+        y CarritoItem con el upsert de save(); no depende del tamaño del carrito.
+        """
+        anonimo = dict(self._items)
+        # login() rota la clave de sesión: las reservas anónimas quedaron con la anterior
+        clave_anterior = self.request.session.get(RESERVA_KEY)
+        self.reload()
+        self._ensure_session_key()
+        session_key = self.request.session.session_key
+        variantes = ColorVariante.objects.in_bulk([int(pk) for pk in anonimo]) if anonimo else {}
+        cantidades = {}
+        for key, item in anonimo.items():
+            variante = variantes.get(int(key))
+            if variante is None:
+                continue
+            merged = dict(item)
+            merged['q'] = item['q'] + self.quantity(key)
+            self._items[key] = merged
+            self._variantes[key] = variante
+            cantidades[variante.pk] = merged['q']
+            self._changed(key)
+        anteriores = [clave_anterior] if clave_anterior and clave_anterior != session_key else []
+        reservations.consolidate(cantidades, session_key, self.user, extra_session_keys=anteriores)
+        self._remember_session_key()
+        self.save()
+
+    def save(self):
+        """Escribe la sesión una vez y, si hay usuario, CarritoItem en un lote."""
+        if self._session_dirty:
+            self.request.session[SESSION_KEY] = self._items
+            self.request.session.modified = True
+            self._session_dirty = False
+        if self.user is None or not (self._upserts or self._deletes):
+            return
+        now = timezone.now()
+        faltan = [key for key in self._upserts if key not in self._variantes]
+        self._variantes.update(self._load_variantes(faltan))
+        with transaction.atomic():
+            carrito, _ = Carrito.objects.get_or_create(user=self.user)
+            rows = [
+                CarritoItem(
+                    carrito=carrito,
+                    variante_id=int(key),
+                    quantity=self._items[key]['q'],
+                    price=self._items[key]['p'],
+                    original_price=self._items[key]['o'],
+                    image_url=self._image_url(self._variantes.get(key)),
+                )
+                for key in self._upserts
+            ]
+            if rows:
+                CarritoItem.objects.bulk_create(
+                    rows,
+                    update_conflicts=True,
+                    unique_fields=['carrito', 'variante'],
+                    update_fields=['quantity', 'price', 'original_price', 'image_url'],
+                )
+            if self._deletes:
+                CarritoItem.objects.filter(carrito=carrito, variante_id__in=[int(k) for k in self._deletes]).delete()
+            Carrito.recount(Carrito.objects.filter(pk=carrito.pk), updated_at=now)
+        self.request.session[SYNC_KEY] = now.timestamp()
+        self._upserts.clear()
+        self._deletes.clear()
+
+    # --- auxiliares ---
+
+    def _ensure_session_key(self):
+        if not self.request.session.session_key:
+            self.request.session.create()
+
+    def _remember_session_key(self):
+        # Sobrevive a cycle_key(): permite traspasar las reservas anónimas al iniciar sesión
+        if self.request.session.get(RESERVA_KEY) != self.request.session.session_key:
+            self.request.session[RESERVA_KEY] = self.request.session.session_key
+
+    @staticmethod
+    def _image_url(variante):
+        if variante is None or not variante.imagen:
+            return ''
+        return variante.imagen.url
+
+    def _load_variantes(self, keys):
+        keys = [int(k) for k in keys]
+        if not keys:
+            return {}
+        return {
+            str(v.pk): v
+            for v in ColorVariante.objects.filter(pk__in=keys).select_related('producto')
+        }
@@ -0,0 +1,142 @@
+# mi_app/catalog_index.py
+"""Mantenimiento y consulta del índice desnormalizado del catálogo (ProductoIndice).
+
+Las vistas del catálogo filtran por categoría, rango de precio y flags contra
+esta tabla (un join por PK con índices compuestos) en lugar de reconstruir en
+cada request descendientes MPTT + Coalesce + DISTINCT.
+"""
+from django.db.models import F, Q, Sum
+
+from .models import Categoria, ColorVariante, Producto, ProductoIndice
+
+INDEX_UPDATE_FIELDS = [
+    'precio_efectivo', 'categoria', 'categoria_raiz',
+    'es_oferta', 'es_nueva_coleccion', 'stock_total', 'actualizado',
+]
+
+
+def _category_roots():
+    """Devuelve {categoria_id: raiz_id} con una sola consulta (el árbol es pequeño)."""
+    parents = dict(Categoria.objects.values_list('pk', 'parent_id'))
+    roots = {}
+    for pk in parents:
+        current, seen = pk, set()
+        while parents.get(current) is not None and current not in seen:
+            seen.add(current)
+            current = parents[current]
+        roots[pk] = current
+    return roots
+
+
+def refresh_products(producto_ids):
+    """Recalcula las filas del índice para los productos indicados.
+
+    Los ids que ya no existen se eliminan del índice. Devuelve cuántas filas
+    se escribieron.
+    """
+    ids = {int(pk) for pk in producto_ids if pk is not None}
+    if not ids:
+        return 0
+    roots = _category_roots()
+    stock = dict(
+        ColorVariante.objects.filter(producto_id__in=ids)
+        .values('producto_id')
+        .annotate(total=Sum('stock'))
+        .values_list('producto_id', 'total')
+    )
+    rows = []
+    productos = Producto.objects.filter(pk__in=ids).only(
+        'pk', 'precio', 'precio_oferta', 'categoria_id', 'es_oferta', 'es_nueva_coleccion'
+    )
+    for p in productos:
+        rows.append(ProductoIndice(
+            producto_id=p.pk,
+            precio_efectivo=p.precio_oferta if p.precio_oferta is not None else p.precio,
+            categoria_id=p.categoria_id,
+            categoria_raiz_id=roots.get(p.categoria_id),
+            es_oferta=p.es_oferta,
+            es_nueva_coleccion=p.es_nueva_coleccion,
+            stock_total=stock.get(p.pk) or 0,
+        ))
+    missing = ids - {r.producto_id for r in rows}
+    if missing:
+        ProductoIndice.objects.filter(pk__in=missing).delete()
+    if rows:
+        ProductoIndice.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=['producto'],
+            update_fields=INDEX_UPDATE_FIELDS,
+        )
+    return len(rows)
+
+
+def refresh_category(categoria):
+    """Reindexa los productos del subárbol de una categoría (p.ej. si cambió de padre)."""
+    ids = Producto.objects.filter(
+        categoria__in=categoria.get_descendants(include_self=True)
+    ).values_list('pk', flat=True)
+    return refresh_products(ids)
+
+
+def refresh_orphans():
+    """Reindexa filas cuya categoría fue eliminada (SET_NULL dejó la raíz desfasada)."""
+    ids = ProductoIndice.objects.filter(categoria__isnull=True).values_list('pk', flat=True)
+    return refresh_products(ids)
+
+
+def rebuild_catalog_index(batch_size=500):
+    """Reconstruye el índice completo por lotes. Devuelve el total de filas escritas."""
+    total = 0
+    ids = list(Producto.objects.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(ids), batch_size):
+        total += refresh_products(ids[start:start + batch_size])
+    return total
+
+
+# ================= Consultas =================
+def catalog_queryset():
+    """Queryset base del catálogo con `precio_efectivo` leído del índice."""
+    return (
+        Producto.objects.select_related("categoria__parent")
+        .prefetch_related("variantes")
+        .annotate(precio_efectivo=F("indice__precio_efectivo"))
+    )
+
+
+def category_q(categoria):
+    """Filtro por categoría (incluyendo descendientes) resuelto sobre el índice."""
+    if categoria.is_root_node():
+        return Q(indice__categoria_raiz_id=categoria.pk)
+    if categoria.is_leaf_node():
+        return Q(indice__categoria_id=categoria.pk)
+    return Q(indice__categoria_id__in=categoria.get_descendants(include_self=True).values('pk'))
+
+
+def filter_catalog(queryset, categoria=None, nueva_coleccion=False, solo_ofertas=False,
+                   precio_min=None, precio_max=None):
+    """Aplica los filtros del catálogo contra ProductoIndice (sin DISTINCT)."""
+    filtros = Q()
+    if categoria is not None:
+        filtros &= category_q(categoria)
+    if nueva_coleccion:
+        filtros &= Q(indice__es_nueva_coleccion=True)
+    if solo_ofertas:
+        filtros &= Q(indice__es_oferta=True)
+    if precio_min is not None:
+        filtros &= Q(indice__precio_efectivo__gte=precio_min)
+    if precio_max is not None:
+        filtros &= Q(indice__precio_efectivo__lte=precio_max)
+    return queryset.filter(filtros) if filtros else queryset
+
+
+def order_catalog(queryset, orden, relevancia=False):
+    """Orden del catálogo; con búsqueda activa y sin orden explícito, por relevancia."""
+    if relevancia and not orden:
+        return queryset.order_by("-search_rank", "-id")
+    # NULL (producto aún sin índice) como el precio más alto en ambos motores (pagination._after_q)
+    if orden == "price-asc":
+        return queryset.order_by(F("indice__precio_efectivo").asc(nulls_last=True), "id")
+    if orden == "price-desc":
+        return queryset.order_by(F("indice__precio_efectivo").desc(nulls_first=True), "-id")
+    return queryset.order_by("-id")
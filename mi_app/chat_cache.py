@@ -0,0 +1,88 @@
+# mi_app/chat_cache.py
+"""Cache de respuestas del chatbot para las preguntas frecuentes.
+
+Las respuestas se agrupan por "cubeta": versiones de catálogo y sitio
+(versioning.py; guardar ConfiguracionChatbot incrementa 'sitio'), hash de
+las instrucciones del sistema ya formateadas (cambian con
+instrucciones_sistema y con el nombre del cliente) y huella de los dos
+últimos turnos del historial. Dentro de la cubeta la clave es el mensaje
+normalizado (sin tildes, mayúsculas ni signos).
+
+Si no hay coincidencia exacta se busca un casi-duplicado entre los últimos
+INDEX_MAX mensajes de la cubeta: similitud de Jaccard entre trigramas
+(autocomplete.trigrams) de al menos NEAR_THRESHOLD, y solo si las palabras
+distintas son largas (erratas como "metodo"/"metodos"); palabras cortas o
+números distintos ("talla s" / "talla m", "talla 40" / "talla 42") nunca
+coinciden.
+"""
+import hashlib
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .autocomplete import trigrams
+from .models import Producto
+from .versioning import CATALOGO, SITIO, versions_token
+
+TTL = getattr(settings, 'CHAT_CACHE_TTL', 6 * 3600)
+NEAR_THRESHOLD = 0.8
+INDEX_MAX = 200
+# Longitud mínima de las palabras que pueden diferir en un casi-duplicado
+MIN_DIFF_WORD = 4
+
+_RESPONSE = 'fi:chat:resp:{}:{}'
+_INDEX = 'fi:chat:idx:{}'
+
+
+def normalize(message):
+    return re.sub(r'[^a-z0-9]+', ' ', Producto._normalize_text(message)).strip()
+
+
+def bucket(system_instructions, history):
+    """Identificador de la cubeta: versiones, instrucciones y últimos dos turnos."""
+    turns = '|'.join(f"{h.get('role')}:{normalize(h.get('text', ''))}" for h in (history or [])[-2:])
+    raw = '|'.join((versions_token(CATALOGO, SITIO), system_instructions, turns))
+    return hashlib.md5(raw.encode()).hexdigest()
+
+
+def _digest(norm):
+    return hashlib.md5(norm.encode()).hexdigest()
+
+
+def _similar(a, b):
+    words_a, words_b = set(a.split()), set(b.split())
+    if any(len(w) < MIN_DIFF_WORD for w in words_a ^ words_b):
+        return 0.0
+    grams_a, grams_b = trigrams(a), trigrams(b)
+    if not grams_a or not grams_b:
+        return 0.0
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
+
+
+def lookup(message, bucket_id):
+    """Respuesta cacheada para el mensaje (exacta o casi-duplicada) o None."""
+    norm = normalize(message)
+    if not norm:
+        return None
+    found = cache.get(_RESPONSE.format(bucket_id, _digest(norm)))
+    if found is not None:
+        return found
+    best, best_score = None, NEAR_THRESHOLD
+    for candidate in cache.get(_INDEX.format(bucket_id)) or ():
+        score = _similar(norm, candidate)
+        if score >= best_score:
+            best, best_score = candidate, score
+    if best is None:
+        return None
+    return cache.get(_RESPONSE.format(bucket_id, _digest(best)))
+
+
+def store(message, bucket_id, response):
+    norm = normalize(message)
+    if not norm:
+        return
+    cache.set(_RESPONSE.format(bucket_id, _digest(norm)), response, TTL)
+    index = [n for n in cache.get(_INDEX.format(bucket_id)) or () if n != norm]
+    index.append(norm)
+    cache.set(_INDEX.format(bucket_id), index[-INDEX_MAX:], TTL)
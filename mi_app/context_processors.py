@@ -1,48 +1,231 @@
 # mi_app/context_processors.py
 import json
 import os
+import random
+from functools import lru_cache
 from pathlib import Path
-from .models import Categoria, ConfiguracionSitio, Pagina, ConfiguracionRuleta, ConfiguracionChatbot, Banner, Producto, Carrito
+from django.core.cache import cache
+from .models import Categoria, ConfiguracionSitio, Pagina, ConfiguracionRuleta, ConfiguracionChatbot, Banner, Producto
+from .versioning import CATALOGO, SITIO, versions_token
+from . import sampling
+from .cart import get_cart
 from django.urls import reverse
 from django.utils import timezone
 
-def common_context(request):
-    """
-    Provee contexto común a todas las plantillas, incluyendo las configuraciones
-    globales del sitio, la ruleta y el chatbot.
-    """
+# Snapshot de datos globales del sitio (configuraciones, menú, páginas, promos,
+# ruleta y banners). Se guarda en el cache bajo una clave con las versiones
+# 'sitio' y 'catalogo'; los receptores de mi_app.signals las incrementan al
+# guardar/borrar los modelos implicados. El TTL es solo una red de seguridad.
+SNAPSHOT_TTL = 60 * 10
+# Candidatos precargados por tipo de promo; se elige uno al azar por request.
+PROMO_POOL_SIZE = 12
+
+# Marcadores de la caché de página completa (ver http_cache.py). Solo letras y
+# dígitos para que ningún filtro de escape los altere.
+CSRF_HOLE = 'FIHOLEcsrf7c1d'
+CART_HOLE = 'FIHOLEcart7c1d'
+PROMO_HOLE = 'FIHOLEpromo7c1d'
+PAGE_HOLES = {
+    'csrf_token': CSRF_HOLE,
+    'cart_count': CART_HOLE,
+    'promo_products_json': PROMO_HOLE,
+}
+
+
+@lru_cache(maxsize=1)
+def _build_info():
+    """Sello de versión (para ver en producción qué build está activo). No cambia durante el proceso."""
+    try:
+        commit_full = os.environ.get('RENDER_GIT_COMMIT') or os.environ.get('GIT_COMMIT') or os.environ.get('COMMIT_SHA') or ''
+        branch = os.environ.get('RENDER_GIT_BRANCH') or os.environ.get('BRANCH') or ''
+        built_at = ''
+        # Fallback: leer build_info.json en raíz del proyecto
+        if not commit_full:
+            try:
+                root = Path(__file__).resolve().parents[1]
+                info_path = root / 'build_info.json'
+                if info_path.exists():
+                    with open(info_path, 'r', encoding='utf-8') as f:
+                        info = json.load(f)
+                        commit_full = info.get('commit', '') or commit_full
+                        branch = info.get('branch', '') or branch
+                        built_at = info.get('built_at', '')
+            except Exception:
+                pass
+        return {
+            'build_commit': (commit_full[:7] if commit_full else ''),
+            'build_branch': branch,
+            'build_built_at': built_at,
+        }
+    except Exception:
+        return {'build_commit': '', 'build_branch': '', 'build_built_at': ''}
+
+
+def _promo_entry(producto, offer=False):
+    try:
+        variant_urls = [getattr(v.imagen, 'url', None) for v in producto.variantes.all()][:2]
+        variant_urls = [u for u in variant_urls if u]
+    except Exception:
+        variant_urls = []
+    entry = {
+        'id': producto.id,
+        'name': producto.nombre,
+        'image': getattr(producto.imagen_principal, 'url', None),
+        'variant_images': variant_urls,
+        'price': str(producto.precio),
+    }
+    if offer:
+        entry['offer_price'] = str(producto.precio_oferta) if producto.precio_oferta else None
+        entry['discount_percent'] = producto.descuento_porcentaje
+    return entry
+
+
+def _promo_pool(pool, offer=False):
+    """Datos de hasta PROMO_POOL_SIZE productos muestreados de un pool de ids (sin ORDER BY RANDOM())."""
+    try:
+        ids = sampling.sample(pool, PROMO_POOL_SIZE)
+        productos = sampling.fetch_in_order(ids, Producto.objects.prefetch_related('variantes'))
+        return [_promo_entry(p, offer=offer) for p in productos]
+    except Exception:
+        return []
+
+
+def _banner_destino(b):
+    """Resuelve la URL de destino del banner según modo_destino (simplificado)."""
+    modo = getattr(b, 'modo_destino', 'nueva')
+    if modo == 'nueva':
+        return f"{reverse('catalogo_publico')}?categoria=nueva_coleccion&banner_id={b.pk}#product-list-section"
+    if modo == 'ofertas':
+        return f"{reverse('catalogo_publico')}?solo_ofertas=1&banner_id={b.pk}#product-list-section"
+    if modo == 'producto':
+        # Soporte: si hay múltiples seleccionados usamos ?productos=1,2,3
+        ids_multi = [p.pk for p in b.productos_destacados.all()]
+        if ids_multi:
+            if len(ids_multi) == 1:
+                # Uno solo -> detalle
+                return reverse('producto_detalle', args=[ids_multi[0]])
+            cadena = ','.join(str(i) for i in ids_multi)
+            return f"{reverse('catalogo_publico')}?productos={cadena}&banner_id={b.pk}#product-list-section"
+        return None
+    if modo == 'enlace' and getattr(b, 'enlace', None):
+        return b.enlace
+    return None
+
+
+def _build_site_snapshot():
+    """Consulta todo lo global del sitio. Solo se ejecuta cuando el snapshot no está en cache."""
     # Obtenemos todas las configuraciones singleton de una vez.
     try:
         configuracion_sitio = ConfiguracionSitio.get_solo()
     except ConfiguracionSitio.DoesNotExist:
         configuracion_sitio = None
-        
+
     try:
         config_ruleta = ConfiguracionRuleta.get_solo()
     except ConfiguracionRuleta.DoesNotExist:
         config_ruleta = None
-        
+
     try:
         chatbot_config = ConfiguracionChatbot.get_solo()
     except ConfiguracionChatbot.DoesNotExist:
         chatbot_config = None
 
+    premios = []
+    if config_ruleta:
+        premios = [{'id': p.id, 'nombre': p.nombre} for p in config_ruleta.premios.filter(activo=True)[:8]]
+
+    # === PROMOS: candidatos de nueva colección y oferta (fallback: cualquier producto) ===
+    pools = sampling.get_pools()
+    promo_new = _promo_pool(pools.nueva_coleccion)
+    promo_offer = _promo_pool(pools.ofertas, offer=True)
+    promo_any = [] if (promo_new or promo_offer) else _promo_pool(pools.con_imagen)
+
+    banners = []
+    for b in Banner.objects.filter(activo=True).prefetch_related('productos_destacados').order_by('id'):
+        destino = _banner_destino(b)
+        if destino:
+            banners.append({
+                'id': b.pk,
+                'titulo': getattr(b, 'titulo', ''),
+                'subtitulo': getattr(b, 'subtitulo', ''),
+                'imagen_url': b.imagen.url if getattr(b, 'imagen', None) else None,
+                'destino_url': destino,
+                'texto_boton': getattr(b, 'texto_boton', 'Ver ahora'),
+                'fecha_inicio': getattr(b, 'fecha_inicio', None),
+                'fecha_fin': getattr(b, 'fecha_fin', None),
+                'modo': getattr(b, 'modo_destino', 'nueva'),
+            })
+
+    return {
+        'configuracion_sitio': configuracion_sitio,
+        'configuracion_ruleta': config_ruleta,
+        'chatbot_config': chatbot_config,
+        'categorias_menu': list(Categoria.objects.filter(parent__isnull=True).prefetch_related('children')),
+        'paginas_informativas': list(Pagina.objects.filter(publicada=True)),
+        'premios_ruleta_json': json.dumps(premios),
+        'promo_new': promo_new,
+        'promo_offer': promo_offer,
+        'promo_any': promo_any,
+        'banners': banners,
+    }
+
+
+def get_site_snapshot(request=None):
+    """Snapshot global vigente; se memoiza en el request para que ambos context processors
+    compartan una sola lectura del cache."""
+    snapshot = getattr(request, '_site_snapshot', None) if request is not None else None
+    if snapshot is not None:
+        return snapshot
+    key = f'fi:site_snapshot:{versions_token(SITIO, CATALOGO)}'
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = _build_site_snapshot()
+        cache.set(key, snapshot, SNAPSHOT_TTL)
+    if request is not None:
+        request._site_snapshot = snapshot
+    return snapshot
+
+
+def promo_products_json(snapshot):
+    """PROMOS: 1 producto nueva colección y 1 oferta al azar entre los candidatos cacheados."""
+    promo_payload = {
+        'new_collection': random.choice(snapshot['promo_new']) if snapshot['promo_new'] else None,
+        'offer': random.choice(snapshot['promo_offer']) if snapshot['promo_offer'] else None,
+    }
+    # Fallback: cualquier producto con imagen si ambos faltan
+    if not promo_payload['new_collection'] and not promo_payload['offer']:
+        if snapshot['promo_any']:
+            promo_payload['any_product'] = random.choice(snapshot['promo_any'])
+    else:
+        promo_payload['any_product'] = None
+    return json.dumps(promo_payload)
+
+
+def common_context(request):
+    """
+    Provee contexto común a todas las plantillas, incluyendo las configuraciones
+    globales del sitio, la ruleta y el chatbot.
+
+    Todo lo global sale del snapshot cacheado; solo el contador del carrito y
+    lo dependiente de la hora (ruleta, promo aleatoria) se calcula por request.
+    """
+    snapshot = get_site_snapshot(request)
+    configuracion_sitio = snapshot['configuracion_sitio']
+    config_ruleta = snapshot['configuracion_ruleta']
+    chatbot_config = snapshot['chatbot_config']
+
     # Creamos el diccionario de contexto base.
-    # Calcular cart_count: usar carrito persistente si el usuario está autenticado
-    if getattr(request, 'user', None) and request.user.is_authenticated:
-        try:
-            carrito = Carrito.objects.filter(user=request.user).first()
-            cart_count = carrito.total_items if carrito else 0
-        except Exception:
-            cart_count = 0
+    # cart_count sale del carrito en sesión (espejo del persistente si hay usuario): sin consultas
+    if hasattr(request, 'session') and hasattr(request, 'user'):
+        cart_count = get_cart(request).count
     else:
-        cart_count = sum(item.get('quantity', 0) for item in request.session.get('cart', {}).values())
+        cart_count = 0
 
     context = {
-        'categorias_menu': Categoria.objects.filter(parent__isnull=True).prefetch_related('children'),
+        'categorias_menu': snapshot['categorias_menu'],
         'cart_count': cart_count,
         'configuracion_sitio': configuracion_sitio,
-        'paginas_informativas': Pagina.objects.filter(publicada=True),
+        'paginas_informativas': snapshot['paginas_informativas'],
         'configuracion_ruleta': config_ruleta,
         'chatbot_config': chatbot_config, # <-- Aquí está la nueva configuración
         # Zoom de producto (configurable desde admin)
@@ -64,110 +247,12 @@ def common_context(request):
     }
 
     # Sello de versión (para ver en producción qué build está activo)
-    try:
-        commit_full = os.environ.get('RENDER_GIT_COMMIT') or os.environ.get('GIT_COMMIT') or os.environ.get('COMMIT_SHA') or ''
-        branch = os.environ.get('RENDER_GIT_BRANCH') or os.environ.get('BRANCH') or ''
-        built_at = ''
-        # Fallback: leer build_info.json en raíz del proyecto
-        if not commit_full:
-            try:
-                root = Path(__file__).resolve().parents[1]
-                info_path = root / 'build_info.json'
-                if info_path.exists():
-                    with open(info_path, 'r', encoding='utf-8') as f:
-                        info = json.load(f)
-                        commit_full = info.get('commit', '') or commit_full
-                        branch = info.get('branch', '') or branch
-                        built_at = info.get('built_at', '')
-            except Exception:
-                pass
-        context['build_commit'] = (commit_full[:7] if commit_full else '')
-        context['build_branch'] = branch
-        context['build_built_at'] = built_at
-    except Exception:
-        context['build_commit'] = ''
-        context['build_branch'] = ''
-        context['build_built_at'] = ''
+    context.update(_build_info())
 
-    # === PROMOS: Selección rápida de 1 producto nueva colección y 1 oferta ===
-    try:
-        nuevo = (Producto.objects
-                 .filter(es_nueva_coleccion=True, imagen_principal__isnull=False)
-                 .order_by('?')
-                 .first())
-    except Exception:
-        nuevo = None
-    try:
-        oferta = (Producto.objects
-                  .filter(es_oferta=True, imagen_principal__isnull=False)
-                  .order_by('?')
-                  .first())
-    except Exception:
-        oferta = None
-
-    promo_payload = {
-        'new_collection': None,
-        'offer': None,
-    }
-    if nuevo:
-        try:
-            variant_urls_nuevo = [getattr(v.imagen, 'url', None) for v in nuevo.variantes.all()][:2]
-            variant_urls_nuevo = [u for u in variant_urls_nuevo if u]
-        except Exception:
-            variant_urls_nuevo = []
-        promo_payload['new_collection'] = {
-            'id': nuevo.id,
-            'name': nuevo.nombre,
-            'image': getattr(nuevo.imagen_principal, 'url', None),
-            'variant_images': variant_urls_nuevo,
-            'price': str(nuevo.precio),
-        }
-    if oferta:
-        try:
-            variant_urls_oferta = [getattr(v.imagen, 'url', None) for v in oferta.variantes.all()][:2]
-            variant_urls_oferta = [u for u in variant_urls_oferta if u]
-        except Exception:
-            variant_urls_oferta = []
-        promo_payload['offer'] = {
-            'id': oferta.id,
-            'name': oferta.nombre,
-            'image': getattr(oferta.imagen_principal, 'url', None),
-            'variant_images': variant_urls_oferta,
-            'price': str(oferta.precio),
-            'offer_price': str(oferta.precio_oferta) if oferta.precio_oferta else None,
-            'discount_percent': oferta.descuento_porcentaje,
-        }
-    # Fallback: cualquier producto con imagen si ambos faltan
-    if not promo_payload['new_collection'] and not promo_payload['offer']:
-        try:
-            cualquiera = (Producto.objects
-                           .filter(imagen_principal__isnull=False)
-                           .order_by('?')
-                           .first())
-        except Exception:
-            cualquiera = None
-        if cualquiera:
-            try:
-                variant_urls_any = [getattr(v.imagen, 'url', None) for v in cualquiera.variantes.all()][:2]
-                variant_urls_any = [u for u in variant_urls_any if u]
-            except Exception:
-                variant_urls_any = []
-            promo_payload['any_product'] = {
-                'id': cualquiera.id,
-                'name': cualquiera.nombre,
-                'image': getattr(cualquiera.imagen_principal, 'url', None),
-                'variant_images': variant_urls_any,
-                'price': str(cualquiera.precio),
-            }
-    else:
-        promo_payload['any_product'] = None
-    context['promo_products_json'] = json.dumps(promo_payload)
+    context['promo_products_json'] = promo_products_json(snapshot)
 
     # Preparamos los datos JSON específicos para la ruleta si existe.
     if config_ruleta:
-        premios_ruleta = list(config_ruleta.premios.filter(activo=True)[:8])
-        premios_json = json.dumps([{'id': p.id, 'nombre': p.nombre} for p in premios_ruleta])
-        
         # Calcular segundos restantes si hay fecha_fin
         remaining_seconds = None
         try:
@@ -189,7 +274,7 @@ def common_context(request):
         config_json = json.dumps(config_json_data)
 
         context.update({
-            'roulette_prizes_json': premios_json,
+            'roulette_prizes_json': snapshot['premios_ruleta_json'],
             'roulette_config_json': config_json,
             'ruleta_activa': (config_ruleta.is_active_now() if hasattr(config_ruleta, 'is_active_now') else config_ruleta.activa),
         })
@@ -201,54 +286,26 @@ def common_context(request):
             'ruleta_activa': False,
         })
 
+    if getattr(request, '_page_cache_render', False):
+        # Render para la caché de página completa (http_cache): lo propio de cada
+        # visitante queda como marcador y se rellena al servir la copia cacheada
+        context.update(PAGE_HOLES)
+
     return context
 
 
 def banners_context(request):
-    """Devuelve banners activos con URL según modo_destino (simplificado)."""
+    """Devuelve banners activos con URL según modo_destino (simplificado).
+
+    Los destinos se resuelven al construir el snapshot; aquí solo se aplica
+    la ventana de fechas, que depende de la hora actual.
+    """
     banners_out = []
     now = timezone.now()
-    for b in Banner.objects.filter(activo=True).order_by('id'):
-        if getattr(b, 'fecha_inicio', None) and b.fecha_inicio and b.fecha_inicio > now:
+    for b in get_site_snapshot(request)['banners']:
+        if b['fecha_inicio'] and b['fecha_inicio'] > now:
             continue
-        if getattr(b, 'fecha_fin', None) and b.fecha_fin and b.fecha_fin < now:
+        if b['fecha_fin'] and b['fecha_fin'] < now:
             continue
-        destino = None
-        modo = getattr(b, 'modo_destino', 'nueva')
-        if modo == 'nueva':
-            destino = f"{reverse('catalogo_publico')}?categoria=nueva_coleccion&banner_id={b.pk}#product-list-section"
-        elif modo == 'ofertas':
-            destino = f"{reverse('catalogo_publico')}?solo_ofertas=1&banner_id={b.pk}#product-list-section"
-        elif modo == 'producto':
-            # Soporte: si hay múltiples seleccionados usamos ?productos=1,2,3
-            ids_multi = []
-            try:
-                ids_multi = list(b.productos_destacados.values_list('pk', flat=True)) if hasattr(b, 'productos_destacados') else []
-            except Exception:
-                ids_multi = []
-            if ids_multi:
-                if len(ids_multi) == 1:
-                    # Uno solo -> detalle
-                    destino = reverse('producto_detalle', args=[ids_multi[0]])
-                else:
-                    cadena = ','.join(str(i) for i in ids_multi)
-                    destino = f"{reverse('catalogo_publico')}?productos={cadena}&banner_id={b.pk}#product-list-section"
-        elif modo == 'enlace' and getattr(b, 'enlace', None):
-            destino = b.enlace
-        # Debug simple después de resolver destino
-        try:
-            print(f"BANNER_CTX: banner={b.pk} modo={modo} destino={destino}")
-        except Exception:
-            pass
-        if destino:
-            banners_out.append({
-                'id': b.pk,
-                'titulo': getattr(b, 'titulo', ''),
-                'subtitulo': getattr(b, 'subtitulo', ''),
-                'imagen_url': b.imagen.url if getattr(b, 'imagen', None) else None,
-                'destino_url': destino,
-                'texto_boton': getattr(b, 'texto_boton', 'Ver ahora'),
-                'fecha_fin': getattr(b, 'fecha_fin', None),
-                'modo': modo,
-            })
+        banners_out.append(b)
     return {'banners_activos': banners_out}
@@ -0,0 +1,139 @@
+# mi_app/http_cache.py
+"""GET condicional (ETag / 304) y caché de página completa para visitantes anónimos.
+
+El ETag se deriva de los contadores de versionado (versioning.py), que los
+receptores de signals.py incrementan al cambiar productos, variantes,
+categorías, banners o la configuración del sitio; no hace falta renderizar
+para saber si la página cambió. Como la cabecera muestra el usuario y el
+contador del carrito, el ETag también incluye quién pide y cuántos ítems
+lleva, y la respuesta varía por Cookie.
+
+Solo las respuestas anónimas que no fijan cookies (sesión nueva, token CSRF
+nuevo) se marcan `public, s-maxage` para que un CDN pueda servirlas; el
+resto queda `private` y se revalida con el navegador.
+
+Con page_cache=True el HTML anónimo se guarda en el cache bajo la misma
+clave de versiones. Lo único que cambia entre invitados (token CSRF,
+contador del carrito y la promo al azar) se renderiza como marcador
+(context_processors.PAGE_HOLES) y se rellena al servir cada copia: un
+acierto no toca plantillas ni base de datos más allá de `extra`.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.middleware.csrf import get_token
+from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.html import escapejs
+from django.utils.http import parse_etags, quote_etag
+
+from .cart import get_cart
+from .context_processors import CART_HOLE, CSRF_HOLE, PROMO_HOLE, get_site_snapshot, promo_products_json
+from .versioning import CATALOGO, SITIO, versions_token
+
+S_MAXAGE = getattr(settings, 'HTTP_CACHE_S_MAXAGE', 300)
+# Corto a propósito: acota lo que tardan en verse la ventana de banners y la cuenta atrás de la ruleta
+PAGE_CACHE_TTL = getattr(settings, 'PAGE_CACHE_TTL', 60)
+
+
+def _visitor(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'u{user.pk}'
+    return 'anon'
+
+
+def _has_messages(request):
+    # len() no marca los mensajes como leídos
+    try:
+        return len(get_messages(request)) > 0
+    except Exception:
+        return False
+
+
+def _sets_cookies(request):
+    session = getattr(request, 'session', None)
+    return bool(request.META.get('CSRF_COOKIE_NEEDS_UPDATE')) or (session is not None and session.modified)
+
+
+def _fill_holes(request, content):
+    """Sustituye los marcadores de la copia cacheada por los valores de este visitante."""
+    if CSRF_HOLE in content:
+        content = content.replace(CSRF_HOLE, get_token(request))
+    if CART_HOLE in content:
+        content = content.replace(CART_HOLE, str(get_cart(request).count))
+    if PROMO_HOLE in content:
+        content = content.replace(PROMO_HOLE, escapejs(promo_products_json(get_site_snapshot(request))))
+    return content
+
+
+def _cached_page(request, key, view, args, kwargs):
+    entry = cache.get(key)
+    if entry is None:
+        request._page_cache_render = True
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            request._page_cache_render = False
+        if response.status_code != 200 or response.streaming:
+            return response
+        entry = (response.content.decode(response.charset), response['Content-Type'])
+        if not response.cookies:
+            cache.set(key, entry, PAGE_CACHE_TTL)
+    content, content_type = entry
+    return HttpResponse(_fill_holes(request, content), content_type=content_type)
+
+
+def conditional_page(namespaces=(CATALOGO, SITIO), per_visitor=True, extra=None, s_maxage=None, page_cache=False):
+    """Decorador de vistas GET: responde 304 si el ETag del cliente coincide.
+
+    `extra(request, *args, **kwargs)` añade al ETag lo que la versión no cubre
+    (p.ej. el stock de un producto). Con per_visitor=False la respuesta es la
+    misma para todos (JSON de sugerencias) y no varía por Cookie. Con
+    page_cache=True los anónimos reciben la copia cacheada con los huecos
+    rellenos.
+    """
+    max_age = S_MAXAGE if s_maxage is None else s_maxage
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or (per_visitor and _has_messages(request)):
+                return view(request, *args, **kwargs)
+
+            # Las vistas responden un parcial a fetch/XHR con la misma URL
+            parts = [
+                view.__name__, request.get_full_path(), versions_token(*namespaces),
+                str(timezone.localdate()), request.headers.get('x-requested-with', ''),
+            ]
+            if extra is not None:
+                parts.append(str(extra(request, *args, **kwargs)))
+            content_key = hashlib.md5('|'.join(parts).encode()).hexdigest()
+            anonimo = per_visitor and _visitor(request) == 'anon'
+            etag = content_key
+            if per_visitor:
+                etag = hashlib.md5(f'{content_key}|{_visitor(request)}|{get_cart(request).count}'.encode()).hexdigest()
+            etag = quote_etag(etag)
+
+            if etag in parse_etags(request.headers.get('If-None-Match', '')):
+                response = HttpResponseNotModified()
+            elif page_cache and anonimo:
+                response = _cached_page(request, f'fi:page:{content_key}', view, args, kwargs)
+            else:
+                response = view(request, *args, **kwargs)
+            if response.status_code not in (200, 304):
+                return response
+
+            response['ETag'] = etag
+            patch_vary_headers(response, ('Cookie', 'X-Requested-With') if per_visitor else ('X-Requested-With',))
+            if not per_visitor or (anonimo and not _sets_cookies(request)):
+                patch_cache_control(response, public=True, max_age=0, s_maxage=max_age)
+            else:
+                patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,231 @@
+# mi_app/key_pool.py
+"""Salud de las claves de IA (ApiKey) y circuit breaker por proveedor.
+
+Cada clave se identifica por un hash SHA-256 (key_id) y no por sus últimos
+caracteres, así dos claves con el mismo final no comparten penalización. En
+el cache (compartido entre workers) se guarda, por clave y por modelo:
+
+- la tasa de éxito reciente (media exponencial de aciertos),
+- la latencia media exponencial (EWMA),
+- el enfriamiento tras fallos seguidos (429 y 401/403 enfrían más) y
+- las peticiones del día frente a AI_KEY_DAILY_QUOTA.
+
+order() devuelve las claves utilizables de mejor a peor puntuación. Si un
+proveedor encadena CIRCUIT_THRESHOLD fallos de red o 5xx, el circuito se abre
+CIRCUIT_COOLDOWN segundos: allow() responde False al instante en vez de agotar
+el plazo del chat contra un servicio caído. Pasado ese tiempo una sola
+petición sondea (semiabierto); un éxito lo cierra y un fallo lo vuelve a abrir.
+
+Las actualizaciones son leer-modificar-escribir sin bloqueo: entre workers
+puede perderse algún incremento, lo que basta para estas estadísticas.
+"""
+import hashlib
+import random
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+PENALTY_MAX = 15 * 60
+CIRCUIT_THRESHOLD = getattr(settings, 'AI_CIRCUIT_THRESHOLD', 5)
+CIRCUIT_COOLDOWN = getattr(settings, 'AI_CIRCUIT_COOLDOWN', 60)
+# Peticiones por clave y día (0 = sin límite); al alcanzarlo la clave descansa hasta mañana
+DAILY_QUOTA = getattr(settings, 'AI_KEY_DAILY_QUOTA', 0)
+# Peso de la última observación en las medias exponenciales
+ALPHA = 0.2
+STATS_TTL = 2 * 24 * 3600
+
+_KEY = 'fi:ai_pool:key:{}'
+_MODELS = 'fi:ai_pool:models:{}'
+_CIRCUIT = 'fi:ai_pool:circuit:{}'
+_PROBE = 'fi:ai_pool:probe:{}'
+
+
+def key_id(key):
+    """Identificador estable y no reversible de una clave (para cache y logs)."""
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def _new_stats():
+    # Optimista: una clave sin historial se prueba antes que una que ya falló
+    return {'ok': 0, 'fail': 0, 'rate': 1.0, 'latency': 0.0, 'strikes': 0,
+            'cooldown_until': 0.0, 'last_status': None, 'day': '', 'day_count': 0}
+
+
+def _ewma(previous, value, seen):
+    return value if not seen else previous + ALPHA * (value - previous)
+
+
+def _score(stats):
+    """Tasa de éxito penalizada por la latencia (5 s de media la reduce a la mitad)."""
+    return stats['rate'] / (1 + stats['latency'] / 5)
+
+
+def _requests_today(stats):
+    return stats['day_count'] if stats['day'] == timezone.localdate().isoformat() else 0
+
+
+def _usable(stats, now):
+    if stats['cooldown_until'] > now:
+        return False
+    return not DAILY_QUOTA or _requests_today(stats) < DAILY_QUOTA
+
+
+def _cooldown(status, strikes):
+    """Segundos de enfriamiento: base según el error, duplicada por cada fallo seguido."""
+    if status in (401, 403):
+        return PENALTY_MAX
+    base = 300 if status == 429 else 60
+    return min(base * 2 ** (strikes - 1), PENALTY_MAX)
+
+
+def _observe(stats, success, latency):
+    seen = stats['ok'] + stats['fail'] > 0
+    stats['ok' if success else 'fail'] += 1
+    stats['rate'] = _ewma(stats['rate'], 1.0 if success else 0.0, seen)
+    if latency is not None:
+        stats['latency'] = _ewma(stats['latency'], latency, seen and stats['latency'] > 0)
+
+
+def _count_today(stats):
+    today = timezone.localdate().isoformat()
+    if stats['day'] != today:
+        stats['day'], stats['day_count'] = today, 0
+    stats['day_count'] += 1
+
+
+# ================= Lectura =================
+async def order(provider, keys):
+    """Claves utilizables (sin enfriamiento ni cuota agotada) de mejor a peor.
+
+    Un poco de azar reparte la carga entre claves con puntuación parecida.
+    """
+    found = await cache.aget_many([_KEY.format(key_id(k)) for k in keys])
+    now = time.time()
+    ranked = []
+    for key in keys:
+        stats = found.get(_KEY.format(key_id(key))) or _new_stats()
+        if _usable(stats, now):
+            ranked.append((_score(stats) + random.random() * 0.05, key))
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return [key for _, key in ranked]
+
+
+async def allow(provider):
+    """False mientras el circuito del proveedor está abierto (salvo para la petición que sondea)."""
+    circuit = await cache.aget(_CIRCUIT.format(provider))
+    if not circuit or not circuit.get('opened_until'):
+        return True
+    if circuit['opened_until'] > time.time():
+        return False
+    # Semiabierto: solo el primero en tomar el turno prueba el proveedor
+    return await cache.aadd(_PROBE.format(provider), True, CIRCUIT_COOLDOWN)
+
+
+# ================= Registro =================
+async def record_success(provider, key, model, latency):
+    kid = key_id(key)
+    stats = await cache.aget(_KEY.format(kid)) or _new_stats()
+    _observe(stats, True, latency)
+    _count_today(stats)
+    stats.update(strikes=0, cooldown_until=0.0, last_status=200)
+    await cache.aset(_KEY.format(kid), stats, STATS_TTL)
+    await _record_model(provider, model, True, latency)
+    circuit = await cache.aget(_CIRCUIT.format(provider))
+    if circuit:
+        await cache.adelete_many([_CIRCUIT.format(provider), _PROBE.format(provider)])
+
+
+async def record_failure(provider, key, model, status=None, key_fault=True):
+    """Registra un intento fallido; status None es error de red o timeout.
+
+    key_fault=False (404 de modelo, 400 ya reintentado) cuenta solo para el
+    modelo: la clave no tiene la culpa y no se enfría.
+    """
+    await _record_model(provider, model, False, None)
+    if key_fault:
+        kid = key_id(key)
+        stats = await cache.aget(_KEY.format(kid)) or _new_stats()
+        _observe(stats, False, None)
+        _count_today(stats)
+        stats['strikes'] += 1
+        stats['last_status'] = status
+        stats['cooldown_until'] = time.time() + _cooldown(status, stats['strikes'])
+        await cache.aset(_KEY.format(kid), stats, STATS_TTL)
+    if status is None or status >= 500:
+        await _trip(provider)
+
+
+async def _record_model(provider, model, success, latency):
+    models = await cache.aget(_MODELS.format(provider)) or {}
+    stats = models.setdefault(model, _new_stats())
+    _observe(stats, success, latency)
+    await cache.aset(_MODELS.format(provider), models, STATS_TTL)
+
+
+async def _trip(provider):
+    circuit = await cache.aget(_CIRCUIT.format(provider)) or {'failures': 0, 'opened_until': 0.0}
+    circuit['failures'] += 1
+    if circuit['failures'] >= CIRCUIT_THRESHOLD:
+        circuit['opened_until'] = time.time() + CIRCUIT_COOLDOWN
+        await cache.adelete(_PROBE.format(provider))
+    await cache.aset(_CIRCUIT.format(provider), circuit, STATS_TTL)
+
+
+# ================= Estado (ai_status) =================
+def _iso(ts):
+    return datetime.fromtimestamp(ts, tz=timezone.get_current_timezone()).isoformat() if ts else None
+
+
+def snapshot(provider, keys):
+    """Estado del pool para monitoreo: circuito, claves (por key_id) y modelos."""
+    now = time.time()
+    found = cache.get_many([_KEY.format(key_id(k)) for k in keys])
+    circuit = cache.get(_CIRCUIT.format(provider)) or {'failures': 0, 'opened_until': 0.0}
+    if not circuit['opened_until']:
+        estado = 'cerrado'
+    elif circuit['opened_until'] > now:
+        estado = 'abierto'
+    else:
+        estado = 'semiabierto'
+
+    claves = []
+    for key in keys:
+        kid = key_id(key)
+        stats = found.get(_KEY.format(kid)) or _new_stats()
+        claves.append({
+            'id': kid,
+            'utilizable': _usable(stats, now),
+            'puntuacion': round(_score(stats), 3),
+            'tasa_exito': round(stats['rate'], 3),
+            'latencia_media_s': round(stats['latency'], 2),
+            'exitos': stats['ok'],
+            'fallos': stats['fail'],
+            'fallos_seguidos': stats['strikes'],
+            'ultimo_status': stats['last_status'],
+            'enfriada_hasta': _iso(stats['cooldown_until']) if stats['cooldown_until'] > now else None,
+            'peticiones_hoy': _requests_today(stats),
+        })
+    claves.sort(key=lambda c: c['puntuacion'], reverse=True)
+
+    modelos = {
+        model: {
+            'tasa_exito': round(stats['rate'], 3),
+            'latencia_media_s': round(stats['latency'], 2),
+            'exitos': stats['ok'],
+            'fallos': stats['fail'],
+        }
+        for model, stats in (cache.get(_MODELS.format(provider)) or {}).items()
+    }
+    return {
+        'circuito': {
+            'estado': estado,
+            'fallos_seguidos': circuit['failures'],
+            'abierto_hasta': _iso(circuit['opened_until']),
+        },
+        'cuota_diaria': DAILY_QUOTA or None,
+        'claves': claves,
+        'modelos': modelos,
+    }
@@ -0,0 +1,449 @@
+# mi_app/llm_gateway.py
+"""Gateway asíncrono hacia Gemini / OpenAI para el chatbot (get_ai_response).
+
+Todas las llamadas comparten un httpx.AsyncClient por event loop (pool de
+conexiones keep-alive) y un plazo global por mensaje (Deadline): cada intento
+usa como timeout lo que queda del plazo, y al agotarse se deja de rotar.
+
+No se duerme entre intentos: las claves se prueban en el orden de salud de
+key_pool (tasa de éxito, latencia, enfriamientos y cuota diaria), cada intento
+se registra allí y el bucle pasa de inmediato a la siguiente clave, endpoint
+o modelo. Con el circuito del proveedor abierto no se llama a la API. Mientras
+se espera a la API el worker ASGI atiende otras peticiones.
+
+Gemini no se sondea en cada mensaje: cada ApiKey guarda su resolución
+(modelo, endpoint, acepta systemInstruction), que refresca check_ai_keys
+con resolve_gemini, y la petición hace una sola llamada con ella. Solo si
+falta o quedó obsoleta (404, systemInstruction rechazado) se recorren las
+alternativas; lo hallado así se guarda en el cache (RESOLUTION_TTL) hasta la
+próxima ejecución de check_ai_keys, sin escribir en la base desde la petición.
+
+stream_gemini / stream_openai son las variantes en streaming
+(streamGenerateContent con alt=sse y `stream: true`): producen fragmentos de
+texto a medida que llegan. Solo se puede rotar de clave o modelo antes del
+primer fragmento; el plazo global acota ese tiempo hasta el primer token y
+luego cada lectura tiene su propio timeout. Un corte después del primer
+fragmento lanza StreamInterrupted (respuesta incompleta).
+"""
+import asyncio
+import copy
+import json
+import logging
+import time
+
+import httpx
+from django.conf import settings
+from django.core.cache import cache
+
+from . import key_pool
+
+logger = logging.getLogger(__name__)
+
+# Segundos totales que puede tardar un mensaje del chat, sumando todos los intentos
+REQUEST_DEADLINE = getattr(settings, 'AI_REQUEST_DEADLINE', 30)
+ATTEMPT_TIMEOUT = 15
+RESOLUTION_TTL = 6 * 3600
+_RESOLUTION = 'fi:ai_gemini_res:{}'
+
+GEMINI_URL = "https://generativelanguage.googleapis.com/{version}/models/{model}:generateContent"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/{version}/models/{model}:streamGenerateContent"
+OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+
+_client = None
+_client_loop = None
+
+
+class StreamInterrupted(Exception):
+    """El stream se cortó después de enviar fragmentos: la respuesta quedó incompleta."""
+
+
+class Deadline:
+    """Plazo global de una petición; reparte el tiempo restante entre intentos."""
+
+    def __init__(self, seconds=None):
+        self.expires = time.monotonic() + (REQUEST_DEADLINE if seconds is None else seconds)
+
+    def remaining(self):
+        return max(self.expires - time.monotonic(), 0.0)
+
+    @property
+    def expired(self):
+        # Menos de medio segundo no alcanza para una respuesta del modelo
+        return self.remaining() < 0.5
+
+    def timeout(self):
+        return min(ATTEMPT_TIMEOUT, self.remaining())
+
+
+def get_client():
+    """Cliente compartido del event loop actual (se recrea si cambia el loop)."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            timeout=ATTEMPT_TIMEOUT,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=10),
+            headers={"Content-Type": "application/json"},
+        )
+        _client_loop = loop
+    return _client
+
+
+async def _post(url, body, deadline, headers=None):
+    return await get_client().post(url, json=body, headers=headers, timeout=deadline.timeout())
+
+
+async def _open_stream(url, body, deadline, headers=None):
+    """Abre una respuesta en streaming; si no es 200 la lee entera y la cierra (para r.text).
+
+    Conectar respeta lo que queda del plazo; cada lectura (cabeceras y cada
+    fragmento) tiene ATTEMPT_TIMEOUT propio, para que una pausa entre
+    fragmentos no corte un stream abierto con poco plazo restante.
+    """
+    client = get_client()
+    timeout = httpx.Timeout(deadline.timeout(), read=ATTEMPT_TIMEOUT)
+    request = client.build_request("POST", url, json=body, headers=headers, timeout=timeout)
+    response = await client.send(request, stream=True)
+    if response.status_code != 200:
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+    return response
+
+
+async def _sse_events(response):
+    """JSON de cada línea `data:` de una respuesta SSE; cierra la respuesta al terminar."""
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if not data or data == "[DONE]":
+                continue
+            try:
+                yield json.loads(data)
+            except ValueError:
+                logger.warning("Evento SSE no JSON ignorado: %s", data[:200])
+    finally:
+        await response.aclose()
+
+
+# ================= Gemini =================
+def candidate_models(model_name):
+    """Modelo pedido y alternativas comunes (dependen de disponibilidad regional / versión API)."""
+    candidates = [model_name]
+    if model_name.endswith('-latest'):
+        base_name = model_name.rsplit('-latest', 1)[0]
+        candidates.append(base_name)
+        if '1.5-flash' in base_name:
+            candidates.extend(['gemini-1.5-flash', 'gemini-1.5-flash-001'])
+        candidates.extend(['gemini-pro', 'gemini-1.0-pro'])
+    else:
+        candidates.extend(['gemini-1.5-flash', 'gemini-pro'])
+    return list(dict.fromkeys(candidates))
+
+
+def _gemini_text(data):
+    # Los fragmentos del stream pueden venir sin candidatos/partes (p.ej. solo métricas)
+    candidates = data.get("candidates") or [{}]
+    parts = candidates[0].get("content", {}).get("parts") or [{}]
+    return parts[0].get("text")
+
+
+def _rejects_system_instruction(response):
+    low = (response.text or "").lower()
+    return 'unknown name' in low and 'systeminstruction' in low
+
+
+def _embed_system_instruction(payload):
+    """Copia del payload con las instrucciones como primer mensaje 'user' (endpoints sin systemInstruction)."""
+    fallback = copy.deepcopy(payload)
+    sys_part = fallback.pop('systemInstruction', None) or {}
+    sys_text = '\n'.join(p.get('text', '') for p in sys_part.get('parts', []) if isinstance(p, dict))
+    fallback.setdefault('contents', []).insert(
+        0, {"role": "user", "parts": [{"text": f"[INSTRUCCIONES DEL SISTEMA]\n{sys_text.strip()}"}]}
+    )
+    return fallback
+
+
+async def _network_failure(provider, key, model, error, deadline):
+    """Error de red o timeout. Si el timeout llegó con el plazo del chat ya agotado
+    (lo cortó el plazo, no la clave), no enfría la clave ni suma al circuito.
+    deadline None: el timeout no dependía del plazo (lecturas del stream)."""
+    if isinstance(error, httpx.TimeoutException) and deadline is not None and deadline.remaining() <= 0:
+        logger.info("Timeout por plazo del chat agotado; no se penaliza la clave %s", key_pool.key_id(key))
+        return
+    await key_pool.record_failure(provider, key, model)
+
+
+async def _gemini_failure(r, key, current_model, version, retried):
+    """Registra una respuesta no-200 de Gemini; True si fue 404 (probar el otro endpoint o modelo)."""
+    kid = key_pool.key_id(key)
+    if r.status_code == 404:
+        logger.warning("Modelo Gemini '%s' no disponible (404) en endpoint %s con clave %s.", current_model, version, kid)
+        await key_pool.record_failure('gemini', key, current_model, 404, key_fault=False)
+        return True
+    logger.warning("Status %s (modelo %s endpoint %s) con clave %s. Respuesta: %s", r.status_code, current_model, version, kid, r.text[:300])
+    await key_pool.record_failure('gemini', key, current_model, r.status_code, key_fault=not (retried and r.status_code == 400))
+    return False
+
+
+async def _usable_keys(provider, api_keys):
+    """Claves en orden de salud, o [] si el circuito del proveedor está abierto."""
+    if not await key_pool.allow(provider):
+        logger.warning("Circuito %s abierto: no se llama a la API", provider)
+        return []
+    return await key_pool.order(provider, api_keys)
+
+
+def _plan(model_name, resolution):
+    """Intentos (modelo, endpoint, systemInstruction) para una clave, empezando por su resolución."""
+    plan = [(m, version, True) for m in candidate_models(model_name) for version in ("v1beta", "v1")]
+    if resolution:
+        plan = [resolution] + [p for p in plan if p[:2] != resolution[:2]]
+    return plan
+
+
+async def _resolutions(api_keys, model_name, stored):
+    """Resolución de cada clave para model_name: la aprendida en caliente (cache) o la de ApiKey.
+
+    `stored` es {clave: (modelo pedido, modelo, endpoint, systemInstruction)}.
+    """
+    cache_keys = {key: _RESOLUTION.format(key_pool.key_id(key)) for key in api_keys}
+    learned = await cache.aget_many(list(cache_keys.values()))
+    result = {}
+    for key in api_keys:
+        entry = learned.get(cache_keys[key]) or stored.get(key)
+        if entry and entry[0] == model_name:
+            result[key] = tuple(entry[1:])
+    return result
+
+
+async def _learn(key, model_name, resolution, previous):
+    if resolution == previous:
+        return
+    logger.info("Clave %s resuelta en caliente: %s → %s (antes %s)", key_pool.key_id(key), model_name, resolution, previous)
+    await cache.aset(_RESOLUTION.format(key_pool.key_id(key)), (model_name, *resolution), RESOLUTION_TTL)
+
+
+def forget_resolutions(api_keys):
+    """Descarta lo aprendido en caliente (check_ai_keys acaba de guardar la resolución en ApiKey)."""
+    cache.delete_many([_RESOLUTION.format(key_pool.key_id(key)) for key in api_keys])
+
+
+def _gemini_body(payload, system_instruction):
+    if system_instruction or 'systemInstruction' not in payload:
+        return payload
+    return _embed_system_instruction(payload)
+
+
+async def call_gemini(api_keys, payload, model_name, deadline, resolutions=None):
+    """Una llamada por clave con su resolución; sin ella (u obsoleta) prueba modelo × endpoint."""
+    keys = await _usable_keys('gemini', api_keys)
+    known = await _resolutions(keys, model_name, resolutions or {})
+    # Modelo y endpoint que existen (respondieron algo distinto de 404) con una clave que
+    # luego falló: las siguientes claves sin resolución empiezan por ahí
+    discovered = None
+    for key in keys:
+        kid = key_pool.key_id(key)
+        for current_model, version, system_instruction in _plan(model_name, known.get(key) or discovered):
+            if deadline.expired:
+                logger.warning("Plazo del chat agotado probando Gemini (modelo %s)", current_model)
+                return None
+            url = f"{GEMINI_URL.format(version=version, model=current_model)}?key={key}"
+            started = time.monotonic()
+            try:
+                r = await _post(url, _gemini_body(payload, system_instruction), deadline)
+                retried = False
+                if r.status_code == 400 and system_instruction and 'systemInstruction' in payload and _rejects_system_instruction(r):
+                    logger.warning("Endpoint %s rechaza systemInstruction; reintento con instrucciones embebidas (modelo %s clave %s)", version, current_model, kid)
+                    system_instruction = False
+                    r = await _post(url, _embed_system_instruction(payload), deadline)
+                    retried = True
+            except httpx.HTTPError as e:
+                logger.warning("Error de red Gemini (modelo %s endpoint %s) con clave %s: %s", current_model, version, kid, e)
+                await _network_failure('gemini', key, current_model, e, deadline)
+                break
+
+            if r.status_code == 200:
+                text = _gemini_text(r.json())
+                if text:
+                    await key_pool.record_success('gemini', key, current_model, time.monotonic() - started)
+                    await _learn(key, model_name, (current_model, version, system_instruction), known.get(key))
+                    if current_model != model_name:
+                        logger.info("Se utilizó modelo alternativo Gemini '%s' (endpoint %s) para '%s'", current_model, version, model_name)
+                    return text
+                logger.warning("Respuesta OK pero sin texto (modelo %s endpoint %s) clave %s", current_model, version, kid)
+                break
+            if await _gemini_failure(r, key, current_model, version, retried):
+                # Modelo ausente en este endpoint: siguiente intento del plan
+                continue
+            discovered = (current_model, version, system_instruction)
+            break
+    return None
+
+
+async def stream_gemini(api_keys, payload, model_name, deadline, resolutions=None):
+    """Como call_gemini, pero con streamGenerateContent: produce los fragmentos de texto."""
+    keys = await _usable_keys('gemini', api_keys)
+    known = await _resolutions(keys, model_name, resolutions or {})
+    discovered = None
+    for key in keys:
+        kid = key_pool.key_id(key)
+        for current_model, version, system_instruction in _plan(model_name, known.get(key) or discovered):
+            if deadline.expired:
+                logger.warning("Plazo del chat agotado probando Gemini en streaming (modelo %s)", current_model)
+                return
+            url = f"{GEMINI_STREAM_URL.format(version=version, model=current_model)}?alt=sse&key={key}"
+            started = time.monotonic()
+            first_token = None
+            try:
+                r = await _open_stream(url, _gemini_body(payload, system_instruction), deadline)
+                retried = False
+                if r.status_code == 400 and system_instruction and 'systemInstruction' in payload and _rejects_system_instruction(r):
+                    logger.warning("Endpoint %s rechaza systemInstruction; reintento con instrucciones embebidas (modelo %s clave %s)", version, current_model, kid)
+                    system_instruction = False
+                    r = await _open_stream(url, _embed_system_instruction(payload), deadline)
+                    retried = True
+                if r.status_code == 200:
+                    async for data in _sse_events(r):
+                        text = _gemini_text(data)
+                        if text:
+                            if first_token is None:
+                                first_token = time.monotonic() - started
+                            yield text
+                    if first_token is not None:
+                        # La latencia que importa en streaming es la del primer fragmento
+                        await key_pool.record_success('gemini', key, current_model, first_token)
+                        await _learn(key, model_name, (current_model, version, system_instruction), known.get(key))
+                        return
+                    logger.warning("Stream OK pero sin texto (modelo %s endpoint %s) clave %s", current_model, version, kid)
+                    break
+            except httpx.HTTPError as e:
+                logger.warning("Error de red Gemini en streaming (modelo %s endpoint %s) con clave %s: %s", current_model, version, kid, e)
+                # Las lecturas del stream tienen ATTEMPT_TIMEOUT completo: su timeout no es del plazo
+                await _network_failure('gemini', key, current_model, e, None if isinstance(e, httpx.ReadTimeout) else deadline)
+                if first_token is not None:
+                    # Ya se enviaron fragmentos: no se puede reintentar sin duplicarlos
+                    raise StreamInterrupted(str(e)) from e
+                break
+            if await _gemini_failure(r, key, current_model, version, retried):
+                continue
+            discovered = (current_model, version, system_instruction)
+            break
+
+
+async def resolve_gemini(key, model_name, timeout=ATTEMPT_TIMEOUT):
+    """Sondea modelo × endpoint con una petición mínima para una clave (check_ai_keys).
+
+    Devuelve ((modelo, endpoint, acepta systemInstruction) | None, error | None).
+    No pasa por key_pool: es un chequeo de fondo, no tráfico del chat.
+    """
+    deadline = Deadline(timeout)
+    payload = {
+        "contents": [{"role": "user", "parts": [{"text": "ping"}]}],
+        "systemInstruction": {"parts": [{"text": "Responde breve."}]},
+        "generationConfig": {"maxOutputTokens": 5},
+    }
+    error = None
+    for current_model, version, _ in _plan(model_name, None):
+        if deadline.expired:
+            return None, error or "plazo agotado"
+        url = f"{GEMINI_URL.format(version=version, model=current_model)}?key={key}"
+        try:
+            r = await _post(url, payload, deadline)
+            system_instruction = True
+            if r.status_code == 400 and _rejects_system_instruction(r):
+                system_instruction = False
+                r = await _post(url, _embed_system_instruction(payload), deadline)
+        except httpx.HTTPError as e:
+            return None, str(e) or e.__class__.__name__
+        if r.status_code == 200:
+            return (current_model, version, system_instruction), None
+        error = f"{r.status_code} {r.text[:80]}"
+        if r.status_code != 404:
+            return None, error
+    return None, error
+
+
+# ================= OpenAI =================
+async def _openai_failure(r, key, model_name):
+    kid = key_pool.key_id(key)
+    if r.status_code == 429:
+        logger.warning("Cuota excedida (429) con clave %s.", kid)
+    else:
+        logger.warning("Status OpenAI %s con clave %s. Respuesta: %s", r.status_code, kid, r.text[:300])
+    await key_pool.record_failure('chatgpt', key, model_name, r.status_code)
+
+
+async def call_openai(api_keys, messages, model_name, temperature, deadline):
+    """Chat Completions con rotación de claves; 429 enfría la clave más tiempo (key_pool)."""
+    body = {
+        "model": model_name,
+        "messages": messages,
+        "temperature": max(0.0, min(1.0, temperature)),
+        "max_tokens": 800,
+    }
+    for key in await _usable_keys('chatgpt', api_keys):
+        if deadline.expired:
+            logger.warning("Plazo del chat agotado probando OpenAI")
+            return None
+        kid = key_pool.key_id(key)
+        started = time.monotonic()
+        try:
+            r = await _post(OPENAI_URL, body, deadline, headers={"Authorization": f"Bearer {key}"})
+        except httpx.HTTPError as e:
+            logger.warning("Error de red OpenAI con clave %s: %s", kid, e)
+            await _network_failure('chatgpt', key, model_name, e, deadline)
+            continue
+        if r.status_code == 200:
+            choices = r.json().get("choices", [])
+            content = choices[0].get("message", {}).get("content") if choices else None
+            if content:
+                await key_pool.record_success('chatgpt', key, model_name, time.monotonic() - started)
+                return content
+            logger.warning("Respuesta OpenAI OK sin contenido con clave %s", kid)
+        else:
+            await _openai_failure(r, key, model_name)
+    return None
+
+
+async def stream_openai(api_keys, messages, model_name, temperature, deadline):
+    """Como call_openai, pero con `stream: true`: produce los fragmentos (delta.content)."""
+    body = {
+        "model": model_name,
+        "messages": messages,
+        "temperature": max(0.0, min(1.0, temperature)),
+        "max_tokens": 800,
+        "stream": True,
+    }
+    for key in await _usable_keys('chatgpt', api_keys):
+        if deadline.expired:
+            logger.warning("Plazo del chat agotado probando OpenAI en streaming")
+            return
+        kid = key_pool.key_id(key)
+        started = time.monotonic()
+        first_token = None
+        try:
+            r = await _open_stream(OPENAI_URL, body, deadline, headers={"Authorization": f"Bearer {key}"})
+            if r.status_code == 200:
+                async for data in _sse_events(r):
+                    choices = data.get("choices") or [{}]
+                    text = (choices[0].get("delta") or {}).get("content")
+                    if text:
+                        if first_token is None:
+                            first_token = time.monotonic() - started
+                        yield text
+                if first_token is not None:
+                    await key_pool.record_success('chatgpt', key, model_name, first_token)
+                    return
+                logger.warning("Stream OpenAI OK sin contenido con clave %s", kid)
+                continue
+        except httpx.HTTPError as e:
+            logger.warning("Error de red OpenAI en streaming con clave %s: %s", kid, e)
+            await _network_failure('chatgpt', key, model_name, e, None if isinstance(e, httpx.ReadTimeout) else deadline)
+            if first_token is not None:
+                raise StreamInterrupted(str(e)) from e
+            continue
+        await _openai_failure(r, key, model_name)
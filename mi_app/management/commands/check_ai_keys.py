@@ -1,19 +1,29 @@
+import asyncio
 import json
 import time
+from collections import Counter
 import requests
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
+from django.utils import timezone
+from mi_app import llm_gateway
 from mi_app.models import ApiKey, ConfiguracionChatbot
+from mi_app.views.ai_views import _gemini_model
 
-GEMINI_TEST_MODELS = ["gemini-1.5-flash", "gemini-pro", "gemini-1.0-pro"]
 OPENAI_TEST_MODEL = "gpt-4o-mini"
 
 class Command(BaseCommand):
-    help = "Verifica el estado de las claves de IA (Gemini y ChatGPT) intentando una petición mínima."
+    help = (
+        "Verifica el estado de las claves de IA (Gemini y ChatGPT) intentando una petición mínima. "
+        "Para Gemini guarda en cada clave el modelo/endpoint que responde (resolución que usa el chat); "
+        "se ejecuta en cada deploy (build.sh) y conviene programarlo cada hora como cron job "
+        "(python manage.py check_ai_keys --provider gemini)."
+    )
 
     def add_arguments(self, parser):
         parser.add_argument('--provider', choices=['gemini','chatgpt','all'], default='all', help='Filtrar proveedor a validar.')
         parser.add_argument('--timeout', type=int, default=12, help='Timeout por clave (segundos).')
-        parser.add_argument('--model', type=str, default=None, help='Forzar un modelo Gemini específico (omite lista).')
+        parser.add_argument('--model', type=str, default=None, help='Resolver para este modelo Gemini en lugar del configurado.')
 
     def handle(self, *args, **options):
         provider = options['provider']
@@ -26,31 +36,47 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS(json.dumps(summary, ensure_ascii=False, indent=2)))
 
     def _check_gemini(self, timeout, model=None):
-        results = []
-        keys = list(ApiKey.objects.filter(provider='gemini', activa=True).values_list('key', flat=True))
-        if not keys:
+        claves = list(ApiKey.objects.filter(provider='gemini', activa=True))
+        if not claves:
             return {"status": "sin_claves"}
-        payload = {"contents": [{"role":"user","parts":[{"text":"ping"}]}]}
-        models_to_try = [model] if model else GEMINI_TEST_MODELS
-        for key in keys:
-            ok = False
-            err = None
-            for m in models_to_try:
-                url = f"https://generativelanguage.googleapis.com/v1beta/models/{m}:generateContent?key={key}"
-                try:
-                    r = requests.post(url, json=payload, timeout=timeout)
-                    if r.status_code == 200:
-                        ok = True
-                        break
-                    elif r.status_code == 404:
-                        err = f"404 modelo {m}"; continue
-                    else:
-                        err = f"{r.status_code} {r.text[:80]}"; break
-                except requests.exceptions.RequestException as e:
-                    err = str(e); break
-                time.sleep(0.5)
-            results.append({"key_tail": key[-6:], "ok": ok, "error": err, "model_forzado": model})
-        return {"total": len(results), "validas": sum(1 for r in results if r['ok']), "detalle": results}
+        model_name = model or _gemini_model(ConfiguracionChatbot.get_solo())
+
+        async def resolve_all():
+            return [await llm_gateway.resolve_gemini(c.key, model_name, timeout) for c in claves]
+
+        results = []
+        resueltos = Counter()
+        now = timezone.now()
+        for clave, (resolution, err) in zip(claves, asyncio.run(resolve_all())):
+            if resolution:
+                modelo, endpoint, system_instruction = resolution
+                ApiKey.objects.filter(pk=clave.pk).update(
+                    gemini_modelo_pedido=model_name, gemini_modelo=modelo, gemini_endpoint=endpoint,
+                    gemini_system_instruction=system_instruction, gemini_resuelto_en=now,
+                )
+                resueltos[modelo] += 1
+            results.append({
+                "key_tail": clave.key[-6:],
+                "ok": resolution is not None,
+                "error": err,
+                "modelo": resolution[0] if resolution else None,
+                "endpoint": resolution[1] if resolution else None,
+                "system_instruction": resolution[2] if resolution else None,
+            })
+        # Las peticiones ya no necesitan lo aprendido en caliente: leen la resolución recién guardada
+        llm_gateway.forget_resolutions([c.key for c in claves])
+        cache.delete('api_keys_gemini_resolucion')
+        cfg = ConfiguracionChatbot.get_solo()
+        if resueltos and cfg.last_valid_gemini_model != resueltos.most_common(1)[0][0]:
+            # Solo si cambió: guardar la configuración invalida el snapshot del sitio
+            cfg.last_valid_gemini_model = resueltos.most_common(1)[0][0]
+            cfg.save(update_fields=["last_valid_gemini_model"])
+        return {
+            "modelo_pedido": model_name,
+            "total": len(results),
+            "validas": sum(1 for r in results if r['ok']),
+            "detalle": results,
+        }
 
     def _check_openai(self, timeout):
         results = []
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from mi_app.reservations import SWEEP_BATCH_SIZE, resync_counters, sweep_expired
+
+
+class Command(BaseCommand):
+    help = (
+        "Libera por lotes las reservas de stock vencidas (y los ítems de carrito asociados). "
+        "Con --loop queda corriendo como worker; --resync / --resync-every recalculan "
+        "los contadores de reservas a pedido. En Render se despliega como cron job "
+        "(cada 5 minutos, sin --loop): las líneas worker: del Procfile no se arrancan."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=SWEEP_BATCH_SIZE, help='Reservas por lote/transacción.')
+        parser.add_argument('--loop', action='store_true', help='Repetir indefinidamente cada --interval segundos.')
+        parser.add_argument('--interval', type=int, default=300, help='Segundos entre barridos en modo --loop.')
+        parser.add_argument('--resync', action='store_true', help='Recalcular además ColorVariante.stock_reservado desde las reservas en cada barrido.')
+        parser.add_argument('--resync-every', type=int, default=0, help='En modo --loop, recalcular los contadores cada N barridos (0 = nunca; mantenimiento a pedido).')
+
+    def handle(self, *args, **options):
+        barridos = 0
+        while True:
+            barridos += 1
+            stats = sweep_expired(batch_size=options['batch_size'])
+            self.stdout.write(
+                f"{stats['reservas']} reservas liberadas ({stats['unidades']} unidades, "
+                f"{stats['variantes']} variantes, {stats['items_carrito']} ítems de carrito)."
+            )
+            periodico = options['loop'] and options['resync_every'] and barridos % options['resync_every'] == 0
+            if options['resync'] or periodico:
+                fixed = resync_counters()
+                self.stdout.write(f"Contadores de reservas corregidos: {fixed}.")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from mi_app.models import PedidoWhatsApp
+from mi_app.orders import recalculate_totals
+
+
+class Command(BaseCommand):
+    help = (
+        "Completa subtotal, costo_envio e item_count de PedidoWhatsApp desde sus líneas. "
+        "Por defecto solo los pedidos sin totales (item_count = 0)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--todos', action='store_true', help='Recalcular todos los pedidos.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Pedidos por lote.')
+
+    def handle(self, *args, **options):
+        pedidos = PedidoWhatsApp.objects.all()
+        if not options['todos']:
+            pedidos = pedidos.filter(item_count=0)
+        total = recalculate_totals(pedidos, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Totales recalculados en {total} pedidos."))
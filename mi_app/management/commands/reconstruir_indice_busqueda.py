@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from mi_app.search import backend, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Renormaliza nombre/descripción de los productos y reconstruye el índice de búsqueda de texto completo."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Productos por lote.')
+
+    def handle(self, *args, **options):
+        total = rebuild_search_index(batch_size=options['batch_size'])
+        motor = backend() or 'contains (sin índice)'
+        self.stdout.write(self.style.SUCCESS(
+            f"Índice de búsqueda reconstruido ({motor}): {total} productos renormalizados."
+        ))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from mi_app.catalog_index import rebuild_catalog_index
+
+
+class Command(BaseCommand):
+    help = "Reconstruye el índice desnormalizado del catálogo (ProductoIndice) a partir de productos y variantes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Productos por lote.')
+
+    def handle(self, *args, **options):
+        total = rebuild_catalog_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Índice de catálogo reconstruido: {total} productos."))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from mi_app.related_products import rebuild_all
+
+
+class Command(BaseCommand):
+    help = "Reconstruye el grafo de productos relacionados (ProductoRelacionado) con las reglas de prioridad del detalle."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Productos por lote.')
+
+    def handle(self, *args, **options):
+        total = rebuild_all(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Grafo de relacionados reconstruido: {total} aristas."))
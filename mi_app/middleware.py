@@ -0,0 +1,39 @@
+# mi_app/middleware.py
+"""Middleware propio del sitio.
+
+AsyncWhiteNoiseMiddleware: WhiteNoiseMiddleware solo es síncrono y, bajo
+ASGI, Django tendría que envolver todo lo que viene detrás en async_to_sync
+dentro del hilo único de sync_to_async: la vista asíncrona del chat ocuparía
+ese hilo mientras espera a la API y el resto de peticiones del worker
+quedaría en cola. Esta versión admite ambos modos; la búsqueda del archivo
+es en memoria y solo la apertura pasa a un hilo del pool.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            # Solo en DEBUG: recorre el disco en cada petición
+            static_file = await sync_to_async(self.find_file, thread_sensitive=False)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve, thread_sensitive=False)(static_file, request)
+        return await self.get_response(request)
@@ -0,0 +1,65 @@
+# Generated by Django 5.2.5 on 2026-10-17 19:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_index(apps, schema_editor):
+    Categoria = apps.get_model('mi_app', 'Categoria')
+    Producto = apps.get_model('mi_app', 'Producto')
+    ColorVariante = apps.get_model('mi_app', 'ColorVariante')
+    ProductoIndice = apps.get_model('mi_app', 'ProductoIndice')
+    parents = dict(Categoria.objects.values_list('pk', 'parent_id'))
+
+    def root_of(pk):
+        seen = set()
+        while parents.get(pk) is not None and pk not in seen:
+            seen.add(pk)
+            pk = parents[pk]
+        return pk
+
+    stock = dict(
+        ColorVariante.objects.values('producto_id').annotate(total=Sum('stock')).values_list('producto_id', 'total')
+    )
+    rows = []
+    for p in Producto.objects.all().iterator():
+        rows.append(ProductoIndice(
+            producto_id=p.pk,
+            precio_efectivo=p.precio_oferta if p.precio_oferta is not None else p.precio,
+            categoria_id=p.categoria_id,
+            categoria_raiz_id=root_of(p.categoria_id) if p.categoria_id else None,
+            es_oferta=p.es_oferta,
+            es_nueva_coleccion=p.es_nueva_coleccion,
+            stock_total=stock.get(p.pk) or 0,
+        ))
+    ProductoIndice.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mi_app', '0037_configuracionsitio_numero_plin_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductoIndice',
+            fields=[
+                ('producto', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='indice', serialize=False, to='mi_app.producto')),
+                ('precio_efectivo', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('es_oferta', models.BooleanField(default=False)),
+                ('es_nueva_coleccion', models.BooleanField(default=False)),
+                ('stock_total', models.IntegerField(default=0)),
+                ('actualizado', models.DateTimeField(auto_now=True)),
+                ('categoria', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='mi_app.categoria')),
+                ('categoria_raiz', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='mi_app.categoria')),
+            ],
+            options={
+                'verbose_name': 'Índice de Catálogo',
+                'verbose_name_plural': 'Índice de Catálogo',
+                'indexes': [models.Index(fields=['categoria_raiz', 'precio_efectivo'], name='mi_app_idx_raiz_precio'), models.Index(fields=['categoria', 'precio_efectivo'], name='mi_app_idx_cat_precio'), models.Index(fields=['es_oferta', 'precio_efectivo'], name='mi_app_idx_oferta_precio'), models.Index(fields=['es_nueva_coleccion', 'precio_efectivo'], name='mi_app_idx_nueva_precio')],
+            },
+        ),
+        migrations.RunPython(populate_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,92 @@
+from django.db import migrations
+
+# Postgres: columna tsvector generada (se recalcula sola al cambiar los campos
+# normalizados) + índice GIN. SQLite: tabla FTS5 de contenido externo
+# sincronizada por triggers. Otros motores usan el filtro por contains.
+PG_FORWARD = [
+    """
+    ALTER TABLE mi_app_producto ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple'::regconfig, coalesce(nombre_norm, '')), 'A') ||
+        setweight(to_tsvector('simple'::regconfig, coalesce(descripcion_norm, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX mi_app_producto_search_gin ON mi_app_producto USING gin (search_vector)",
+]
+PG_REVERSE = [
+    "DROP INDEX IF EXISTS mi_app_producto_search_gin",
+    "ALTER TABLE mi_app_producto DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE mi_app_producto_fts USING fts5(
+        nombre_norm, descripcion_norm,
+        content='mi_app_producto', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER mi_app_producto_fts_ai AFTER INSERT ON mi_app_producto BEGIN
+        INSERT INTO mi_app_producto_fts(rowid, nombre_norm, descripcion_norm)
+        VALUES (new.id, new.nombre_norm, new.descripcion_norm);
+    END
+    """,
+    """
+    CREATE TRIGGER mi_app_producto_fts_ad AFTER DELETE ON mi_app_producto BEGIN
+        INSERT INTO mi_app_producto_fts(mi_app_producto_fts, rowid, nombre_norm, descripcion_norm)
+        VALUES ('delete', old.id, old.nombre_norm, old.descripcion_norm);
+    END
+    """,
+    """
+    CREATE TRIGGER mi_app_producto_fts_au AFTER UPDATE OF nombre_norm, descripcion_norm ON mi_app_producto BEGIN
+        INSERT INTO mi_app_producto_fts(mi_app_producto_fts, rowid, nombre_norm, descripcion_norm)
+        VALUES ('delete', old.id, old.nombre_norm, old.descripcion_norm);
+        INSERT INTO mi_app_producto_fts(rowid, nombre_norm, descripcion_norm)
+        VALUES (new.id, new.nombre_norm, new.descripcion_norm);
+    END
+    """,
+    "INSERT INTO mi_app_producto_fts(mi_app_producto_fts) VALUES ('rebuild')",
+]
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS mi_app_producto_fts_ai",
+    "DROP TRIGGER IF EXISTS mi_app_producto_fts_ad",
+    "DROP TRIGGER IF EXISTS mi_app_producto_fts_au",
+    "DROP TABLE IF EXISTS mi_app_producto_fts",
+]
+
+
+def _sqlite_has_fts5(cursor):
+    try:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+    except Exception:
+        return False
+
+
+def _run(schema_editor, statements_by_vendor):
+    vendor = schema_editor.connection.vendor
+    statements = statements_by_vendor.get(vendor) or []
+    with schema_editor.connection.cursor() as cursor:
+        if vendor == 'sqlite' and not _sqlite_has_fts5(cursor):
+            return
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def create_search_index(apps, schema_editor):
+    _run(schema_editor, {'postgresql': PG_FORWARD, 'sqlite': SQLITE_FORWARD})
+
+
+def drop_search_index(apps, schema_editor):
+    _run(schema_editor, {'postgresql': PG_REVERSE, 'sqlite': SQLITE_REVERSE})
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('mi_app', '0038_productoindice'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
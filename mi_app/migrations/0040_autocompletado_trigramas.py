@@ -0,0 +1,30 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+# Índice GIN de trigramas sobre nombre_norm (solo Postgres; en otros motores
+# el autocompletado usa el índice en memoria de mi_app.autocomplete).
+def create_trgm_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "CREATE INDEX IF NOT EXISTS mi_app_producto_nombre_trgm "
+        "ON mi_app_producto USING gin (nombre_norm gin_trgm_ops)"
+    )
+
+
+def drop_trgm_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS mi_app_producto_nombre_trgm")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('mi_app', '0039_busqueda_texto_completo'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunPython(create_trgm_index, drop_trgm_index),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-17 19:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mi_app', '0040_autocompletado_trigramas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductoRelacionado',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prioridad', models.PositiveSmallIntegerField(choices=[(0, 'Categorías relacionadas'), (1, 'Misma subcategoría'), (2, 'Categoría padre'), (3, 'Misma categoría raíz'), (4, 'Global')])),
+                ('producto', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='relaciones', to='mi_app.producto')),
+                ('relacionado', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='relacionado_en', to='mi_app.producto')),
+            ],
+            options={
+                'verbose_name': 'Producto Relacionado',
+                'verbose_name_plural': 'Productos Relacionados',
+                'constraints': [models.UniqueConstraint(fields=('producto', 'relacionado'), name='mi_app_relacionado_unico')],
+            },
+        ),
+    ]
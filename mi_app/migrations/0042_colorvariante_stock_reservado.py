@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-17 21:10
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def backfill_stock_reservado(apps, schema_editor):
+    ColorVariante = apps.get_model('mi_app', 'ColorVariante')
+    ReservaStock = apps.get_model('mi_app', 'ReservaStock')
+    totals = ReservaStock.objects.values('variante_id').annotate(total=Sum('quantity'))
+    for row in totals:
+        ColorVariante.objects.filter(pk=row['variante_id']).update(stock_reservado=row['total'] or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mi_app', '0041_productorelacionado'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='colorvariante',
+            name='stock_reservado',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_stock_reservado, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-17 19:56
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mi_app', '0042_colorvariante_stock_reservado'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reservastock',
+            index=models.Index(fields=['variante', 'expires_at'], name='mi_app_idx_reserva_var_exp'),
+        ),
+        migrations.AddIndex(
+            model_name='reservastock',
+            index=models.Index(fields=['expires_at'], name='mi_app_idx_reserva_expira'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-17 19:58
+
+from django.db import migrations, models
+
+
+def crear_contador(apps, schema_editor):
+    ContadorPedido = apps.get_model('mi_app', 'ContadorPedido')
+    ContadorPedido.objects.get_or_create(nombre='pedido')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mi_app', '0043_reservastock_indices_vencimiento'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContadorPedido',
+            fields=[
+                ('nombre', models.CharField(max_length=30, primary_key=True, serialize=False)),
+                ('valor', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(crear_contador, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-17 19:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mi_app', '0044_contador_pedido'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pedidowhatsapp',
+            name='costo_envio',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='pedidowhatsapp',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pedidowhatsapp',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+    ]
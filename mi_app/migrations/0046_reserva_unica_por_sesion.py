@@ -0,0 +1,44 @@
+# Generated by Django 5.2.5 on 2026-10-17 20:05
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fusionar_duplicadas(apps, schema_editor):
+    """Una fila por (variante, session_key): suma cantidades y conserva el vencimiento mayor.
+
+    La suma total por variante no cambia, así que stock_reservado sigue cuadrando.
+    """
+    ReservaStock = apps.get_model('mi_app', 'ReservaStock')
+    duplicadas = (
+        ReservaStock.objects.values('variante_id', 'session_key')
+        .annotate(n=Count('id')).filter(n__gt=1)
+    )
+    for grupo in duplicadas:
+        filas = list(
+            ReservaStock.objects.filter(variante_id=grupo['variante_id'], session_key=grupo['session_key'])
+            .order_by('-expires_at', '-id')
+        )
+        principal = filas[0]
+        principal.quantity = sum(f.quantity for f in filas)
+        if principal.user_id is None:
+            principal.user_id = next((f.user_id for f in filas if f.user_id), None)
+        principal.save(update_fields=['quantity', 'user'])
+        ReservaStock.objects.filter(pk__in=[f.pk for f in filas[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mi_app', '0045_pedido_totales'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(fusionar_duplicadas, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='reservastock',
+            constraint=models.UniqueConstraint(fields=('variante', 'session_key'), name='mi_app_reserva_unica_sesion'),
+        ),
+    ]
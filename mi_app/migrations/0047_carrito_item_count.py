@@ -0,0 +1,31 @@
+# Generated by Django 5.2.5 on 2026-10-17 22:40
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_item_count(apps, schema_editor):
+    Carrito = apps.get_model('mi_app', 'Carrito')
+    CarritoItem = apps.get_model('mi_app', 'CarritoItem')
+    suma = (
+        CarritoItem.objects.filter(carrito=OuterRef('pk'))
+        .values('carrito').annotate(total=Sum('quantity')).values('total')
+    )
+    Carrito.objects.update(item_count=Coalesce(Subquery(suma), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mi_app', '0046_reserva_unica_por_sesion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='carrito',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_item_count, migrations.RunPython.noop),
+    ]
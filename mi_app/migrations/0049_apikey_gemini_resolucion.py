@@ -0,0 +1,43 @@
+# Generated by Django 5.2.5 on 2026-10-17 20:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mi_app', '0048_producto_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apikey',
+            name='gemini_endpoint',
+            field=models.CharField(blank=True, default='', editable=False, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='apikey',
+            name='gemini_modelo',
+            field=models.CharField(blank=True, default='', editable=False, max_length=120),
+        ),
+        migrations.AddField(
+            model_name='apikey',
+            name='gemini_modelo_pedido',
+            field=models.CharField(blank=True, default='', editable=False, max_length=120),
+        ),
+        migrations.AddField(
+            model_name='apikey',
+            name='gemini_resuelto_en',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='apikey',
+            name='gemini_system_instruction',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='configuracionchatbot',
+            name='last_valid_gemini_model',
+            field=models.CharField(blank=True, default='', help_text='(Auto) Modelo Gemini resuelto por check_ai_keys para las claves activas (informativo).', max_length=120),
+        ),
+    ]
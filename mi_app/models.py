@@ -1,5 +1,6 @@
 from django.db import models
-from django.db.models import Sum
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 import os
 from django.conf import settings
 import uuid
@@ -86,6 +87,8 @@ class Producto(models.Model):
     nombre_norm = models.CharField(max_length=255, default='', db_index=True)
     descripcion_norm = models.TextField(blank=True, default='')
     # Campo eliminado: en_grupo_banner (ya no se usa grupo de productos del banner)
+    # Versión de la tarjeta cacheada ({% cache %} en los listados); también avanza al guardar una variante
+    updated_at = models.DateTimeField(auto_now=True)
     
     @property
     def categoria_padre(self):
@@ -97,6 +100,11 @@ class Producto(models.Model):
     def total_stock(self):
         return sum(variant.stock for variant in self.variantes.all())
 
+    @property
+    def primera_variante(self):
+        """Como variantes.first(), pero usando prefetch_related('variantes') si está cargado."""
+        return min(self.variantes.all(), key=lambda v: v.pk, default=None)
+
     @property
     def descuento_porcentaje(self):
         if self.precio_oferta and self.precio and self.precio > 0 and self.precio > self.precio_oferta:
@@ -149,15 +157,92 @@ class ColorVariante(models.Model):
     
     imagen = models.ImageField(upload_to='productos/variantes/')
     stock = models.IntegerField(default=0)
+    # Suma de las reservas (ReservaStock) aún no liberadas; lo mantiene mi_app/reservations.py
+    stock_reservado = models.IntegerField(default=0, editable=False)
 
     def __str__(self):
         return f"{self.producto.nombre} - {self.codigo or self.color}"
 
+    def save(self, *args, **kwargs):
+        # stock_reservado solo se ajusta con F() desde reservations.py: un save() normal
+        # (admin, vistas) no debe pisarlo con el valor leído al cargar la instancia.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != 'stock_reservado'
+            ]
+        super().save(*args, **kwargs)
+
     @property
     def stock_disponible(self):
-        """Stock disponible efectivo (stock físico menos reservas activas)."""
-        reserved = self.reservas.filter(expires_at__gt=timezone.now()).aggregate(total=Sum('quantity'))['total'] or 0
-        return max(self.stock - reserved, 0)
+        """Stock disponible efectivo (stock físico menos reservas), sin consultas extra.
+
+        Incluye reservas vencidas aún no liberadas: quien lo muestre debe llamar
+        antes a reservations.sweep_product (ver producto_detalle).
+        """
+        return max(self.stock - self.stock_reservado, 0)
+
+
+class ProductoIndice(models.Model):
+    """Fila desnormalizada del catálogo público (una por producto).
+
+    Guarda lo que el catálogo necesita para filtrar y ordenar (precio efectivo,
+    categoría hoja y raíz, flags y stock total) para resolver los filtros con un
+    único join por PK en lugar de descendientes + Coalesce + DISTINCT.
+    Se mantiene con señales (mi_app/signals.py) y se reconstruye con
+    `python manage.py reconstruir_indice_catalogo`.
+    """
+    producto = models.OneToOneField(Producto, on_delete=models.CASCADE, primary_key=True, related_name='indice')
+    precio_efectivo = models.DecimalField(max_digits=10, decimal_places=2)
+    categoria = models.ForeignKey(Categoria, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    categoria_raiz = models.ForeignKey(Categoria, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    es_oferta = models.BooleanField(default=False)
+    es_nueva_coleccion = models.BooleanField(default=False)
+    stock_total = models.IntegerField(default=0)
+    actualizado = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Índice de Catálogo"
+        verbose_name_plural = "Índice de Catálogo"
+        indexes = [
+            models.Index(fields=['categoria_raiz', 'precio_efectivo'], name='mi_app_idx_raiz_precio'),
+            models.Index(fields=['categoria', 'precio_efectivo'], name='mi_app_idx_cat_precio'),
+            models.Index(fields=['es_oferta', 'precio_efectivo'], name='mi_app_idx_oferta_precio'),
+            models.Index(fields=['es_nueva_coleccion', 'precio_efectivo'], name='mi_app_idx_nueva_precio'),
+        ]
+
+    def __str__(self):
+        return f"Índice {self.producto_id}"
+
+
+class ProductoRelacionado(models.Model):
+    """Arista precalculada del grafo de productos relacionados.
+
+    Cada producto guarda un número acotado de candidatos elegidos con las mismas
+    prioridades que usaba producto_detalle (categorías relacionadas, hermanos,
+    padre, raíz, global). Se mantiene con señales y se reconstruye con
+    `python manage.py reconstruir_relacionados`.
+    """
+    PRIORIDADES = [
+        (0, 'Categorías relacionadas'),
+        (1, 'Misma subcategoría'),
+        (2, 'Categoría padre'),
+        (3, 'Misma categoría raíz'),
+        (4, 'Global'),
+    ]
+    producto = models.ForeignKey(Producto, on_delete=models.CASCADE, related_name='relaciones')
+    relacionado = models.ForeignKey(Producto, on_delete=models.CASCADE, related_name='relacionado_en')
+    prioridad = models.PositiveSmallIntegerField(choices=PRIORIDADES)
+
+    class Meta:
+        verbose_name = "Producto Relacionado"
+        verbose_name_plural = "Productos Relacionados"
+        constraints = [
+            models.UniqueConstraint(fields=['producto', 'relacionado'], name='mi_app_relacionado_unico'),
+        ]
+
+    def __str__(self):
+        return f"{self.producto_id} -> {self.relacionado_id}"
 
 
 class PedidoWhatsApp(models.Model):
@@ -174,20 +259,25 @@ class PedidoWhatsApp(models.Model):
     ciudad_envio = models.CharField(max_length=100, blank=True, null=True)
     direccion_envio = models.CharField(max_length=255, blank=True, null=True)
 
-    @property
-    def subtotal(self):
-        return sum(detalle.subtotal for detalle in self.detalles.all())
-
-    @property
-    def costo_envio(self):
-        if self.total >= self.subtotal:
-            return self.total - self.subtotal
-        return 0
+    # Totales desnormalizados: se escriben al crear el pedido (orders.build_order);
+    # los pedidos antiguos se completan con `python manage.py recalcular_totales_pedidos`.
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    costo_envio = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    item_count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.codigo_pedido
 
 
+class ContadorPedido(models.Model):
+    """Contador de códigos de pedido; se reparte por bloques a cada proceso (mi_app/order_codes.py)."""
+    nombre = models.CharField(max_length=30, primary_key=True)
+    valor = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.nombre}: {self.valor}"
+
+
 class DetallePedidoWhatsApp(models.Model):
     pedido = models.ForeignKey(PedidoWhatsApp, related_name='detalles', on_delete=models.CASCADE)
     producto_nombre = models.CharField(max_length=200)
@@ -213,6 +303,17 @@ class ReservaStock(models.Model):
     reserved_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            # disponibilidad/liberación por variante y barrido global de vencidas (liberar_reservas)
+            models.Index(fields=['variante', 'expires_at'], name='mi_app_idx_reserva_var_exp'),
+            models.Index(fields=['expires_at'], name='mi_app_idx_reserva_expira'),
+        ]
+        constraints = [
+            # una reserva por variante y sesión (permite upserts en bloque)
+            models.UniqueConstraint(fields=['variante', 'session_key'], name='mi_app_reserva_unica_sesion'),
+        ]
+
     def is_expired(self):
         return timezone.now() >= self.expires_at
 
@@ -224,13 +325,24 @@ class Carrito(models.Model):
     """Carrito persistente por usuario (sincroniza dispositivos)."""
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='carrito')
     updated_at = models.DateTimeField(auto_now=True)
+    # Suma de quantity de los ítems; la mantienen cart.Cart.save(), el checkout y el barrido de reservas
+    item_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return f"Carrito de {self.user}"
 
     @property
     def total_items(self):
-        return sum(i.quantity for i in self.items.all())
+        return self.item_count
+
+    @staticmethod
+    def recount(carritos, **campos):
+        """Recalcula item_count de los carritos del queryset (y `campos` extra) con un solo UPDATE."""
+        suma = (
+            CarritoItem.objects.filter(carrito=OuterRef('pk'))
+            .values('carrito').annotate(total=Sum('quantity')).values('total')
+        )
+        return carritos.update(item_count=Coalesce(Subquery(suma), 0), **campos)
 
 
 class CarritoItem(models.Model):
@@ -502,6 +614,13 @@ class ApiKey(models.Model):
     activa = models.BooleanField(default=True, help_text="Desmarca esta casilla para desactivar la clave temporalmente.")
     notas = models.TextField(blank=True, help_text="Notas internas (ej: 'Clave de cuenta personal', 'Clave de prueba').")
     fecha_creacion = models.DateTimeField(auto_now_add=True)
+    # Resolución de Gemini (la refresca `manage.py check_ai_keys`): modelo y endpoint que
+    # responden con esta clave al modelo pedido, y si aceptan systemInstruction
+    gemini_modelo_pedido = models.CharField(max_length=120, blank=True, default="", editable=False)
+    gemini_modelo = models.CharField(max_length=120, blank=True, default="", editable=False)
+    gemini_endpoint = models.CharField(max_length=10, blank=True, default="", editable=False)
+    gemini_system_instruction = models.BooleanField(default=True, editable=False)
+    gemini_resuelto_en = models.DateTimeField(null=True, blank=True, editable=False)
 
     class Meta:
         verbose_name = "Clave de API de IA"
@@ -651,7 +770,7 @@ class ConfiguracionChatbot(SingletonModel):
         max_length=120,
         blank=True,
         default="",
-        help_text="(Auto) Último modelo Gemini que respondió correctamente. Tiene prioridad mientras exista."
+        help_text="(Auto) Modelo Gemini resuelto por check_ai_keys para las claves activas (informativo)."
     )
     openai_model_name = models.CharField(
         max_length=100,
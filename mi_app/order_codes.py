@@ -0,0 +1,56 @@
+# mi_app/order_codes.py
+"""Códigos de pedido únicos y cortos: FI-ddmmyy-NNNNN.
+
+El número sale de un contador global (ContadorPedido) que cada proceso
+reserva por bloques de BLOCK_SIZE con un único UPDATE bloqueante; dentro del
+bloque los códigos se reparten en memoria sin tocar la base. Así no hay
+colisiones entre workers ni reintentos, y solo 1 de cada BLOCK_SIZE pedidos
+paga un viaje a la base. Los números de un bloque no usado (reinicio del
+proceso) se pierden: puede haber huecos, nunca repetidos.
+"""
+import os
+import threading
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ContadorPedido
+
+CONTADOR = 'pedido'
+BLOCK_SIZE = 20
+PREFIX = 'FI'
+
+_lock = threading.Lock()
+_bloque = {'pid': None, 'next': 0, 'end': 0}
+
+
+def _reserve_block(size):
+    """Reserva [inicio, fin) en el contador global.
+
+    Debe confirmarse por separado (durable): si la reserva se revirtiera con
+    la transacción del pedido, otro proceso podría recibir el mismo bloque.
+    """
+    with transaction.atomic(durable=True):
+        ContadorPedido.objects.get_or_create(nombre=CONTADOR)
+        ContadorPedido.objects.filter(nombre=CONTADOR).update(valor=F('valor') + size)
+        end = ContadorPedido.objects.filter(nombre=CONTADOR).values_list('valor', flat=True).get() + 1
+    return end - size, end
+
+
+def next_number():
+    with _lock:
+        pid = os.getpid()
+        # Tras un fork (gunicorn --preload) el bloque heredado es del padre
+        if _bloque['pid'] != pid or _bloque['next'] >= _bloque['end']:
+            _bloque['next'], _bloque['end'] = _reserve_block(BLOCK_SIZE)
+            _bloque['pid'] = pid
+        number = _bloque['next']
+        _bloque['next'] += 1
+    return number
+
+
+def next_code(now=None):
+    """Nuevo codigo_pedido. Llamar fuera de transaction.atomic (ver _reserve_block)."""
+    fecha = timezone.localtime(now or timezone.now())
+    return f"{PREFIX}-{fecha.strftime('%d%m%y')}-{next_number():05d}"
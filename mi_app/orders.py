@@ -0,0 +1,198 @@
+# mi_app/orders.py
+"""Checkout del carrito con bloqueo de filas y operaciones por conjunto.
+
+Todas las variantes del carrito se bloquean con un único SELECT ... FOR UPDATE
+(ordenado por pk para que dos compras concurrentes no se bloqueen en cruz);
+el stock se descuenta con un solo UPDATE condicional (stock >= cantidad), las
+líneas del pedido se insertan con bulk_create y las reservas propias se borran
+en una sentencia. El número de consultas no depende del tamaño del carrito.
+Si algo no cuadra se lanza StockInsuficiente y la transacción se revierte.
+
+build_order (cabecera con el total ya calculado + bulk_create de líneas) es
+común a procesar_pago y crear_pedido_whatsapp; también escribe los totales
+desnormalizados del pedido (subtotal, costo_envio, item_count).
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, IntegerField, Q, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import catalog_index, reservations
+from .models import Carrito, CarritoItem, ColorVariante, DetallePedidoWhatsApp, PedidoWhatsApp, ReservaStock
+
+
+class StockInsuficiente(Exception):
+    """Una línea del carrito supera el stock disponible."""
+
+    def __init__(self, nombre, disponible):
+        self.nombre = nombre
+        self.disponible = disponible
+        super().__init__(f"Stock insuficiente para '{nombre}' (quedan {disponible}).")
+
+
+def _lock_variantes(ids):
+    return list(
+        ColorVariante.objects.select_for_update(of=('self',))
+        .select_related('producto')
+        .filter(pk__in=ids)
+        .order_by('pk')
+    )
+
+
+def _own_reserved(ids, owner):
+    if not owner:
+        return {}
+    return dict(
+        ReservaStock.objects.filter(owner, variante_id__in=ids)
+        .values('variante_id').annotate(total=Sum('quantity'))
+        .values_list('variante_id', 'total')
+    )
+
+
+def _faltante(variantes, lines, own):
+    """Primera variante cuya cantidad pedida supera stock - reservas de otros, con su disponible."""
+    for variante in variantes:
+        disponible = max(variante.stock - (variante.stock_reservado - own.get(variante.pk, 0)), 0)
+        if lines[variante.pk] > disponible:
+            return variante, disponible
+    return None, None
+
+
+def _cart_items(cart):
+    """{variante_id: item} del carrito de sesión, sin líneas con cantidad no positiva."""
+    return {int(pk): item for pk, item in cart.items() if int(item.get('quantity') or 0) > 0}
+
+
+def build_order(items, codigo_pedido, user=None, **datos_cliente):
+    """Inserta el pedido con su total y sus líneas: 2 INSERT sea cual sea el tamaño del carrito.
+
+    `items` es {variante_id: item del carrito de sesión} (ver _cart_items).
+    """
+    subtotal = sum(Decimal(str(item['price'])) * int(item['quantity']) for item in items.values())
+    with transaction.atomic():
+        pedido = PedidoWhatsApp.objects.create(
+            codigo_pedido=codigo_pedido,
+            total=subtotal,
+            subtotal=subtotal,
+            costo_envio=Decimal('0'),
+            item_count=sum(int(item['quantity']) for item in items.values()),
+            user=user if user is not None and user.is_authenticated else None,
+            **datos_cliente,
+        )
+        DetallePedidoWhatsApp.objects.bulk_create([
+            DetallePedidoWhatsApp(
+                pedido=pedido,
+                producto_nombre=item['name'],
+                variante_color=item['color'],
+                cantidad=int(item['quantity']),
+                precio_unitario=Decimal(str(item['price'])),
+                imagen_url=item['image_url'],
+            )
+            for item in items.values()
+        ])
+    return pedido
+
+
+def order_from_cart(cart, codigo_pedido, user=None, **datos_cliente):
+    """Pedido por WhatsApp sin descontar stock (crear_pedido_whatsapp)."""
+    items = _cart_items(cart)
+    if not items:
+        raise ValueError('El carrito está vacío.')
+    return build_order(items, codigo_pedido, user=user, **datos_cliente)
+
+
+def checkout_cart(cart, codigo_pedido, session_key=None, user=None, **datos_cliente):
+    """Crea el PedidoWhatsApp del carrito de sesión descontando stock de forma atómica.
+
+    `datos_cliente` son los campos *_cliente / *_envio del pedido. Lanza
+    StockInsuficiente (sin efectos) si alguna variante no alcanza.
+    """
+    items = _cart_items(cart)
+    lines = {pk: int(item['quantity']) for pk, item in items.items()}
+    if not lines:
+        raise ValueError('El carrito está vacío.')
+    ids = sorted(lines)
+    owner = reservations.owner_q(session_key, user)
+
+    with transaction.atomic():
+        variantes = _lock_variantes(ids)
+        if len(variantes) != len(ids):
+            faltan = set(ids) - {v.pk for v in variantes}
+            raise StockInsuficiente(items[min(faltan)].get('name', ''), 0)
+
+        own = _own_reserved(ids, owner)
+        variante, disponible = _faltante(variantes, lines, own)
+        if variante is not None and reservations.release_expired(ids):
+            # Había reservas vencidas sin barrer: recalcular con el contador ya limpio
+            variantes = _lock_variantes(ids)
+            own = _own_reserved(ids, owner)
+            variante, disponible = _faltante(variantes, lines, own)
+        if variante is not None:
+            raise StockInsuficiente(variante.producto.nombre, disponible)
+
+        cond = Q()
+        for pk, qty in lines.items():
+            cond |= Q(pk=pk, stock__gte=qty)
+        updated = ColorVariante.objects.filter(cond).update(
+            stock=Case(
+                *[When(pk=pk, then=F('stock') - qty) for pk, qty in lines.items()],
+                default=F('stock'), output_field=IntegerField(),
+            ),
+            stock_reservado=Case(
+                *[When(pk=pk, then=F('stock_reservado') - own.get(pk, 0)) for pk in ids],
+                default=F('stock_reservado'), output_field=IntegerField(),
+            ),
+        )
+        if updated != len(ids):
+            # No debería ocurrir con las filas bloqueadas; por si acaso, revertir todo
+            raise StockInsuficiente(variantes[0].producto.nombre, 0)
+        if owner:
+            ReservaStock.objects.filter(owner, variante_id__in=ids).delete()
+
+        pedido = build_order(items, codigo_pedido, user=user, **datos_cliente)
+        if pedido.user_id:
+            CarritoItem.objects.filter(carrito__user_id=pedido.user_id).delete()
+            Carrito.objects.filter(user_id=pedido.user_id).update(item_count=0, updated_at=timezone.now())
+
+        # UPDATE directo: no hay post_save de ColorVariante que refresque el índice del catálogo
+        producto_ids = {v.producto_id for v in variantes}
+        transaction.on_commit(lambda: catalog_index.refresh_products(producto_ids))
+    return pedido
+
+
+def _costo_envio(total, subtotal):
+    return total - subtotal if total >= subtotal else Decimal('0')
+
+
+def recalculate_totals(pedidos=None, batch_size=500):
+    """Recalcula subtotal, costo_envio e item_count desde las líneas (backfill de pedidos antiguos).
+
+    Devuelve cuántos pedidos se actualizaron.
+    """
+    qs = PedidoWhatsApp.objects.all() if pedidos is None else pedidos
+    rows = (
+        qs.order_by('pk')
+        .annotate(
+            subtotal_lineas=Coalesce(
+                Sum(F('detalles__cantidad') * F('detalles__precio_unitario')),
+                Value(Decimal('0')), output_field=DecimalField(max_digits=10, decimal_places=2),
+            ),
+            items_lineas=Coalesce(Sum('detalles__cantidad'), Value(0)),
+        )
+        .values_list('pk', 'total', 'subtotal_lineas', 'items_lineas')
+    )
+    total = 0
+    batch = []
+    for pk, total_pedido, subtotal, items in rows.iterator(chunk_size=batch_size):
+        subtotal = Decimal(str(subtotal)).quantize(Decimal('0.01'))
+        batch.append(PedidoWhatsApp(
+            pk=pk, subtotal=subtotal, costo_envio=_costo_envio(total_pedido, subtotal), item_count=items,
+        ))
+        if len(batch) >= batch_size:
+            total += PedidoWhatsApp.objects.bulk_update(batch, ['subtotal', 'costo_envio', 'item_count'])
+            batch = []
+    if batch:
+        total += PedidoWhatsApp.objects.bulk_update(batch, ['subtotal', 'costo_envio', 'item_count'])
+    return total
@@ -0,0 +1,178 @@
+# mi_app/pagination.py
+"""Paginación por cursor (keyset) del catálogo público.
+
+En lugar de COUNT + OFFSET, cada página filtra "después del último elemento
+visto" según el orden activo:
+- por defecto: (-id)
+- price-asc / price-desc: (precio_efectivo, id) en el mismo sentido; un
+  producto aún sin fila en ProductoIndice tiene precio NULL, que se ordena
+  como el valor más alto (al final en asc, al principio en desc)
+- búsqueda sin orden explícito: (-search_rank, -id)
+El cursor es opaco (firmado con django.core.signing) y el total de
+coincidencias se cachea por combinación de filtros y versión del catálogo.
+El modo numérico (?page=N) se mantiene para enlaces antiguos.
+keyset_page también sirve a otros listados (historial de pedidos) con sus
+propias claves.
+"""
+import hashlib
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+from django.core import signing
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Q
+
+from .versioning import CATALOGO, get_version
+
+PAGE_SIZE = 12
+COUNT_TTL = 60 * 5
+CURSOR_SALT = 'mi_app.catalogo.cursor'
+# Parámetros que no cambian el conjunto de resultados (no entran en la clave del conteo)
+_NON_FILTER_PARAMS = {'cursor', 'page', 'orden', 'banner', 'banner_id'}
+
+
+def keyset_for(orden, relevancia=False):
+    """[(lookup, atributo_en_instancia, descendente[, anulable]), ...] para el orden activo (ver order_catalog)."""
+    if relevancia and not orden:
+        return [('search_rank', 'search_rank', True), ('id', 'id', True)]
+    if orden == 'price-asc':
+        return [('indice__precio_efectivo', 'precio_efectivo', False, True), ('id', 'id', False)]
+    if orden == 'price-desc':
+        return [('indice__precio_efectivo', 'precio_efectivo', True, True), ('id', 'id', True)]
+    return [('id', 'id', True)]
+
+
+def _encode_value(value):
+    if isinstance(value, Decimal):
+        return {'d': str(value)}
+    if isinstance(value, datetime):
+        return {'t': value.isoformat()}
+    if isinstance(value, uuid.UUID):
+        return {'u': str(value)}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if 'd' in value:
+            return Decimal(value['d'])
+        if 't' in value:
+            return datetime.fromisoformat(value['t'])
+        if 'u' in value:
+            return uuid.UUID(value['u'])
+    return value
+
+
+def encode_cursor(orden, values):
+    return signing.dumps({'o': orden or '', 'v': [_encode_value(v) for v in values]}, salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(token, orden):
+    """Valores del cursor, o None si es inválido o pertenece a otro orden."""
+    try:
+        payload = signing.loads(token, salt=CURSOR_SALT)
+    except (signing.BadSignature, ValueError, TypeError):
+        return None
+    if payload.get('o') != (orden or ''):
+        return None
+    return [_decode_value(v) for v in payload.get('v') or []]
+
+
+def _after_q(keys, values):
+    """(k1 > v1) OR (k1 = v1 AND k2 > v2) ... respetando el sentido de cada clave.
+
+    En las claves anulables NULL cuenta como el valor más alto (NULLS LAST en
+    asc, NULLS FIRST en desc, ver order_catalog).
+    """
+    condition = Q()
+    equal = Q()
+    for (lookup, _attr, desc, *rest), value in zip(keys, values):
+        nullable = bool(rest and rest[0])
+        if value is None:
+            # Cursor en el tramo de NULL: en desc ya siguen los valores no nulos
+            if desc:
+                condition |= equal & Q(**{f'{lookup}__isnull': False})
+            equal &= Q(**{f'{lookup}__isnull': True})
+            continue
+        op = 'lt' if desc else 'gt'
+        step = Q(**{f'{lookup}__{op}': value})
+        if nullable and not desc:
+            step |= Q(**{f'{lookup}__isnull': True})
+        condition |= equal & step
+        equal &= Q(**{lookup: value})
+    return condition
+
+
+class KeysetPage:
+    """Página por cursor con la interfaz mínima que usan las plantillas."""
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def keyset_page(queryset, orden, cursor=None, relevancia=False, per_page=PAGE_SIZE, keys=None):
+    """Una página a partir de `cursor` sobre un queryset ya ordenado con order_catalog.
+
+    Otros listados pasan sus propias `keys` (mismo formato que keyset_for) y
+    un `orden` propio que identifica el cursor.
+    """
+    keys = keys or keyset_for(orden, relevancia)
+    values = decode_cursor(cursor, orden) if cursor else None
+    if values and len(values) == len(keys):
+        queryset = queryset.filter(_after_q(keys, values))
+    rows = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor(orden, [getattr(last, key[1]) for key in keys])
+    return KeysetPage(rows, next_cursor)
+
+
+def cached_count(queryset, params):
+    """COUNT de coincidencias cacheado por filtros + versión del catálogo."""
+    items = sorted(
+        (k, v) for k in params.keys() if k not in _NON_FILTER_PARAMS for v in params.getlist(k)
+    )
+    digest = hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+    key = f'fi:catalogo_count:v{get_version(CATALOGO)}:{digest}'
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, COUNT_TTL)
+    return count
+
+
+def paginate_catalog(request, queryset, orden=None, relevancia=False):
+    """Pagina el catálogo. Devuelve (page_obj, matched_count, next_page_url).
+
+    Con ?page=N se usa el Paginator clásico (enlaces numerados existentes);
+    en otro caso, cursor + conteo cacheado.
+    """
+    matched_count = cached_count(queryset, request.GET)
+    if request.GET.get('page'):
+        paginator = Paginator(queryset, PAGE_SIZE)
+        # El COUNT ya está cacheado: evitar que el paginator lo repita
+        paginator.count = matched_count
+        return paginator.get_page(request.GET.get('page')), matched_count, None
+
+    page_obj = keyset_page(queryset, orden, request.GET.get('cursor'), relevancia=relevancia)
+    next_page_url = None
+    if page_obj.has_next:
+        params = request.GET.copy()
+        params['cursor'] = page_obj.next_cursor
+        next_page_url = f'{request.path}?{params.urlencode()}'
+    return page_obj, matched_count, next_page_url
@@ -0,0 +1,160 @@
+# mi_app/related_products.py
+"""Grafo materializado de productos relacionados (ProductoRelacionado).
+
+Reglas (idénticas a las que aplicaba producto_detalle en cada request):
+0. Si la categoría del producto o su padre tienen categorias_relacionadas,
+   productos de esas categorías (con descendientes).
+1. Si es subcategoría: hermanos (misma categoría exacta).
+2. Si no hay hermanos: productos del subárbol del padre.
+3. Si es categoría raíz: productos del subárbol de la raíz.
+4. Fallback global.
+Se usa la primera regla con candidatos. Se guardan hasta MAX_CANDIDATOS por
+producto; el detalle los lee con una consulta y elige al azar.
+"""
+import random
+
+from django.db import transaction
+
+from .models import Categoria, Producto, ProductoRelacionado
+from .sampling import build_pools, sample
+
+MAX_CANDIDATOS = 12
+
+
+class _Grafo:
+    """Estado en memoria necesario para calcular candidatos (pools + árbol + cross-selling)."""
+
+    def __init__(self):
+        self.pools = build_pools()
+        self.parents = dict(Categoria.objects.values_list('pk', 'parent_id'))
+        self.relacionadas = {}
+        through = Categoria.categorias_relacionadas.through
+        for from_id, to_id in through.objects.values_list('from_categoria_id', 'to_categoria_id'):
+            self.relacionadas.setdefault(from_id, []).append(to_id)
+
+    def candidatos(self, producto_id, categoria_id):
+        excluir = (producto_id,)
+        if categoria_id is not None and categoria_id in self.parents:
+            parent_id = self.parents[categoria_id]
+            related = list(self.relacionadas.get(categoria_id, ()))
+            if parent_id is not None:
+                related += self.relacionadas.get(parent_id, ())
+            if related:
+                ids = sample(self.pools.subarboles(related), MAX_CANDIDATOS, excluir)
+                if ids:
+                    return 0, ids
+            if parent_id is not None:
+                ids = sample(self.pools.categoria(categoria_id), MAX_CANDIDATOS, excluir)
+                if ids:
+                    return 1, ids
+                ids = sample(self.pools.subarbol(parent_id), MAX_CANDIDATOS, excluir)
+                if ids:
+                    return 2, ids
+            else:
+                ids = sample(self.pools.subarbol(categoria_id), MAX_CANDIDATOS, excluir)
+                if ids:
+                    return 3, ids
+        return 4, sample(self.pools.todos, MAX_CANDIDATOS, excluir)
+
+    def ancestros(self, categoria_id):
+        seen = []
+        while categoria_id is not None and categoria_id not in seen:
+            seen.append(categoria_id)
+            categoria_id = self.parents.get(categoria_id)
+        return seen
+
+    def categorias_afectadas(self, categoria_ids):
+        """Categorías cuyos productos pueden tener como candidato a un producto de `categoria_ids`."""
+        afectadas = set()
+        for categoria_id in categoria_ids:
+            if categoria_id is None:
+                continue
+            ancestros = set(self.ancestros(categoria_id))
+            raiz = self.ancestros(categoria_id)[-1]
+            for pk in self.parents:
+                cadena = self.ancestros(pk)
+                # Mismo árbol (hermanos, padre, raíz)
+                if cadena and cadena[-1] == raiz:
+                    afectadas.add(pk)
+                    continue
+                # Cross-selling: la categoría o su padre apuntan a un ancestro de la cambiada
+                origen = [pk] + ([self.parents[pk]] if self.parents.get(pk) is not None else [])
+                if any(ancestros.intersection(self.relacionadas.get(o, ())) for o in origen):
+                    afectadas.add(pk)
+        return afectadas
+
+
+def _write(grafo, productos):
+    """Reemplaza las aristas de `productos` [(id, categoria_id), ...]. Devuelve cuántas aristas se escribieron."""
+    rows = []
+    for producto_id, categoria_id in productos:
+        prioridad, ids = grafo.candidatos(producto_id, categoria_id)
+        rows.extend(
+            ProductoRelacionado(producto_id=producto_id, relacionado_id=rel_id, prioridad=prioridad)
+            for rel_id in ids
+        )
+    with transaction.atomic():
+        ProductoRelacionado.objects.filter(producto_id__in=[pk for pk, _ in productos]).delete()
+        ProductoRelacionado.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def refresh_products(producto_ids):
+    """Recalcula las aristas de los productos indicados."""
+    ids = {int(pk) for pk in producto_ids if pk is not None}
+    if not ids:
+        return 0
+    grafo = _Grafo()
+    productos = list(Producto.objects.filter(pk__in=ids).values_list('pk', 'categoria_id'))
+    return _write(grafo, productos)
+
+
+def refresh_for_categories(categoria_ids, extra_producto_ids=()):
+    """Recalcula los productos que pueden verse afectados por cambios en `categoria_ids`.
+
+    `extra_producto_ids` permite incluir productos concretos (p.ej. los que
+    tenían como candidato a un producto que cambió de categoría).
+    """
+    grafo = _Grafo()
+    afectadas = grafo.categorias_afectadas(categoria_ids)
+    productos = list(
+        Producto.objects.filter(categoria_id__in=afectadas).values_list('pk', 'categoria_id')
+    )
+    extra = set(extra_producto_ids) - {pk for pk, _ in productos}
+    if extra:
+        productos += list(Producto.objects.filter(pk__in=extra).values_list('pk', 'categoria_id'))
+    return _write(grafo, productos)
+
+
+def refresh_category_links(categoria_ids):
+    """Tras cambiar categorias_relacionadas: productos de esas categorías y de sus hijas directas."""
+    grafo = _Grafo()
+    ids = set(categoria_ids)
+    categorias = ids | {pk for pk, parent_id in grafo.parents.items() if parent_id in ids}
+    productos = list(Producto.objects.filter(categoria_id__in=categorias).values_list('pk', 'categoria_id'))
+    return _write(grafo, productos)
+
+
+def refresh_producto(producto_id):
+    """Tras guardar un producto: él mismo, su entorno de categorías y quien ya lo tenía como candidato."""
+    categoria_id = Producto.objects.filter(pk=producto_id).values_list('categoria_id', flat=True).first()
+    previos = ProductoRelacionado.objects.filter(relacionado_id=producto_id).values_list('producto_id', flat=True)
+    return refresh_for_categories([categoria_id], extra_producto_ids=[producto_id, *previos])
+
+
+def rebuild_all(batch_size=500):
+    """Reconstruye el grafo completo por lotes. Devuelve el total de aristas."""
+    grafo = _Grafo()
+    productos = list(Producto.objects.order_by('pk').values_list('pk', 'categoria_id'))
+    total = 0
+    for start in range(0, len(productos), batch_size):
+        total += _write(grafo, productos[start:start + batch_size])
+    return total
+
+
+def related_for(producto, limit=4):
+    """Hasta `limit` productos relacionados al azar, leídos del grafo con una consulta."""
+    candidatos = list(Producto.objects.filter(relacionado_en__producto_id=producto.pk))
+    if len(candidatos) > limit:
+        candidatos = random.sample(candidatos, limit)
+    return candidatos
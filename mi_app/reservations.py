@@ -0,0 +1,308 @@
+# mi_app/reservations.py
+"""Reservas de stock con contador agregado por variante.
+
+`ColorVariante.stock_reservado` es la suma de `quantity` de todas las filas
+ReservaStock de la variante (vencidas o no, hasta que se liberan). Toda
+creación, cambio o liberación de reservas pasa por este módulo, que ajusta
+el contador con F() dentro de la misma transacción; así "disponible = stock
+- reservado" es una lectura O(1) en lugar de sumar filas en Python.
+
+Las reservas vencidas siguen contando hasta liberarse, así que no se depende
+de que el worker `python manage.py liberar_reservas --loop` (sweep_expired)
+esté corriendo: antes de mostrar stock se liberan las vencidas del producto
+o variante (sweep_product, current_available) y, si al reservar una variante
+parece agotada, también (ensure_available). El worker solo adelanta ese
+trabajo y limpia los carritos.
+"""
+import logging
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, When
+from django.utils import timezone
+
+from .models import Carrito, CarritoItem, ColorVariante, ReservaStock
+
+logger = logging.getLogger(__name__)
+
+RESERVA_HORAS = 24
+SWEEP_BATCH_SIZE = 500
+
+
+def _adjust(deltas):
+    """Aplica {variante_id: delta} al contador en un solo UPDATE (stock_reservado = stock_reservado + delta)."""
+    deltas = {pk: delta for pk, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    if len(deltas) == 1:
+        (pk, delta), = deltas.items()
+        ColorVariante.objects.filter(pk=pk).update(stock_reservado=F('stock_reservado') + delta)
+        return
+    ColorVariante.objects.filter(pk__in=list(deltas)).update(stock_reservado=Case(
+        *[When(pk=pk, then=F('stock_reservado') + delta) for pk, delta in deltas.items()],
+        default=F('stock_reservado'), output_field=IntegerField(),
+    ))
+
+
+def _release(queryset):
+    """Borra las reservas de `queryset` y descuenta sus cantidades. Devuelve las unidades liberadas."""
+    with transaction.atomic():
+        rows = list(queryset.select_for_update().values_list('pk', 'variante_id', 'quantity'))
+        if not rows:
+            return 0
+        ReservaStock.objects.filter(pk__in=[pk for pk, _, _ in rows]).delete()
+        deltas = {}
+        for _pk, variante_id, quantity in rows:
+            deltas[variante_id] = deltas.get(variante_id, 0) - quantity
+        _adjust(deltas)
+    return -sum(deltas.values())
+
+
+def set_reservation(variante, session_key, quantity, user=None, hours=RESERVA_HORAS):
+    """Crea o actualiza la reserva (variante, sesión) a `quantity` y extiende su vencimiento."""
+    expires_at = timezone.now() + timedelta(hours=hours)
+    with transaction.atomic():
+        reserva = (
+            ReservaStock.objects.select_for_update()
+            .filter(variante=variante, session_key=session_key)
+            .first()
+        )
+        if reserva is None:
+            try:
+                with transaction.atomic():
+                    reserva = ReservaStock.objects.create(
+                        variante=variante, session_key=session_key, quantity=0, expires_at=expires_at,
+                    )
+            except IntegrityError:
+                # Otra petición de la misma sesión la creó en paralelo (doble clic)
+                reserva = ReservaStock.objects.select_for_update().get(variante=variante, session_key=session_key)
+        delta = quantity - reserva.quantity
+        reserva.quantity = quantity
+        reserva.expires_at = expires_at
+        if user is not None and getattr(user, 'is_authenticated', False):
+            reserva.user = user
+        reserva.save()
+        _adjust({variante.pk: delta})
+    return reserva
+
+
+def consolidate(quantities, session_key, user, extra_session_keys=(), hours=RESERVA_HORAS):
+    """Deja una reserva por variante para (sesión actual, usuario) con las cantidades dadas.
+
+    Usado al iniciar sesión: libera las reservas previas del usuario y de las
+    sesiones anteriores (`extra_session_keys`, p.ej. la anónima antes de
+    cycle_key) y las reemplaza en bloque. Número de consultas constante.
+    """
+    if not quantities and not extra_session_keys:
+        return
+    expires_at = timezone.now() + timedelta(hours=hours)
+    previas = Q(variante_id__in=list(quantities)) & owner_q(session_key, user)
+    if extra_session_keys:
+        previas |= Q(session_key__in=list(extra_session_keys))
+    with transaction.atomic():
+        rows = list(ReservaStock.objects.select_for_update().filter(previas).values_list('pk', 'variante_id', 'quantity'))
+        deltas = {}
+        if rows:
+            ReservaStock.objects.filter(pk__in=[pk for pk, _, _ in rows]).delete()
+            for _pk, variante_id, quantity in rows:
+                deltas[variante_id] = deltas.get(variante_id, 0) - quantity
+        nuevas = [
+            ReservaStock(variante_id=variante_id, session_key=session_key, user=user, quantity=quantity, expires_at=expires_at)
+            for variante_id, quantity in quantities.items() if quantity > 0
+        ]
+        if nuevas:
+            ReservaStock.objects.bulk_create(
+                nuevas,
+                update_conflicts=True,
+                unique_fields=['variante', 'session_key'],
+                update_fields=['quantity', 'expires_at', 'user'],
+            )
+            for reserva in nuevas:
+                deltas[reserva.variante_id] = deltas.get(reserva.variante_id, 0) + reserva.quantity
+        _adjust(deltas)
+
+
+def owner_q(session_key=None, user=None):
+    """Q de las reservas de esa sesión y/o de ese usuario (todas sus sesiones); Q() vacía si no hay dueño."""
+    cond = Q()
+    if session_key:
+        cond |= Q(session_key=session_key)
+    if user is not None and getattr(user, 'is_authenticated', False):
+        cond |= Q(user=user)
+    return cond
+
+
+def release(variante, session_key=None, user=None):
+    """Libera las reservas de la variante de esa sesión y/o de ese usuario (todas sus sesiones)."""
+    cond = owner_q(session_key, user)
+    if not cond:
+        return 0
+    return _release(ReservaStock.objects.filter(cond, variante=variante))
+
+
+def release_owner(session_key=None, user=None):
+    """Libera todas las reservas de esa sesión y/o usuario (p.ej. antes de borrar la cuenta)."""
+    cond = owner_q(session_key, user)
+    if not cond:
+        return 0
+    return _release(ReservaStock.objects.filter(cond))
+
+
+def release_expired(variante_ids=None, now=None):
+    """Libera reservas vencidas (de todas las variantes o solo de `variante_ids`)."""
+    qs = ReservaStock.objects.filter(expires_at__lte=now or timezone.now())
+    if variante_ids is not None:
+        qs = qs.filter(variante_id__in=list(variante_ids))
+    return _release(qs)
+
+
+def _release_if_expired(queryset, now=None):
+    """Libera las vencidas de `queryset`; en el caso habitual (ninguna) es un EXISTS sin bloqueos."""
+    vencidas = queryset.filter(expires_at__lte=now or timezone.now())
+    if not vencidas.exists():
+        return 0
+    return _release(vencidas)
+
+
+def sweep_product(producto_id, now=None):
+    """Libera las reservas vencidas de las variantes del producto (antes de mostrar su stock)."""
+    variantes = ColorVariante.objects.filter(producto_id=producto_id).values('pk')
+    return _release_if_expired(ReservaStock.objects.filter(variante_id__in=variantes), now)
+
+
+def _sweep_batch(now, batch_size):
+    """Libera un lote de reservas vencidas y los CarritoItem que ya no tienen reserva viva.
+
+    Devuelve (reservas, unidades, items_carrito, variantes).
+    """
+    with transaction.atomic():
+        rows = list(
+            ReservaStock.objects.select_for_update(skip_locked=True)
+            .filter(expires_at__lte=now)
+            .order_by('expires_at')
+            .values_list('pk', 'variante_id', 'user_id', 'quantity')[:batch_size]
+        )
+        if not rows:
+            return 0, 0, 0, set()
+        ReservaStock.objects.filter(pk__in=[pk for pk, _, _, _ in rows]).delete()
+        deltas = {}
+        pares = set()
+        for _pk, variante_id, user_id, quantity in rows:
+            deltas[variante_id] = deltas.get(variante_id, 0) - quantity
+            if user_id is not None:
+                pares.add((user_id, variante_id))
+        _adjust(deltas)
+
+        items = 0
+        if pares:
+            # Conservar el ítem si el usuario mantiene otra reserva vigente (otra sesión)
+            vivas = set(
+                ReservaStock.objects.filter(
+                    user_id__in={u for u, _ in pares},
+                    variante_id__in={v for _, v in pares},
+                    expires_at__gt=now,
+                ).values_list('user_id', 'variante_id')
+            )
+            cond = Q()
+            for user_id, variante_id in pares - vivas:
+                cond |= Q(carrito__user_id=user_id, variante_id=variante_id)
+            if cond:
+                items, _ = CarritoItem.objects.filter(cond).delete()
+                Carrito.recount(
+                    Carrito.objects.filter(user_id__in={u for u, _ in pares - vivas}), updated_at=timezone.now(),
+                )
+    return len(rows), -sum(deltas.values()), items, set(deltas)
+
+
+def sweep_expired(batch_size=SWEEP_BATCH_SIZE, now=None, max_batches=None):
+    """Borra por lotes todas las reservas vencidas (worker liberar_reservas).
+
+    Cada lote va en su propia transacción para no bloquear la tabla. Devuelve
+    un dict con las métricas de lo liberado (también se registra en el log).
+    """
+    now = now or timezone.now()
+    stats = {'lotes': 0, 'reservas': 0, 'unidades': 0, 'items_carrito': 0, 'variantes': 0}
+    variantes = set()
+    while max_batches is None or stats['lotes'] < max_batches:
+        reservas, unidades, items, afectadas = _sweep_batch(now, batch_size)
+        if not reservas:
+            break
+        stats['lotes'] += 1
+        stats['reservas'] += reservas
+        stats['unidades'] += unidades
+        stats['items_carrito'] += items
+        variantes |= afectadas
+        if reservas < batch_size:
+            break
+    stats['variantes'] = len(variantes)
+    if stats['reservas']:
+        logger.info(
+            "Reservas vencidas liberadas: %(reservas)s reservas, %(unidades)s unidades, "
+            "%(variantes)s variantes, %(items_carrito)s ítems de carrito (%(lotes)s lotes)", stats
+        )
+    return stats
+
+
+def own_quantity(variante, session_key):
+    if not session_key:
+        return 0
+    return (
+        ReservaStock.objects.filter(variante=variante, session_key=session_key)
+        .values_list('quantity', flat=True).first()
+    ) or 0
+
+
+def available_for(variante, session_key=None):
+    """Unidades que puede tener la sesión: stock - reservas de otras sesiones."""
+    reserved_others = variante.stock_reservado - own_quantity(variante, session_key)
+    return max(variante.stock - reserved_others, 0)
+
+
+def ensure_available(variante, session_key, wanted):
+    """Como available_for, pero si no alcanza libera las vencidas de la variante y recalcula.
+
+    Refresca `variante.stock`/`stock_reservado` en ese caso.
+    """
+    available = available_for(variante, session_key)
+    if wanted > available and release_expired([variante.pk]):
+        variante.refresh_from_db(fields=['stock', 'stock_reservado'])
+        available = available_for(variante, session_key)
+    return available
+
+
+def current_available(variante):
+    """Disponible total (stock - reservas vigentes) leído del contador actualizado."""
+    _release_if_expired(ReservaStock.objects.filter(variante=variante))
+    stock, reservado = ColorVariante.objects.filter(pk=variante.pk).values_list('stock', 'stock_reservado').get()
+    return max(stock - reservado, 0)
+
+
+def resync_counters(variante_ids=None, batch_size=SWEEP_BATCH_SIZE):
+    """Recalcula stock_reservado desde las filas (para corregir derivas). Devuelve las variantes corregidas.
+
+    Cada lote bloquea sus variantes (select_for_update, en orden de pk) antes de
+    sumar las reservas. Toda reserva, liberación o checkout ajusta el contador
+    en la misma transacción que sus filas: o ya confirmó y entra en la suma, o
+    espera el bloqueo y aplica su delta sobre el valor corregido.
+    """
+    pks = ColorVariante.objects.order_by('pk').values_list('pk', flat=True)
+    if variante_ids is not None:
+        pks = pks.filter(pk__in=list(variante_ids))
+    pks = list(pks)
+    fixed = 0
+    for start in range(0, len(pks), batch_size):
+        lote = pks[start:start + batch_size]
+        with transaction.atomic():
+            current = dict(
+                ColorVariante.objects.select_for_update().filter(pk__in=lote).order_by('pk')
+                .values_list('pk', 'stock_reservado')
+            )
+            totals = dict(
+                ReservaStock.objects.filter(variante_id__in=lote)
+                .values('variante_id').annotate(total=Sum('quantity'))
+                .values_list('variante_id', 'total')
+            )
+            deltas = {pk: (totals.get(pk) or 0) - reservado for pk, reservado in current.items()}
+            _adjust(deltas)
+        fixed += sum(1 for delta in deltas.values() if delta)
+    return fixed
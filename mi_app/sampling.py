@@ -0,0 +1,111 @@
+# mi_app/sampling.py
+"""Muestreo aleatorio de productos sin ORDER BY RANDOM().
+
+Mantiene en memoria del proceso pools de ids de producto (todos, por
+categoría exacta, por subárbol de categoría, nueva colección y oferta),
+construidos con dos consultas y reconstruidos cuando cambia la versión
+'catalogo' o tras POOL_TTL segundos. Elegir k productos es random.sample
+sobre una lista: no se ordena la tabla en cada request.
+"""
+import random
+import threading
+import time
+
+from .models import Categoria, Producto
+from .versioning import CATALOGO, get_version
+
+POOL_TTL = 300
+
+_lock = threading.Lock()
+_state = {'version': None, 'built_at': 0.0, 'pools': None}
+
+
+class ProductPools:
+    def __init__(self, rows, categorias):
+        self.todos = []
+        self.con_imagen = []
+        self.nueva_coleccion = []
+        self.ofertas = []
+        self.por_categoria = {}
+        for pk, categoria_id, es_oferta, es_nueva, imagen in rows:
+            self.todos.append(pk)
+            if categoria_id is not None:
+                self.por_categoria.setdefault(categoria_id, []).append(pk)
+            # Las promos solo muestran productos con imagen principal
+            if imagen:
+                self.con_imagen.append(pk)
+                if es_nueva:
+                    self.nueva_coleccion.append(pk)
+                if es_oferta:
+                    self.ofertas.append(pk)
+
+        # Subárboles: cada categoría acumula sus productos y los de sus descendientes
+        children = {}
+        for pk, parent_id in categorias:
+            children.setdefault(parent_id, []).append(pk)
+        self.por_subarbol = {}
+
+        def _collect(cat_pk, seen):
+            ids = list(self.por_categoria.get(cat_pk, ()))
+            for child in children.get(cat_pk, ()):
+                if child not in seen:
+                    seen.add(child)
+                    ids.extend(_collect(child, seen))
+            self.por_subarbol[cat_pk] = ids
+            return ids
+
+        for root in children.get(None, ()):
+            _collect(root, {root})
+
+    def subarbol(self, categoria_id):
+        return self.por_subarbol.get(categoria_id, [])
+
+    def subarboles(self, categoria_ids):
+        """Unión (sin duplicados) de los subárboles de varias categorías."""
+        ids = set()
+        for categoria_id in categoria_ids:
+            ids.update(self.subarbol(categoria_id))
+        return list(ids)
+
+    def categoria(self, categoria_id):
+        return self.por_categoria.get(categoria_id, [])
+
+
+def build_pools():
+    rows = Producto.objects.values_list('pk', 'categoria_id', 'es_oferta', 'es_nueva_coleccion', 'imagen_principal')
+    categorias = Categoria.objects.values_list('pk', 'parent_id')
+    return ProductPools(list(rows), list(categorias))
+
+
+def get_pools():
+    """Pools vigentes para la versión actual del catálogo (se reconstruyen bajo demanda)."""
+    version = get_version(CATALOGO)
+    now = time.monotonic()
+    state = _state
+    if state['pools'] is None or state['version'] != version or now - state['built_at'] > POOL_TTL:
+        with _lock:
+            if state['pools'] is None or state['version'] != version or now - state['built_at'] > POOL_TTL:
+                state['pools'] = build_pools()
+                state['version'] = version
+                state['built_at'] = now
+    return state['pools']
+
+
+def sample(pool, k, exclude=()):
+    """Hasta k ids distintos al azar de `pool`, sin los de `exclude`."""
+    exclude = set(exclude)
+    if not pool or k <= 0:
+        return []
+    # Se toman algunos de más para compensar los excluidos sin recorrer el pool
+    extra = min(len(pool), k + len(exclude))
+    picked = [pk for pk in random.sample(pool, extra) if pk not in exclude]
+    return picked[:k]
+
+
+def fetch_in_order(ids, queryset=None):
+    """Instancias de Producto para `ids` en una consulta, respetando el orden de muestreo."""
+    if not ids:
+        return []
+    queryset = queryset if queryset is not None else Producto.objects.all()
+    by_pk = queryset.in_bulk(ids)
+    return [by_pk[pk] for pk in ids if pk in by_pk]
@@ -0,0 +1,177 @@
+# mi_app/search.py
+"""Búsqueda de texto completo sobre los campos normalizados de Producto.
+
+- Postgres: columna generada `search_vector` (tsvector, pesos A/B) con índice GIN.
+- SQLite: tabla FTS5 `mi_app_producto_fts` de contenido externo mantenida por triggers.
+- Otro motor (o SQLite sin FTS5): filtro `contains` sobre nombre_norm/descripcion_norm.
+
+Los términos se normalizan con Producto._normalize_text y cada uno se busca
+como prefijo (búsqueda mientras se escribe). Se combinan con OR, como el
+filtro anterior, y el orden por relevancia deja primero los que coinciden
+con más términos y en el nombre.
+"""
+import re
+
+from django.db import connection, connections
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+from .models import Producto
+
+FTS_TABLE = 'mi_app_producto_fts'
+PG_CONFIG = 'simple'
+
+# Triggers de sincronización (idempotentes). Se recrean tras migrar porque el
+# "remake table" de SQLite al alterar mi_app_producto los elimina.
+SQLITE_TRIGGERS = {
+    'mi_app_producto_fts_ai': """
+        CREATE TRIGGER IF NOT EXISTS mi_app_producto_fts_ai AFTER INSERT ON mi_app_producto BEGIN
+            INSERT INTO mi_app_producto_fts(rowid, nombre_norm, descripcion_norm)
+            VALUES (new.id, new.nombre_norm, new.descripcion_norm);
+        END
+    """,
+    'mi_app_producto_fts_ad': """
+        CREATE TRIGGER IF NOT EXISTS mi_app_producto_fts_ad AFTER DELETE ON mi_app_producto BEGIN
+            INSERT INTO mi_app_producto_fts(mi_app_producto_fts, rowid, nombre_norm, descripcion_norm)
+            VALUES ('delete', old.id, old.nombre_norm, old.descripcion_norm);
+        END
+    """,
+    'mi_app_producto_fts_au': """
+        CREATE TRIGGER IF NOT EXISTS mi_app_producto_fts_au
+        AFTER UPDATE OF nombre_norm, descripcion_norm ON mi_app_producto BEGIN
+            INSERT INTO mi_app_producto_fts(mi_app_producto_fts, rowid, nombre_norm, descripcion_norm)
+            VALUES ('delete', old.id, old.nombre_norm, old.descripcion_norm);
+            INSERT INTO mi_app_producto_fts(rowid, nombre_norm, descripcion_norm)
+            VALUES (new.id, new.nombre_norm, new.descripcion_norm);
+        END
+    """,
+}
+
+_fts_available = False
+
+
+def search_terms(query):
+    """Normaliza la consulta y la separa en términos alfanuméricos."""
+    norm = Producto._normalize_text(query)
+    return [t for t in re.split(r'[^a-z0-9]+', norm) if t]
+
+
+def _sqlite_fts_ready():
+    global _fts_available
+    if not _fts_available:
+        _fts_available = FTS_TABLE in connection.introspection.table_names()
+    return _fts_available
+
+
+def backend():
+    """'postgres', 'fts5' o None (filtro contains)."""
+    if connection.vendor == 'postgresql':
+        return 'postgres'
+    if connection.vendor == 'sqlite' and _sqlite_fts_ready():
+        return 'fts5'
+    return None
+
+
+def _fallback_q(terms):
+    q_obj = Q()
+    for t in terms:
+        q_obj |= Q(nombre_norm__contains=t) | Q(descripcion_norm__contains=t)
+    return q_obj
+
+
+def search_queryset(queryset, query):
+    """Filtra `queryset` (de Producto) por `query` y anota `search_rank`.
+
+    Un `search_rank` mayor indica mayor relevancia. Si la consulta no tiene
+    términos útiles devuelve un queryset vacío.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return queryset.none().annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+    engine = backend()
+    if engine == 'postgres':
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField
+
+        tsquery = SearchQuery(
+            ' | '.join(f'{t}:*' for t in terms), search_type='raw', config=PG_CONFIG
+        )
+        vector = RawSQL('"mi_app_producto"."search_vector"', [], output_field=SearchVectorField())
+        return (
+            queryset.alias(search_vector=vector)
+            .filter(search_vector=tsquery)
+            .annotate(search_rank=SearchRank(F('search_vector'), tsquery))
+        )
+
+    if engine == 'fts5':
+        match = ' OR '.join(f'"{t}"*' for t in terms)
+        # bm25 devuelve valores negativos (más bajo = mejor); se invierte el signo.
+        # Peso 10 al nombre frente a 1 a la descripción.
+        rank = RawSQL(
+            f'SELECT -bm25({FTS_TABLE}, 10.0, 1.0) FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s AND {FTS_TABLE}.rowid = "mi_app_producto"."id"',
+            [match], output_field=FloatField(),
+        )
+        return (
+            queryset.filter(pk__in=RawSQL(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [match]
+            ))
+            .annotate(search_rank=rank)
+        )
+
+    return queryset.filter(_fallback_q(terms)).annotate(
+        search_rank=Value(0.0, output_field=FloatField())
+    )
+
+
+# ================= Mantenimiento =================
+def ensure_sqlite_triggers(using=None):
+    """Recrea los triggers FTS5 si faltan; reconstruye la tabla si hubo que crearlos."""
+    conn = connections[using or 'default']
+    if conn.vendor != 'sqlite':
+        return False
+    with conn.cursor() as cursor:
+        if FTS_TABLE not in conn.introspection.table_names(cursor):
+            return False
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'mi_app_producto'"
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        missing = [name for name in SQLITE_TRIGGERS if name not in existing]
+        for name in missing:
+            cursor.execute(SQLITE_TRIGGERS[name])
+        if missing:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    return bool(missing)
+
+
+def rebuild_search_index(batch_size=500):
+    """Renormaliza nombre/descripción de todos los productos y reconstruye el índice.
+
+    En Postgres la columna generada se recalcula con el UPDATE; en SQLite se
+    fuerza además un 'rebuild' + 'optimize' de la tabla FTS5. Devuelve cuántos
+    productos se actualizaron.
+    """
+    changed = []
+    updated = 0
+    qs = Producto.objects.only('pk', 'nombre', 'descripcion', 'nombre_norm', 'descripcion_norm')
+    for p in qs.iterator(chunk_size=batch_size):
+        nombre_norm = Producto._normalize_text(p.nombre)
+        descripcion_norm = Producto._normalize_text(p.descripcion)
+        if nombre_norm != p.nombre_norm or descripcion_norm != p.descripcion_norm:
+            p.nombre_norm, p.descripcion_norm = nombre_norm, descripcion_norm
+            changed.append(p)
+        if len(changed) >= batch_size:
+            Producto.objects.bulk_update(changed, ['nombre_norm', 'descripcion_norm'])
+            updated += len(changed)
+            changed = []
+    if changed:
+        Producto.objects.bulk_update(changed, ['nombre_norm', 'descripcion_norm'])
+        updated += len(changed)
+
+    if backend() == 'fts5':
+        ensure_sqlite_triggers()
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+    return updated
@@ -0,0 +1,193 @@
+# mi_app/signals.py
+"""Receptores que mantienen al día las estructuras derivadas del catálogo.
+
+Se conectan desde MiAppConfig.ready(). El trabajo se difiere con
+transaction.on_commit para no reindexar filas que el admin aún podría
+revertir (y para que un borrado en cascada no reinserte filas huérfanas).
+Al final, el receptor de login que fusiona el carrito anónimo y el que
+libera las reservas de un usuario antes de borrarlo.
+"""
+import logging
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete, post_migrate, m2m_changed, pre_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import (
+    Producto, ColorVariante, Categoria, Banner, Pagina, ProductoRelacionado,
+    ConfiguracionSitio, ConfiguracionRuleta, PremioRuleta, ConfiguracionChatbot,
+)
+from . import autocomplete, cart, catalog_index, related_products, reservations, search
+from .versioning import CATALOGO, SITIO, bump_version
+
+logger = logging.getLogger(__name__)
+
+
+def _bump_catalog():
+    # Invalida lo derivado del catálogo (autocompletado, snapshots cacheados)
+    bump_version(CATALOGO)
+
+
+@receiver(post_save, sender=Producto)
+def _producto_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    pk = instance.pk
+    transaction.on_commit(lambda: catalog_index.refresh_products([pk]))
+    transaction.on_commit(_bump_catalog)
+
+
+@receiver(post_delete, sender=Producto)
+def _producto_deleted(sender, instance, **kwargs):
+    transaction.on_commit(_bump_catalog)
+
+
+@receiver(post_save, sender=ColorVariante)
+@receiver(post_delete, sender=ColorVariante)
+def _variante_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    producto_id = instance.producto_id
+    transaction.on_commit(lambda: catalog_index.refresh_products([producto_id]))
+    # Imágenes y colores de las tarjetas: invalida las páginas cacheadas (http_cache)
+    transaction.on_commit(_bump_catalog)
+    # ...y la tarjeta del producto ({% cache %} por updated_at); update() no dispara post_save
+    Producto.objects.filter(pk=producto_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Categoria)
+def _categoria_saved(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    transaction.on_commit(_bump_catalog)
+    if created:
+        # Una categoría nueva aún no tiene productos que reindexar.
+        return
+    pk = instance.pk
+
+    def _refresh():
+        categoria = Categoria.objects.filter(pk=pk).first()
+        if categoria is not None:
+            catalog_index.refresh_category(categoria)
+    transaction.on_commit(_refresh)
+
+
+@receiver(post_delete, sender=Categoria)
+def _categoria_deleted(sender, instance, **kwargs):
+    transaction.on_commit(catalog_index.refresh_orphans)
+    transaction.on_commit(_bump_catalog)
+
+
+# ================= Grafo de productos relacionados =================
+@receiver(pre_save, sender=Producto)
+def _producto_categoria_previa(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        instance._categoria_previa = None
+        return
+    instance._categoria_previa = (
+        Producto.objects.filter(pk=instance.pk).values_list('categoria_id', flat=True).first()
+    )
+
+
+@receiver(post_save, sender=Producto)
+def _producto_relacionados(sender, instance, created=False, raw=False, **kwargs):
+    # Nombre, precio o flags no afectan al grafo: solo altas y cambios de categoría
+    if raw or not (created or instance.categoria_id != getattr(instance, '_categoria_previa', None)):
+        return
+    pk = instance.pk
+    transaction.on_commit(lambda: related_products.refresh_producto(pk))
+
+
+@receiver(pre_delete, sender=Producto)
+def _producto_relacionados_borrado(sender, instance, **kwargs):
+    # Quienes lo tenían como candidato pierden una arista (CASCADE): recalcularlos
+    previos = list(
+        ProductoRelacionado.objects.filter(relacionado_id=instance.pk).values_list('producto_id', flat=True)
+    )
+    if previos:
+        transaction.on_commit(lambda: related_products.refresh_products(previos))
+
+
+@receiver(post_save, sender=Categoria)
+def _categoria_relacionados(sender, instance, created=False, raw=False, **kwargs):
+    if raw or created:
+        return
+    pk = instance.pk
+    transaction.on_commit(lambda: related_products.refresh_for_categories([pk]))
+
+
+@receiver(post_delete, sender=Categoria)
+def _categoria_relacionados_borrado(sender, instance, **kwargs):
+    transaction.on_commit(related_products.rebuild_all)
+
+
+@receiver(m2m_changed, sender=Categoria.categorias_relacionadas.through)
+def _categorias_relacionadas_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    # En el lado inverso `instance` es el destino: las categorías origen vienen en pk_set
+    origen = list(pk_set or ()) if reverse else [instance.pk]
+    if reverse and action == 'post_clear':
+        transaction.on_commit(related_products.rebuild_all)
+        return
+    transaction.on_commit(lambda: related_products.refresh_category_links(origen))
+
+
+# ================= Snapshot global del sitio (context processors) =================
+SITE_MODELS = (ConfiguracionSitio, ConfiguracionRuleta, PremioRuleta, ConfiguracionChatbot, Pagina, Banner)
+
+
+def _bump_site():
+    bump_version(SITIO)
+
+
+def _site_changed(sender, raw=False, **kwargs):
+    if raw:
+        return
+    transaction.on_commit(_bump_site)
+
+
+for _model in SITE_MODELS:
+    post_save.connect(_site_changed, sender=_model, dispatch_uid=f'site_snapshot_save_{_model.__name__}')
+    post_delete.connect(_site_changed, sender=_model, dispatch_uid=f'site_snapshot_delete_{_model.__name__}')
+m2m_changed.connect(_site_changed, sender=Banner.productos_destacados.through, dispatch_uid='site_snapshot_banner_productos')
+
+
+@receiver(post_migrate)
+def _ensure_search_triggers(sender, using='default', **kwargs):
+    # Alterar mi_app_producto en SQLite recrea la tabla y elimina los triggers FTS5.
+    if getattr(sender, 'name', None) == 'mi_app':
+        search.ensure_sqlite_triggers(using)
+
+
+@receiver(connection_created)
+def _set_trigram_threshold(sender, connection, **kwargs):
+    # Umbral de `<%` (pg_trgm) alineado con el índice en memoria
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('pg_trgm.word_similarity_threshold', %s, false)",
+                [str(autocomplete.SIMILARITY_THRESHOLD)],
+            )
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL, dispatch_uid='mi_app_release_user_reservations')
+def _release_user_reservations(sender, instance, **kwargs):
+    # El CASCADE de ReservaStock.user no descontaría ColorVariante.stock_reservado
+    reservations.release_owner(user=instance)
+
+
+@receiver(user_logged_in, dispatch_uid='mi_app_merge_session_cart')
+def merge_session_cart(sender, user, request, **kwargs):
+    """Fusiona el carrito de sesión con el persistente (ver cart.Cart.merge_on_login)."""
+    if request is None:
+        return
+    try:
+        cart.on_login(request, user)
+    except Exception:
+        # No bloquear login en caso de error de fusión
+        logger.exception("No se pudo fusionar el carrito de sesión al iniciar sesión")
@@ -37,6 +37,7 @@ urlpatterns = [
 
     # Ruta para el asistente de IA
     path('get-ai-response/', views.get_ai_response, name='get_ai_response'),
+    path('get-ai-response/stream/', views.get_ai_response_stream, name='get_ai_response_stream'),
     path('ai/status/', views.ai_status, name='ai_status'),
 
     # --- INICIO DE LA MEJORA: URL para la Ruleta de la Suerte ---
@@ -55,6 +56,7 @@ urlpatterns = [
     
     # === INICIO DE LA MEJORA: Rutas para el panel del cliente ===
     path('mi-cuenta/', views.mi_cuenta, name='mi_cuenta'),
+    path('mi-cuenta/pedidos/', views.mi_cuenta_pedidos, name='mi_cuenta_pedidos'),
     path('mi-cuenta/eliminar/', views.eliminar_cuenta_view, name='eliminar_cuenta'),
     # === FIN DE LA MEJORA ===
     
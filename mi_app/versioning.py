@@ -0,0 +1,55 @@
+# mi_app/versioning.py
+"""Contadores de versión en el cache para invalidar datos derivados.
+
+Las claves cacheadas incluyen la versión de su espacio ('catalogo', ...);
+al cambiar los datos de origen basta con incrementarla (bump_version) y las
+entradas anteriores dejan de leerse y expiran solas. Si el contador se
+pierde (cache vacío o clave expulsada) se reinicia con la hora actual en
+segundos, siempre mayor que cualquier versión anterior, para no volver a leer
+entradas viejas que sigan en el cache.
+"""
+import time
+
+from django.core.cache import cache
+
+CATALOGO = 'catalogo'
+SITIO = 'sitio'
+
+_KEY = 'fi:version:{}'
+
+
+def _seed():
+    return int(time.time())
+
+
+def get_version(namespace):
+    key = _KEY.format(namespace)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _seed(), None)
+        version = cache.get(key) or _seed()
+    return version
+
+
+def bump_version(namespace):
+    key = _KEY.format(namespace)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # La clave no existía (cache vacío o expulsada)
+        version = _seed()
+        cache.set(key, version, None)
+        return version
+
+
+def versions_token(*namespaces):
+    """Versiones actuales de varios espacios en una sola lectura (p.ej. 'sitio3-catalogo7')."""
+    keys = [_KEY.format(ns) for ns in namespaces]
+    found = cache.get_many(keys)
+    parts = []
+    for ns, key in zip(namespaces, keys):
+        version = found.get(key)
+        if version is None:
+            version = get_version(ns)
+        parts.append(f'{ns}{version}')
+    return '-'.join(parts)
@@ -1,15 +1,14 @@
 import json
 import os
-import time
-import random
 import logging
-import requests
 import re
 from difflib import SequenceMatcher
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST, require_GET
 from django.core.cache import cache
 from ..models import Producto, ConfiguracionSitio, ApiKey, ConfiguracionChatbot
+from .. import chat_cache, key_pool, llm_gateway, sampling
 
 logger = logging.getLogger(__name__)
 
@@ -53,19 +52,30 @@ def _rate_limit_exceeded(request):
     return False
 
 def _get_api_keys(provider: str):
+    # El orden de uso lo decide key_pool (salud de cada clave), no el azar
     cache_key = f'api_keys_{provider}'
     cached_keys = cache.get(cache_key)
     if cached_keys is not None:
-        random.shuffle(cached_keys)
         return cached_keys
     keys_qs = ApiKey.objects.filter(activa=True, provider=provider).values_list('key', flat=True)
     api_keys = list(keys_qs)
     cache.set(cache_key, api_keys, 60)
     if not api_keys:
         logger.error(f"No se encontraron claves activas para proveedor {provider}.")
-    random.shuffle(api_keys)
     return api_keys
 
+def _gemini_resolutions():
+    """{clave: (modelo pedido, modelo, endpoint, systemInstruction)} guardado por check_ai_keys."""
+    cache_key = 'api_keys_gemini_resolucion'
+    resolutions = cache.get(cache_key)
+    if resolutions is None:
+        rows = ApiKey.objects.filter(activa=True, provider='gemini').exclude(gemini_modelo='').values_list(
+            'key', 'gemini_modelo_pedido', 'gemini_modelo', 'gemini_endpoint', 'gemini_system_instruction'
+        )
+        resolutions = {key: tuple(rest) for key, *rest in rows}
+        cache.set(cache_key, resolutions, 60)
+    return resolutions
+
 def _trim_history(chat_history, max_chars=MAX_HISTORY_CHARS):
     try:
         s = json.dumps(chat_history, ensure_ascii=False)
@@ -97,10 +107,9 @@ def _build_prompt_context(user_query=None):
         productos = base_productos_qs.filter(Q(nombre__icontains=user_query) | Q(categoria__nombre__icontains=user_query))[:6]
 
     if not user_query or not productos or not productos.exists():
-        try:
-            productos = base_productos_qs.order_by('-ventas')[:10]
-        except Exception:
-            productos = base_productos_qs.order_by('?')[:10]
+        # Producto no tiene campo 'ventas': muestra aleatoria desde los pools en memoria
+        ids = sampling.sample(sampling.get_pools().todos, 10)
+        productos = sampling.fetch_in_order(ids, base_productos_qs)
 
     catalogo = {}
     for p in productos:
@@ -144,12 +153,16 @@ BUY_INTENTS = {
     "si quiero", "sí quiero"
 }
 
+def _is_buy_intent(user_message):
+    msg = user_message.lower().strip()
+    return any(phrase in msg for phrase in BUY_INTENTS)
+
 def _postprocess_response(user_message, ai_text, history, context):
     msg = user_message.lower().strip()
     last_response = next((h.get("text", "") for h in reversed(history) if h.get("role") == "model"), "")
     tienda = context.get("info_tienda", {})
 
-    if any(phrase in msg for phrase in BUY_INTENTS):
+    if _is_buy_intent(msg):
         metodos_pago = tienda.get("metodos_pago", {})
         numero_yape = metodos_pago.get("numero_yape")
         numero_plin = metodos_pago.get("numero_plin")
@@ -214,134 +227,6 @@ def _postprocess_response(user_message, ai_text, history, context):
             
     return ai_text
 
-def _call_gemini_with_rotation(api_keys, payload, model_name):
-    """Llama a Gemini intentando modelo principal y variantes si devuelve 404.
-
-    Modelos alternativos comunes (dependen de disponibilidad regional / versión API):
-    - gemini-1.5-flash
-    - gemini-1.5-flash-001
-    - gemini-pro
-    - gemini-1.0-pro
-    """
-    candidate_models = [model_name]
-    # Normalizar: si termina en '-latest', agregar la versión sin sufijo y otras variantes
-    if model_name.endswith('-latest'):
-        base_name = model_name.rsplit('-latest', 1)[0]
-        candidate_models.append(base_name)
-        if '1.5-flash' in base_name:
-            candidate_models.append('gemini-1.5-flash')
-            candidate_models.append('gemini-1.5-flash-001')
-        candidate_models.extend(['gemini-pro', 'gemini-1.0-pro'])
-    else:
-        # Asegurar algunas alternativas genéricas si el nombre no tiene -latest
-        candidate_models.extend(['gemini-1.5-flash', 'gemini-pro'])
-
-    tried_models = set()
-    headers = {"Content-Type": "application/json"}
-    for current_model in candidate_models:
-        if current_model in tried_models:
-            continue
-        tried_models.add(current_model)
-        # Intentamos primero el endpoint v1beta y, si obtenemos 404 por modelo no encontrado,
-        # reintentamos inmediatamente con el mismo modelo usando el endpoint v1 antes de saltar a otro modelo.
-        base_endpoints = [
-            ("v1beta", f"https://generativelanguage.googleapis.com/v1beta/models/{current_model}:generateContent"),
-            ("v1", f"https://generativelanguage.googleapis.com/v1/models/{current_model}:generateContent"),
-        ]
-        for key in api_keys:
-            key_hash = key[-4:]
-            if cache.get(f"failed_api_key_{key_hash}"):
-                continue
-            attempted_variant_404 = False
-            for endpoint_label, base in base_endpoints:
-                url = f"{base}?key={key}"
-                try:
-                    # Usar siempre 'systemInstruction'. Si la API devuelve 400 por campo desconocido, reintentamos sin él.
-                    send_payload = payload
-                    r = requests.post(url, headers=headers, data=json.dumps(send_payload), timeout=25)
-                    if r.status_code == 200:
-                        j = r.json()
-                        text = j.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text")
-                        if text:
-                            if current_model != model_name:
-                                logger.info("Se utilizó modelo alternativo Gemini '%s' (endpoint %s) tras fallar '%s'", current_model, endpoint_label, model_name)
-                            else:
-                                logger.info("Modelo Gemini '%s' respondió ok via endpoint %s", current_model, endpoint_label)
-                            return text
-                        logger.warning("Respuesta OK pero sin texto (modelo %s endpoint %s) clave ...%s. Respuesta: %s", current_model, endpoint_label, key_hash, j)
-                        break  # No sentido probar el otro endpoint si 200 sin texto
-                    elif r.status_code == 404:
-                        logger.warning("Modelo Gemini '%s' no disponible (404) en endpoint %s con clave ...%s.", current_model, endpoint_label, key_hash)
-                        # Marcamos que este endpoint devolvió 404; si era v1beta seguimos a v1, si era v1 salimos a siguiente modelo
-                        attempted_variant_404 = True
-                        # Si era el segundo endpoint (v1), abandonamos esta clave e intentamos siguiente modelo
-                        if endpoint_label == "v1":
-                            break
-                        # Si era v1beta, continuará el loop para intentar v1
-                        continue
-                    elif r.status_code == 400:
-                        txt = r.text or ""
-                        low = txt.lower()
-                        if 'unknown name' in low and 'systeminstruction' in low:
-                            logger.warning("Endpoint %s rechaza systemInstruction; aplicando fallback embebiendo instrucciones en contents (modelo %s clave ...%s)", endpoint_label, current_model, key_hash)
-                            if 'systemInstruction' in send_payload:
-                                try:
-                                    sp2 = dict(send_payload)
-                                    sys_part = sp2.pop('systemInstruction', None)
-                                    # Embebemos el texto de instrucciones al inicio del primer mensaje 'user'
-                                    if sys_part and isinstance(sys_part, dict):
-                                        sys_text = ''
-                                        parts = sys_part.get('parts', [])
-                                        if parts and isinstance(parts, list):
-                                            sys_text = '\n'.join(p.get('text','') for p in parts if isinstance(p, dict))
-                                        contents = sp2.get('contents', [])
-                                        if contents and isinstance(contents, list):
-                                            # Insertar un nuevo mensaje inicial con las instrucciones para no contaminar el contexto original
-                                            instr_block = {"role": "user", "parts": [{"text": f"[INSTRUCCIONES DEL SISTEMA]\n{sys_text.strip()}"}]}
-                                            contents.insert(0, instr_block)
-                                    r2 = requests.post(url, headers=headers, data=json.dumps(sp2), timeout=25)
-                                    if r2.status_code == 200:
-                                        j2 = r2.json()
-                                        text2 = j2.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text")
-                                        if text2:
-                                            logger.info("Modelo %s respondió tras fallback sin systemInstruction en endpoint %s", current_model, endpoint_label)
-                                            return text2
-                                        logger.warning("Respuesta OK sin texto tras fallback sin systemInstruction (modelo %s endpoint %s) ...%s => %s", current_model, endpoint_label, key_hash, j2)
-                                        break
-                                    elif r2.status_code == 404:
-                                        logger.warning("Tras fallback sin systemInstruction, modelo %s da 404 endpoint %s (clave ...%s)", current_model, endpoint_label, key_hash)
-                                        attempted_variant_404 = True
-                                        if endpoint_label == 'v1':
-                                            break
-                                        continue
-                                    else:
-                                        logger.warning("Retry sin systemInstruction status %s (modelo %s endpoint %s) ...%s => %s", r2.status_code, current_model, endpoint_label, key_hash, r2.text)
-                                        if r2.status_code not in (400, 404):
-                                            cache.set(f"failed_api_key_{key_hash}", True, 60)
-                                        break
-                                except Exception as ie:
-                                    logger.exception("Error aplicando fallback sin systemInstruction: %s", ie)
-                                    break
-                        else:
-                            logger.warning("Status 400 distinto (modelo %s endpoint %s) ...%s => %s", current_model, endpoint_label, key_hash, txt)
-                            cache.set(f"failed_api_key_{key_hash}", True, 60)
-                            break
-                    else:
-                        logger.warning("Status %s (modelo %s endpoint %s) con clave ...%s. Respuesta: %s", r.status_code, current_model, endpoint_label, key_hash, r.text)
-                        cache.set(f"failed_api_key_{key_hash}", True, 60)
-                        break  # No insistir con segundo endpoint si error distinto a 404
-                except requests.exceptions.RequestException as e:
-                    logger.warning("Error de red Gemini (modelo %s endpoint %s) con clave ...%s: %s", current_model, endpoint_label, key_hash, e)
-                    cache.set(f"failed_api_key_{key_hash}", True, 60)
-                    break
-                finally:
-                    time.sleep(1)
-            # Si ambos endpoints devolvieron 404 para este modelo y clave, pasamos al siguiente modelo sin penalizar
-            if attempted_variant_404:
-                # Probar siguiente modelo (romper loop de claves para este modelo)
-                break
-    return None
-
 
 # ================= Status Endpoint =================
 @require_GET
@@ -351,20 +236,14 @@ def ai_status(request):
     Incluye:
     - proveedor activo según toggles
     - modelo Gemini configurado y último válido persistido
+    - claves Gemini con resolución (modelo/endpoint) vigente para el modelo pedido
     - modelo OpenAI configurado
     - cantidad de claves activas por proveedor
+    - pool de claves (key_pool): circuito, salud por clave (por hash) y por modelo
     """
     try:
         cfg = ConfiguracionChatbot.get_solo()
-        # Replicar lógica de selección de proveedor
-        if getattr(cfg, 'use_chatgpt', False) and not getattr(cfg, 'use_gemini', False):
-            provider = 'chatgpt'
-        elif getattr(cfg, 'use_gemini', True) and not getattr(cfg, 'use_chatgpt', False):
-            provider = 'gemini'
-        elif getattr(cfg, 'use_chatgpt', False) and getattr(cfg, 'use_gemini', False):
-            provider = cfg.chat_provider or 'gemini'
-        else:
-            provider = cfg.chat_provider or 'gemini'
+        provider = _select_provider(cfg)
 
         data = {
             "activo": cfg.activo,
@@ -374,11 +253,14 @@ def ai_status(request):
                 "last_valid_model": getattr(cfg, 'last_valid_gemini_model', ''),
                 "env_override": os.environ.get("GEMINI_MODEL") or None,
                 "claves_activas": ApiKey.objects.filter(provider='gemini', activa=True).count(),
+                "claves_resueltas": sum(1 for r in _gemini_resolutions().values() if r[0] == _gemini_model(cfg)),
+                "pool": key_pool.snapshot('gemini', _get_api_keys('gemini')),
             },
             "chatgpt": {
                 "modelo_configurado": cfg.openai_model_name,
                 "env_override": os.environ.get("OPENAI_MODEL") or None,
                 "claves_activas": ApiKey.objects.filter(provider='chatgpt', activa=True).count(),
+                "pool": key_pool.snapshot('chatgpt', _get_api_keys('chatgpt')),
             },
         }
         return JsonResponse(data)
@@ -388,214 +270,279 @@ def ai_status(request):
         logger.exception("Error en ai_status: %s", e)
         return JsonResponse({"error": "Error interno"}, status=500)
 
-def _call_openai_with_rotation(api_keys, messages, model_name, temperature: float):
-    """Llama a la API de OpenAI (Chat Completions) con rotación de claves simples.
 
-    Se evita instalar el paquete oficial para mantener dependencias ligeras; se usa requests.
+# ================= View =================
+def _select_provider(cfg):
+    """Proveedor según los toggles nuevos (exclusivos) con fallback al campo legacy."""
+    if getattr(cfg, 'use_chatgpt', False) and not getattr(cfg, 'use_gemini', False):
+        return 'chatgpt'
+    if getattr(cfg, 'use_gemini', True) and not getattr(cfg, 'use_chatgpt', False):
+        return 'gemini'
+    # Ambos activos (no debería tras save) o ninguno: campo legacy
+    return cfg.chat_provider or 'gemini'
+
+
+def _gemini_model(cfg):
+    # Modelo pedido; el que responde con cada clave lo resuelve check_ai_keys (ApiKey.gemini_modelo)
+    return os.environ.get("GEMINI_MODEL") or cfg.gemini_model_name or GEMINI_FALLBACK_MODEL
+
+
+def _gemini_payload(chat):
+    return {
+        "contents": chat["contents"],
+        "systemInstruction": {"parts": [{"text": chat["system_instructions"]}]},
+        "generationConfig": {
+            **DEFAULT_GENERATION_CONFIG,
+            "temperature": chat["temperature"],
+        },
+        "safetySettings": SAFETY_SETTINGS,
+    }
+
+
+def _openai_messages(chat):
+    messages = [{"role": "system", "content": chat["system_instructions"]}]
+    for c in chat["contents"]:
+        parts = c.get("parts", [])
+        text = parts[0].get("text") if parts else ""
+        messages.append({"role": "assistant" if c.get("role") == "model" else "user", "content": text})
+    return messages
+
+
+def _whatsapp_fallback_text(intro):
+    config = ConfiguracionSitio.get_solo()
+    try:
+        prefill = config.whatsapp_prefill_chatbot_resolved
+    except Exception:
+        prefill = ''
+    wa_link = config.whatsapp_link
+    if prefill:
+        from urllib.parse import quote
+        wa_link = f"{wa_link}?text={quote(prefill)}"
+    # Hacemos el enlace clicable. Si el frontend escapa HTML, podría mostrarse literal; de ser así
+    # se podrá ajustar a markdown posteriormente. Por ahora asumimos render seguro.
+    fallback_message = (
+        f"{intro}<br>"
+        f"<a href=\"{wa_link}\" target=\"_blank\" rel=\"noopener\" class=\"fi-wa-fallback-link\">"
+        "<span class=\"fi-wa-badge\"><i class=\"fab fa-whatsapp\" aria-hidden=\"true\"></i> Enviar a WhatsApp</span>"
+        "</a>"
+    )
+    return fallback_message
+
+
+def _prepare_chat(request):
+    """Parte síncrona previa a la llamada (configuración, límites, claves y contexto con ORM).
+
+    Devuelve un dict con todo lo necesario para el gateway o un JsonResponse si hay que cortar.
     """
-    url = "https://api.openai.com/v1/chat/completions"
-    for key in api_keys:
-        key_hash = key[-4:]
-        if cache.get(f"failed_api_key_{key_hash}"):
-            continue
-        headers = {
-            "Authorization": f"Bearer {key}",
-            "Content-Type": "application/json",
-        }
-        body = {
-            "model": model_name,
-            "messages": messages,
-            "temperature": max(0.0, min(1.0, temperature)),
-            "max_tokens": 800,
-        }
-        try:
-            r = requests.post(url, headers=headers, data=json.dumps(body), timeout=25)
-            if r.status_code == 200:
-                j = r.json()
-                choices = j.get("choices", [])
-                if choices:
-                    content = choices[0].get("message", {}).get("content")
-                    if content:
-                        return content
-                logger.warning("Respuesta OpenAI OK sin contenido con clave ...%s: %s", key_hash, j)
-            elif r.status_code == 429:
-                logger.warning("Cuota excedida (429) con clave ...%s. Activando fallback si procede.", key_hash)
-                cache.set(f"failed_api_key_{key_hash}", True, 300)  # penalizar más tiempo
-            else:
-                logger.warning("Status OpenAI %s con clave ...%s. Respuesta: %s", r.status_code, key_hash, r.text)
-                cache.set(f"failed_api_key_{key_hash}", True, 120)
-        except requests.exceptions.RequestException as e:
-            logger.warning("Error de red OpenAI con clave ...%s: %s", key_hash, e)
-            cache.set(f"failed_api_key_{key_hash}", True, 60)
-        time.sleep(1)
-    return None
+    chatbot_config = ConfiguracionChatbot.get_solo()
+    if not chatbot_config.activo:
+        return JsonResponse({"response": "Lo siento, mi asistente virtual Fanty no está disponible en este momento."}, status=503)
+
+    if _rate_limit_exceeded(request):
+        return JsonResponse({"response": "Muchos mensajes. Inténtalo en unos minutos."}, status=429)
+
+    data = json.loads(request.body or "{}")
+    user_message = (data.get("message") or "").strip()
+    chat_history = data.get("history", [])
+    if not user_message:
+        return JsonResponse({"response": "Escribe un mensaje."}, status=400)
+
+    provider = _select_provider(chatbot_config)
+    if provider not in ('gemini', 'chatgpt'):
+        return JsonResponse({"response": f"Proveedor '{provider}' no soportado."}, status=500)
+    api_keys = _get_api_keys(provider)
+    if not api_keys:
+        return JsonResponse({"response": f"El asistente de IA no está configurado para {provider}."}, status=503)
+
+    user_name = None
+    if request.user.is_authenticated:
+        user_name = request.user.first_name or request.user.username
+
+    context = _build_prompt_context(user_message)
+    trimmed_history = _trim_history(chat_history)
+
+    contents = []
+    contents.append({"role": "user", "parts": [{"text": f"CONTEXTO DE LA TIENDA:\n{json.dumps(context, ensure_ascii=False)}"}]})
+    contents.append({"role": "model", "parts": [{"text": "¡Entendido! Estoy lista para ayudar como Fanty."}]})
+    for entry in trimmed_history:
+        role = "user" if entry.get("role") == "user" else "model"
+        contents.append({"role": role, "parts": [{"text": entry.get("text", "")}]})
+    contents.append({"role": "user", "parts": [{"text": user_message}]})
+
+    system_instructions = get_system_instructions(user_name=user_name)
+    cache_bucket = chat_cache.bucket(system_instructions, trimmed_history)
+    # La intención de compra se responde sin modelo (_finish_text): no pasa por el cache
+    cached_response = None if _is_buy_intent(user_message) else chat_cache.lookup(user_message, cache_bucket)
+    if cached_response is not None:
+        logger.info("Respuesta del chatbot servida desde el cache")
+
+    return {
+        "config": chatbot_config,
+        "provider": provider,
+        "api_keys": api_keys,
+        # Fallback resiliente: si ChatGPT falla y hay claves Gemini, se intenta aunque use_gemini esté False
+        "gemini_fallback_keys": _get_api_keys('gemini') if provider == 'chatgpt' else [],
+        "gemini_resolutions": _gemini_resolutions(),
+        "user_message": user_message,
+        "history": trimmed_history,
+        "context": context,
+        "contents": contents,
+        "system_instructions": system_instructions,
+        "temperature": chatbot_config.temperature or DEFAULT_GENERATION_CONFIG["temperature"],
+        "cache_bucket": cache_bucket,
+        "cached_response": cached_response,
+    }
 
-# ================= View =================
-@require_POST
-def get_ai_response(request):
+
+async def _generate(chat, deadline):
+    """Llama al proveedor (y al fallback) sin bloquear. Devuelve el texto o None."""
+    cfg = chat["config"]
+    if chat["provider"] == 'gemini':
+        return await llm_gateway.call_gemini(
+            chat["api_keys"], _gemini_payload(chat), _gemini_model(cfg), deadline, chat["gemini_resolutions"]
+        )
+
+    model_name = os.environ.get("OPENAI_MODEL") or cfg.openai_model_name or "gpt-4o-mini"
+    text = await llm_gateway.call_openai(chat["api_keys"], _openai_messages(chat), model_name, chat["temperature"], deadline)
+    if text or not chat["gemini_fallback_keys"] or deadline.expired:
+        return text
+    logger.info("Fallback resiliente a Gemini (ChatGPT falló y hay claves Gemini disponibles aunque use_gemini=%s)", getattr(cfg, 'use_gemini', None))
+    return await llm_gateway.call_gemini(
+        chat["gemini_fallback_keys"], _gemini_payload(chat), _gemini_model(cfg), deadline, chat["gemini_resolutions"]
+    )
+
+
+def _finish_text(chat, ai_text, complete=True):
+    """Parte síncrona posterior: post-procesa la respuesta. Devuelve (texto, status).
+
+    complete=False (stream cortado a mitad) responde con lo recibido pero no lo cachea.
+    """
+    # La intención de compra se responde igual aunque el modelo no haya contestado
+    if ai_text or _is_buy_intent(chat["user_message"]):
+        ai_text = ai_text or ""
+        processed_ai_text = _postprocess_response(chat["user_message"], ai_text, chat["history"], chat["context"])
+        if ai_text != processed_ai_text:
+            logger.info(f"Post-procesador corrigió la respuesta. Original: '{ai_text}', Corregida: '{processed_ai_text}'")
+        if ai_text and complete and not _is_buy_intent(chat["user_message"]):
+            chat_cache.store(chat["user_message"], chat["cache_bucket"], processed_ai_text)
+        return processed_ai_text, 200
+
+    logger.error("Todas las claves fallaron o sin respuesta válida.")
+    return _whatsapp_fallback_text("Estoy con problemitas técnicos 😅. Escríbeme directo a WhatsApp:"), 503
+
+
+def _finish_chat(chat, ai_text):
+    text, status = _finish_text(chat, ai_text)
+    return JsonResponse({"response": text}, status=status)
+
+
+def _unexpected_error_text():
     try:
-        chatbot_config = ConfiguracionChatbot.get_solo()
-        if not chatbot_config.activo:
-            return JsonResponse({"response": "Lo siento, mi asistente virtual Fanty no está disponible en este momento."}, status=503)
-
-        if _rate_limit_exceeded(request):
-            return JsonResponse({"response": "Muchos mensajes. Inténtalo en unos minutos."}, status=429)
-
-        data = json.loads(request.body or "{}")
-        user_message = (data.get("message") or "").strip()
-        chat_history = data.get("history", [])
-        if not user_message:
-            return JsonResponse({"response": "Escribe un mensaje."}, status=400)
-
-        # Determinar proveedor según toggles nuevos (exclusivos) con fallback legacy
-        if getattr(chatbot_config, 'use_chatgpt', False) and not getattr(chatbot_config, 'use_gemini', False):
-            provider = 'chatgpt'
-        elif getattr(chatbot_config, 'use_gemini', True) and not getattr(chatbot_config, 'use_chatgpt', False):
-            provider = 'gemini'
-        elif getattr(chatbot_config, 'use_chatgpt', False) and getattr(chatbot_config, 'use_gemini', False):
-            # Si por alguna razón ambos están activos (no debería tras save), usamos el campo legacy
-            provider = chatbot_config.chat_provider or 'gemini'
-        else:
-            provider = chatbot_config.chat_provider or 'gemini'
-        api_keys = _get_api_keys(provider)
-        if not api_keys:
-            return JsonResponse({"response": f"El asistente de IA no está configurado para {provider}."}, status=503)
+        return _whatsapp_fallback_text("Ocurrió un error inesperado, ¡pero no te preocupes! Escríbeme directo a WhatsApp:"), 500
+    except ConfiguracionSitio.DoesNotExist:
+        return "Ocurrió un error inesperado y no se pudo cargar la configuración de contacto.", 500
 
-        user_name = None
-        if request.user.is_authenticated:
-            user_name = request.user.first_name or request.user.username
 
-        context = _build_prompt_context(user_message)
-        trimmed_history = _trim_history(chat_history)
-        
-        system_instructions = get_system_instructions(user_name=user_name)
-        
-        contents = []
-        contents.append({"role": "user", "parts": [{"text": f"CONTEXTO DE LA TIENDA:\n{json.dumps(context, ensure_ascii=False)}"}]})
-        contents.append({"role": "model", "parts": [{"text": "¡Entendido! Estoy lista para ayudar como Fanty."}]})
+def _unexpected_error_response():
+    text, status = _unexpected_error_text()
+    return JsonResponse({"response": text}, status=status)
 
-        for entry in trimmed_history:
-            role = "user" if entry.get("role") == "user" else "model"
-            contents.append({"role": role, "parts": [{"text": entry.get("text", "")}]})
-        
-        contents.append({"role": "user", "parts": [{"text": user_message}]})
-        
-        # Selección de proveedor
-        temperature = chatbot_config.temperature or DEFAULT_GENERATION_CONFIG["temperature"]
-        ai_text = None
-        if provider == 'gemini':
-            # Priorizar último modelo válido persistido
-            model_name = (
-                os.environ.get("GEMINI_MODEL")
-                or (chatbot_config.last_valid_gemini_model.strip() if getattr(chatbot_config, 'last_valid_gemini_model', '') else None)
-                or chatbot_config.gemini_model_name
-                or GEMINI_FALLBACK_MODEL
-            )
-            payload = {
-                "contents": contents,
-                "systemInstruction": {"parts": [{"text": system_instructions}]},
-                "generationConfig": {
-                    **DEFAULT_GENERATION_CONFIG,
-                    "temperature": temperature,
-                },
-                "safetySettings": SAFETY_SETTINGS,
-            }
-            ai_text = _call_gemini_with_rotation(api_keys, payload, model_name)
-            # Si funcionó y el modelo usado difiere del persistido, actualizar singleton
-            if ai_text and model_name != getattr(chatbot_config, 'last_valid_gemini_model', ''):
-                try:
-                    chatbot_config.last_valid_gemini_model = model_name
-                    chatbot_config.save(update_fields=["last_valid_gemini_model"])
-                except Exception:
-                    logger.exception("No se pudo actualizar last_valid_gemini_model a '%s'", model_name)
-        elif provider == 'chatgpt':
-            model_name = os.environ.get("OPENAI_MODEL") or chatbot_config.openai_model_name or "gpt-4o-mini"
-            # Convertir a formato messages
-            messages = []
-            messages.append({"role": "system", "content": system_instructions})
-            for c in contents:
-                role = c.get("role")
-                parts = c.get("parts", [])
-                text = parts[0].get("text") if parts else ""
-                if role in ("user", "model"):
-                    mapped_role = "assistant" if role == "model" else "user"
-                    messages.append({"role": mapped_role, "content": text})
-            ai_text = _call_openai_with_rotation(api_keys, messages, model_name, temperature)
-            if not ai_text:
-                # Fallback automático: si hay claves Gemini, intentamos aunque use_gemini esté False (modo resiliencia)
-                try:
-                    gemini_keys = _get_api_keys('gemini')
-                    if gemini_keys:
-                        logger.info("Fallback resiliente a Gemini (ChatGPT falló y hay claves Gemini disponibles aunque use_gemini=%s)", getattr(chatbot_config,'use_gemini',None))
-                        model_name_gemini = os.environ.get("GEMINI_MODEL") or chatbot_config.gemini_model_name or GEMINI_FALLBACK_MODEL
-                        payload = {
-                            "contents": contents,
-                            "systemInstruction": {"parts": [{"text": system_instructions}]},
-                            "generationConfig": {
-                                **DEFAULT_GENERATION_CONFIG,
-                                "temperature": temperature,
-                            },
-                            "safetySettings": SAFETY_SETTINGS,
-                        }
-                        ai_text = _call_gemini_with_rotation(gemini_keys, payload, model_name_gemini)
-                        if ai_text and model_name_gemini != getattr(chatbot_config, 'last_valid_gemini_model', ''):
-                            try:
-                                chatbot_config.last_valid_gemini_model = model_name_gemini
-                                chatbot_config.save(update_fields=["last_valid_gemini_model"])
-                            except Exception:
-                                logger.exception("No se pudo actualizar last_valid_gemini_model en fallback a '%s'", model_name_gemini)
-                except Exception:
-                    logger.exception("Error realizando fallback resiliente a Gemini")
-        else:
-            return JsonResponse({"response": f"Proveedor '{provider}' no soportado."}, status=500)
-        if ai_text:
-            original_ai_text = ai_text
-            processed_ai_text = _postprocess_response(user_message, original_ai_text, trimmed_history, context)
-            if original_ai_text != processed_ai_text:
-                logger.info(f"Post-procesador corrigió la respuesta. Original: '{original_ai_text}', Corregida: '{processed_ai_text}'")
-            return JsonResponse({"response": processed_ai_text})
-
-        logger.error("Todas las claves fallaron o sin respuesta válida.")
-        config = ConfiguracionSitio.get_solo()
-        try:
-            prefill = config.whatsapp_prefill_chatbot_resolved
-        except Exception:
-            prefill = ''
-        wa_link = config.whatsapp_link
-        if prefill:
-            from urllib.parse import quote
-            wa_link = f"{wa_link}?text={quote(prefill)}"
-        # Hacemos el enlace clicable. Si el frontend escapa HTML, podría mostrarse literal; de ser así
-        # se podrá ajustar a markdown posteriormente. Por ahora asumimos render seguro.
-        fallback_message = (
-            "Estoy con problemitas técnicos 😅. Escríbeme directo a WhatsApp:<br>"
-            f"<a href=\"{wa_link}\" target=\"_blank\" rel=\"noopener\" class=\"fi-wa-fallback-link\">"
-            "<span class=\"fi-wa-badge\"><i class=\"fab fa-whatsapp\" aria-hidden=\"true\"></i> Enviar a WhatsApp</span>"
-            "</a>"
-        )
-        return JsonResponse({"response": fallback_message}, status=503)
 
+@require_POST
+async def get_ai_response(request):
+    """Vista asíncrona: el ORM va en sync_to_async y la espera a la API no ocupa un worker.
+
+    Todo el mensaje (rotación de claves y modelos incluida) respeta el plazo de
+    llm_gateway.REQUEST_DEADLINE.
+    """
+    try:
+        chat = await sync_to_async(_prepare_chat)(request)
+        if isinstance(chat, JsonResponse):
+            return chat
+        if chat["cached_response"] is not None:
+            return JsonResponse({"response": chat["cached_response"]})
+        ai_text = await _generate(chat, llm_gateway.Deadline())
+        return await sync_to_async(_finish_chat)(chat, ai_text)
     except (ConfiguracionSitio.DoesNotExist, ConfiguracionChatbot.DoesNotExist):
         logger.exception("Configuración de sitio o chatbot no establecida.")
         return JsonResponse({"response": "Configura la tienda y el chatbot antes de usar el asistente."}, status=500)
     except Exception as e:
         logger.exception("Error inesperado en get_ai_response: %s", e)
-        try:
-            config = ConfiguracionSitio.get_solo()
+        return await sync_to_async(_unexpected_error_response)()
+
+
+# ================= Streaming (SSE) =================
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _stream_chunks(chat, deadline):
+    """Fragmentos del proveedor (y del fallback a Gemini)."""
+    cfg = chat["config"]
+    if chat["provider"] == 'chatgpt':
+        model_name = os.environ.get("OPENAI_MODEL") or cfg.openai_model_name or "gpt-4o-mini"
+        produced = False
+        async for text in llm_gateway.stream_openai(chat["api_keys"], _openai_messages(chat), model_name, chat["temperature"], deadline):
+            produced = True
+            yield text
+        if produced or not chat["gemini_fallback_keys"] or deadline.expired:
+            return
+        logger.info("Fallback resiliente a Gemini en streaming (ChatGPT falló y hay claves Gemini disponibles)")
+        keys = chat["gemini_fallback_keys"]
+    else:
+        keys = chat["api_keys"]
+    async for text in llm_gateway.stream_gemini(keys, _gemini_payload(chat), _gemini_model(cfg), deadline, chat["gemini_resolutions"]):
+        yield text
+
+
+async def _chat_events(chat):
+    """Eventos SSE: `token` por fragmento y un `done` final con la respuesta post-procesada.
+
+    El cliente pinta los tokens al llegar y reemplaza la burbuja con `done`, que
+    incluye las correcciones de _postprocess_response (SKU inventado, bucle,
+    intención de compra). Con intención de compra la respuesta no depende del
+    modelo, así que se envía `done` sin llamarlo; lo mismo con una respuesta
+    del cache (chat_cache).
+    """
+    if chat["cached_response"] is not None:
+        yield _sse("done", {"response": chat["cached_response"], "status": 200})
+        return
+    chunks = []
+    complete = True
+    try:
+        if not _is_buy_intent(chat["user_message"]):
             try:
-                prefill = config.whatsapp_prefill_chatbot_resolved
-            except Exception:
-                prefill = ''
-            wa_link = config.whatsapp_link
-            if prefill:
-                from urllib.parse import quote
-                wa_link = f"{wa_link}?text={quote(prefill)}"
-            fallback_message = (
-                "Ocurrió un error inesperado, ¡pero no te preocupes! Escríbeme directo a WhatsApp:<br>"
-                f"<a href=\"{wa_link}\" target=\"_blank\" rel=\"noopener\" class=\"fi-wa-fallback-link\">"
-                "<span class=\"fi-wa-badge\"><i class=\"fab fa-whatsapp\" aria-hidden=\"true\"></i> Enviar a WhatsApp</span>"
-                "</a>"
-            )
-            return JsonResponse({"response": fallback_message}, status=500)
-        except ConfiguracionSitio.DoesNotExist:
-            return JsonResponse({"response": "Ocurrió un error inesperado y no se pudo cargar la configuración de contacto."}, status=500)
\ No newline at end of file
+                async for text in _stream_chunks(chat, llm_gateway.Deadline()):
+                    chunks.append(text)
+                    yield _sse("token", {"text": text})
+            except llm_gateway.StreamInterrupted:
+                complete = False
+        text, status = await sync_to_async(_finish_text)(chat, "".join(chunks) or None, complete)
+    except Exception as e:
+        logger.exception("Error inesperado en get_ai_response_stream: %s", e)
+        text, status = await sync_to_async(_unexpected_error_text)()
+    yield _sse("done", {"response": text, "status": status})
+
+
+@require_POST
+async def get_ai_response_stream(request):
+    """Variante en streaming de get_ai_response (Server-Sent Events sobre POST).
+
+    Los cortes previos (chatbot inactivo, límite de mensajes, sin claves) se
+    responden en JSON igual que la vista normal.
+    """
+    try:
+        chat = await sync_to_async(_prepare_chat)(request)
+    except (ConfiguracionSitio.DoesNotExist, ConfiguracionChatbot.DoesNotExist):
+        logger.exception("Configuración de sitio o chatbot no establecida.")
+        return JsonResponse({"response": "Configura la tienda y el chatbot antes de usar el asistente."}, status=500)
+    except Exception as e:
+        logger.exception("Error inesperado en get_ai_response_stream: %s", e)
+        return await sync_to_async(_unexpected_error_response)()
+    if isinstance(chat, JsonResponse):
+        return chat
+    response = StreamingHttpResponse(_chat_events(chat), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Que un proxy intermedio (nginx) no acumule los eventos
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -7,9 +7,16 @@ from django.utils.http import urlsafe_base64_decode
 from django.utils.encoding import force_str
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.auth import get_user_model
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.formats import date_format
+from urllib.parse import urlencode
 
 from ..models import PedidoWhatsApp, Direccion, ConfiguracionSitio
 from ..forms import RegistroForm, UserUpdateForm, DireccionForm
+from ..context_processors import get_site_snapshot
+from ..pagination import keyset_page
 
 User = get_user_model()
 
@@ -141,15 +148,17 @@ def mi_cuenta(request):
                 messages.error(request, 'No se pudo encontrar la dirección para eliminar.')
             return redirect('mi_cuenta')
 
-    pedidos = PedidoWhatsApp.objects.filter(user=request.user).order_by('-fecha_creacion')
+    # Solo la primera página del historial; el resto se carga bajo demanda (mi_cuenta_pedidos)
+    pedidos, pedidos_next_url = _pedidos_page(request, cursor=None)
     direcciones = Direccion.objects.filter(user=request.user).order_by('-predeterminada', 'alias')
 
     active_tab = request.GET.get('tab') or 'perfil'
     active_tab_color = 'var(--brand-primary)' if active_tab == 'perfil' else '#fff'
 
-    site_config = ConfiguracionSitio.objects.first()
+    site_config = get_site_snapshot(request)['configuracion_sitio']
     context = {
         'pedidos': pedidos,
+        'pedidos_next_url': pedidos_next_url,
         'direcciones': direcciones,
         'profile_form': profile_form,
         'address_form': address_form,
@@ -160,6 +169,55 @@ def mi_cuenta(request):
     return render(request, 'mi_app/mi_cuenta.html', context)
 
 
+PEDIDOS_POR_PAGINA = 10
+_PEDIDOS_KEYS = [('fecha_creacion', 'fecha_creacion', True), ('pk', 'pk', True)]
+
+
+def _pedidos_page(request, cursor):
+    """Página del historial por cursor (-fecha_creacion, -pk). Devuelve (página, url_siguiente)."""
+    pedidos = (
+        PedidoWhatsApp.objects.filter(user=request.user)
+        .prefetch_related('detalles')
+        .order_by('-fecha_creacion', '-pk')
+    )
+    page = keyset_page(pedidos, 'pedidos', cursor, per_page=PEDIDOS_POR_PAGINA, keys=_PEDIDOS_KEYS)
+    next_url = None
+    if page.has_next:
+        next_url = f"{reverse('mi_cuenta_pedidos')}?{urlencode({'cursor': page.next_cursor})}"
+    return page, next_url
+
+
+def _pedido_json(pedido):
+    return {
+        'id': str(pedido.pk),
+        'codigo': pedido.codigo_pedido,
+        'fecha': timezone.localtime(pedido.fecha_creacion).isoformat(),
+        'fecha_texto': date_format(timezone.localtime(pedido.fecha_creacion), r'd \d\e F, Y'),
+        'total': str(pedido.total),
+        'subtotal': str(pedido.subtotal),
+        'costo_envio': str(pedido.costo_envio),
+        'item_count': pedido.item_count,
+        'url': reverse('resumen_pedido_whatsapp', args=[pedido.pk]),
+        'detalles': [
+            {
+                'producto': d.producto_nombre,
+                'color': d.variante_color,
+                'cantidad': d.cantidad,
+                'precio_unitario': str(d.precio_unitario),
+                'imagen_url': d.imagen_url,
+            }
+            for d in pedido.detalles.all()
+        ],
+    }
+
+
+@login_required(login_url='/login/')
+def mi_cuenta_pedidos(request):
+    """Historial de pedidos en JSON, paginado por cursor (?cursor=...)."""
+    page, next_url = _pedidos_page(request, request.GET.get('cursor'))
+    return JsonResponse({'pedidos': [_pedido_json(p) for p in page], 'next': next_url})
+
+
 # === INICIO DE LA MEJORA: Vista para eliminar la cuenta ===
 @login_required
 def eliminar_cuenta_view(request):
@@ -2,28 +2,35 @@ from django.shortcuts import render, get_object_or_404
 from django.http import JsonResponse
 from django.urls import reverse
 import logging
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.db.models import Q, DecimalField, F
-from django.db.models.functions import Coalesce
 from decimal import Decimal, InvalidOperation
 from django.utils import timezone
 
 # Se añade el modelo Pagina a las importaciones
 from ..models import Producto, Categoria, Banner, Pagina, ColorVariante, ReservaStock
+from ..catalog_index import catalog_queryset, filter_catalog, order_catalog
+from ..search import search_queryset
+from ..pagination import paginate_catalog
+from .. import autocomplete, related_products, reservations, sampling
+from ..http_cache import conditional_page
+from ..versioning import CATALOGO, SITIO
 
+
+def _stock_producto(request, pk):
+    # El stock disponible cambia con reservas y ventas sin tocar la versión del catálogo.
+    # Las reservas vencidas se liberan antes de leerlo (ETag y página usan el mismo valor).
+    reservations.sweep_product(pk)
+    return list(ColorVariante.objects.filter(producto_id=pk).order_by('pk').values_list('pk', 'stock', 'stock_reservado'))
+
+
+@conditional_page(page_cache=True)
 def catalogo_publico(request):
     """
     Muestra el catálogo público con filtros avanzados, búsqueda, ordenamiento 
     y paginación.
     """
-    productos_list = (
-        Producto.objects.select_related("categoria__parent")
-        .prefetch_related("variantes")
-        .annotate(
-            precio_efectivo=Coalesce("precio_oferta", "precio", output_field=DecimalField())
-        )
-        .all()
-    )
+    # Filtros de categoría, precio y ofertas resueltos contra ProductoIndice
+    productos_list = catalog_queryset()
+    filtros = {}
 
     categoria_slug = request.GET.get("categoria")
     productos_param = None  # eliminado soporte productos=
@@ -31,87 +38,45 @@ def catalogo_publico(request):
 
     if not skip_other_filters and categoria_slug:
         if categoria_slug == "nueva_coleccion":
-            productos_list = productos_list.filter(es_nueva_coleccion=True)
+            filtros['nueva_coleccion'] = True
         else:
-            try:
-                cat = Categoria.objects.get(slug=categoria_slug)
-                productos_list = productos_list.filter(
-                    Q(categoria__in=cat.get_descendants(include_self=True))
-                )
-            except Categoria.DoesNotExist:
-                pass
+            cat = Categoria.objects.filter(slug=categoria_slug).first()
+            if cat is not None:
+                filtros['categoria'] = cat
 
     if not skip_other_filters:
         q = request.GET.get("q", "").strip()
         if q:
-            terms = [t.strip().lower() for t in q.split() if t.strip()]
-            q_obj = Q()
-            for t in terms:
-                q_obj |= Q(nombre_norm__contains=t) | Q(descripcion_norm__contains=t)
-            # Fallback adicional
-            q_obj |= Q(nombre__icontains=q) | Q(descripcion__icontains=q)
-            productos_list = productos_list.filter(q_obj)
+            # Texto completo (FTS5 / tsvector) con prefijos y search_rank
+            productos_list = search_queryset(productos_list, q)
 
         try:
             pmin = request.GET.get("precio_min")
             if pmin:
-                productos_list = productos_list.filter(precio_efectivo__gte=Decimal(pmin))
+                filtros['precio_min'] = Decimal(pmin)
                 
             pmax = request.GET.get("precio_max")
             if pmax:
-                productos_list = productos_list.filter(precio_efectivo__lte=Decimal(pmax))
+                filtros['precio_max'] = Decimal(pmax)
         except (InvalidOperation, TypeError):
             pass
 
         color = request.GET.get("color")
         if color:
-            productos_list = productos_list.filter(variantes__color__iexact=color)
+            # Único filtro que aún cruza variantes: requiere DISTINCT
+            productos_list = productos_list.filter(variantes__color__iexact=color).distinct()
 
-        # Filtro de solo ofertas (precio_oferta no nulo y < precio)
+        # Filtro de solo ofertas (flag es_oferta del índice)
         if request.GET.get('solo_ofertas') == '1':
-            try:
-                total_flags = Producto.objects.filter(es_oferta=True).values_list('id', flat=True)
-                print(f"DEBUG_OFERTAS: ids_marcados={list(total_flags)}")
-            except Exception as e:
-                print(f"DEBUG_OFERTAS: error listando marcados: {e}")
-            antes = productos_list.count()
-            productos_list = productos_list.filter(es_oferta=True)
-            try:
-                ids_result = list(productos_list.values_list('id', flat=True))
-                print(f"SOLO_OFERTAS FILTRO: antes={antes} despues={len(ids_result)} ids_result={ids_result}")
-            except Exception as e:
-                print(f"SOLO_OFERTAS FILTRO: error obteniendo ids_result {e}")
-
-        orden = request.GET.get("orden")
-        if orden == "price-asc":
-            productos_list = productos_list.order_by("precio_efectivo")
-        elif orden == "price-desc":
-            productos_list = productos_list.order_by("-precio_efectivo")
-        else:
-            productos_list = productos_list.order_by("-id")
-
-    productos_list = productos_list.distinct()
-
-    # DEBUG: cantidad de productos que quedan tras aplicar filtros
-    try:
-        matched_count = productos_list.count()
-    except Exception:
-        matched_count = None
+            filtros['solo_ofertas'] = True
 
-    # Log final para verificar que el queryset fue filtrado
-    try:
-        print(f"CATALOG VIEW: productos_param={productos_param} matched_count={matched_count}")
-    except Exception:
-        pass
+        productos_list = filter_catalog(productos_list, **filtros)
+        productos_list = order_catalog(productos_list, request.GET.get("orden"), relevancia=bool(q))
 
-    paginator = Paginator(productos_list, 12)
-    page_number = request.GET.get("page")
-    try:
-        page_obj = paginator.page(page_number)
-    except PageNotAnInteger:
-        page_obj = paginator.page(1)
-    except EmptyPage:
-        page_obj = paginator.page(paginator.num_pages)
+    # Paginación por cursor (sin OFFSET) y conteo cacheado; ?page=N mantiene el modo numérico
+    page_obj, matched_count, next_page_url = paginate_catalog(
+        request, productos_list, request.GET.get("orden"), relevancia=bool(q)
+    )
 
     # Modo especial activado por banner (cualquier destino que fuerza vista estática):
     banner_mode_active = request.GET.get('solo_ofertas') == '1' or (categoria_slug == 'nueva_coleccion')
@@ -128,14 +93,15 @@ def catalogo_publico(request):
     context = {
         "productos": page_obj,
         "page_obj": page_obj,
-        "categorias_menu": Categoria.objects.filter(parent__isnull=True).prefetch_related('children'),
         # banners_activos ahora se provee globalmente por el context_processor `banners_context`
         "filtros_activos": request.GET,
+        # categorias_menu lo provee common_context desde el snapshot cacheado
         # Solo para mensaje específico de "productos seleccionados" mantenemos filtered_from_banner (lista explícita)
     "filtered_from_banner": False,
     "solo_ofertas": request.GET.get('solo_ofertas') == '1',
     "solo_descuentos": False,
         "matched_count": matched_count,
+        "next_page_url": next_page_url,
     "has_grupo_banner": False,
         # Nuevo flag global para desactivar AJAX también en modos 'solo_ofertas' y 'nueva_coleccion'
         "banner_mode_active": banner_mode_active,
@@ -148,76 +114,30 @@ def catalogo_publico(request):
     return render(request, "mi_app/catalogo_publico.html", context)
 
 
+@conditional_page(extra=_stock_producto, page_cache=True)
 def producto_detalle(request, pk):
     """
     Muestra los detalles de un producto específico y una selección de productos
     relacionados con una lógica de prioridades EXCLUSIVA y REFACTORIZADA.
     """
     producto = get_object_or_404(
-        Producto.objects.select_related("categoria__parent").prefetch_related(
-            "variantes", 
-            "categoria__categorias_relacionadas__children",
-            "categoria__parent__categorias_relacionadas__children"
-        ), 
+        Producto.objects.select_related("categoria__parent").prefetch_related("variantes"),
         pk=pk
     )
     # Calcular stock inicial usando la propiedad del modelo (no asignar al property)
-    initial_variant = producto.variantes.first()
+    initial_variant = producto.primera_variante
     initial_stock = initial_variant.stock_disponible if initial_variant else 0
     
-    # === INICIO NUEVA LÓGICA DE RELACIONADOS (cross-selling + jerarquía) ===
-    # Prioridad añadida según nueva indicación:
-    # 0. Si hay categorias_relacionadas definidas (en la categoría o su padre) => usar SOLO productos de esas categorías (hasta 4).
-    #    Si encuentra alguno, NO sigue a las demás reglas.
-    # Luego reglas jerárquicas anteriores (1..fallback):
-    # 1. Misma subcategoría (hermanos) (si la categoría tiene padre) sin rellenar con otros.
-    # 2. Si no hay hermanos, usar categoría padre.
-    # 3. Si categoría es raíz: otros productos de la misma categoría raíz.
-    # 4. Fallback global solo si sigue vacío.
-
+    # === RELACIONADOS: grafo precalculado (mi_app.related_products) ===
+    # Las prioridades (categorías relacionadas > hermanos > padre > raíz > global)
+    # se aplican al construir ProductoRelacionado; aquí solo se lee con una consulta.
     max_relacionados = 4
-    productos_relacionados = []
-    categoria_actual = producto.categoria
-
-    if categoria_actual:
-        # Paso 0: categorias_relacionadas explícitas (incluyendo descendientes de cada una)
-        related_cats_pks = set()
-        for cat in categoria_actual.categorias_relacionadas.all():
-            related_cats_pks.update(cat.get_descendants(include_self=True).values_list('pk', flat=True))
-        if categoria_actual.parent:
-            for cat in categoria_actual.parent.categorias_relacionadas.all():
-                related_cats_pks.update(cat.get_descendants(include_self=True).values_list('pk', flat=True))
-        if related_cats_pks:
-            qs = Producto.objects.filter(categoria__pk__in=related_cats_pks).exclude(pk=producto.pk)
-            productos_relacionados = list(qs.order_by('?')[:max_relacionados])
-
-        if not productos_relacionados:
-            es_subcategoria = categoria_actual.parent is not None
-            if es_subcategoria:
-                # 1) Hermanos (misma subcategoría = misma categoría exacta del producto)
-                hermanos_qs = Producto.objects.filter(categoria=categoria_actual).exclude(pk=producto.pk)
-                hermanos_list = list(hermanos_qs.order_by('?')[:max_relacionados])
-                if hermanos_list:
-                    productos_relacionados = hermanos_list  # Si hay al menos uno, NO rellenamos con otras categorías
-                else:
-                    # 2) No hay ningún otro producto en esta subcategoría: usar productos del padre (todas sus subcategorías descendientes excepto esta)
-                    padre = categoria_actual.parent
-                    if padre:
-                        # Tomamos descendientes (todas las subcats del padre) excluyendo el producto actual
-                        padre_desc_qs = Producto.objects.filter(
-                            categoria__in=padre.get_descendants(include_self=True)
-                        ).exclude(pk=producto.pk)
-                        productos_relacionados = list(padre_desc_qs.order_by('?')[:max_relacionados])
-            else:
-                # Categoría raíz: otros productos dentro de esta misma raíz (descendientes incluidos)
-                raiz_qs = Producto.objects.filter(
-                    categoria__in=categoria_actual.get_descendants(include_self=True)
-                ).exclude(pk=producto.pk)
-                productos_relacionados = list(raiz_qs.order_by('?')[:max_relacionados])
-
+    productos_relacionados = related_products.related_for(producto, limit=max_relacionados)
     if not productos_relacionados:
-        productos_relacionados = list(Producto.objects.exclude(pk=producto.pk).order_by('?')[:max_relacionados])
-    # === FIN NUEVA LÓGICA DE RELACIONADOS ===
+        # Grafo aún sin construir para este producto: muestra global desde los pools
+        ids = sampling.sample(sampling.get_pools().todos, max_relacionados, exclude=[producto.pk])
+        productos_relacionados = sampling.fetch_in_order(ids)
+    # === FIN RELACIONADOS ===
 
     context = {
         "producto": producto,
@@ -227,6 +147,7 @@ def producto_detalle(request, pk):
     return render(request, "mi_app/producto_detalle.html", context)
 
 
+@conditional_page(namespaces=(SITIO, CATALOGO), page_cache=True)
 def pagina_informativa_view(request, slug):
     """
     Muestra el contenido de una página informativa específica.
@@ -238,50 +159,54 @@ def pagina_informativa_view(request, slug):
     return render(request, 'mi_app/pagina_informativa.html', context)
 
 
+@conditional_page(namespaces=(CATALOGO,), per_visitor=False)
 def search_suggest(request):
-    """Devuelve sugerencias de productos para el buscador en vivo (JSON)."""
+    """Devuelve sugerencias de productos y categorías para el buscador en vivo (JSON).
+
+    Se resuelve con el índice de trigramas (tolerante a errores de tipeo) y
+    sin COUNT: `has_more` indica si hay más productos que el límite pedido.
+    """
     q = (request.GET.get('q') or '').strip()
     try:
-        limit = int(request.GET.get('limit') or 5)
+        limit = max(1, min(int(request.GET.get('limit') or 5), 20))
     except ValueError:
         limit = 5
 
-    data = {"query": q, "results": [], "total": 0}
+    data = {"query": q, "results": [], "categories": [], "total": 0, "has_more": False}
     if len(q) < 2:
         return JsonResponse(data)
 
-    terms = [t.strip().lower() for t in q.split() if t.strip()]
-    qs = Producto.objects.select_related('categoria').only('id','nombre','precio','precio_oferta','imagen_principal','categoria')
-    q_obj = Q()
-    if terms:
-        for t in terms:
-            q_obj |= Q(nombre_norm__contains=t) | Q(descripcion_norm__contains=t)
-    # Fallback adicional siempre presente
-    q_obj |= Q(nombre__icontains=q) | Q(descripcion__icontains=q)
-    qs = qs.filter(q_obj).order_by('-id')
-    total = qs.count()
-    prods = list(qs[:limit])
+    categorias, productos, has_more = autocomplete.suggest(q, limit=limit)
+    image_storage = Producto._meta.get_field('imagen_principal').storage
 
     results = []
-    for p in prods:
-        # Precio efectivo
-        precio = p.precio_oferta if (p.precio_oferta and p.precio_oferta < p.precio) else p.precio
+    for entry, score in productos:
         # Imagen (principal o nada)
         img = ''
         try:
-            if p.imagen_principal and getattr(p.imagen_principal, 'url', ''):
-                img = p.imagen_principal.url
+            if entry.data['image']:
+                img = image_storage.url(entry.data['image'])
         except Exception:
             img = ''
 
         results.append({
-            'id': p.id,
-            'name': p.nombre,
-            'price': str(precio),
+            'id': entry.pk,
+            'name': entry.label,
+            'price': str(entry.data['price']),
             'image': img,
-            'url': reverse('producto_detalle', args=[p.id]),
+            'url': reverse('producto_detalle', args=[entry.pk]),
         })
 
+    data['categories'] = [
+        {
+            'id': entry.pk,
+            'name': entry.label,
+            'url': f"{reverse('catalogo_publico')}?categoria={entry.data['slug']}",
+        }
+        for entry, score in categorias
+    ]
     data['results'] = results
-    data['total'] = total
-    return JsonResponse(data)
\ No newline at end of file
+    # `total` se mantiene por compatibilidad: número de productos devueltos
+    data['total'] = len(results)
+    data['has_more'] = has_more
+    return JsonResponse(data)
@@ -3,13 +3,14 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.db import transaction
 from django.http import JsonResponse
-from django.db.models import Q, DecimalField
-from django.db.models.functions import Coalesce
-from django.core.paginator import Paginator
 from decimal import Decimal, InvalidOperation
 
 from ..models import Producto, Categoria, Banner
 from ..forms import ProductoForm, ColorVarianteFormSet
+from ..catalog_index import catalog_queryset, filter_catalog, order_catalog
+from ..search import search_queryset
+from ..pagination import paginate_catalog
+from ..http_cache import conditional_page
 
 @login_required
 def dashboard(request):
@@ -74,64 +75,48 @@ def get_subcategories_json(request):
     subcategories = Categoria.objects.filter(parent_id=parent_id).values('id', 'nombre')
     return JsonResponse(list(subcategories), safe=False)
 
+@conditional_page(page_cache=True)
 def catalogo_publico(request):
     """
     Muestra el catálogo público con filtros avanzados, búsqueda y paginación.
     Versión limpia y funcional.
     """
-    # 1. Query base optimizada
-    productos_list = (
-        Producto.objects.select_related("categoria__parent")
-        .prefetch_related("variantes")
-        .annotate(
-            precio_efectivo=Coalesce("precio_oferta", "precio", output_field=DecimalField())
-        )
-        .all()
-    )
+    # 1. Query base: filtros y orden se resuelven contra ProductoIndice
+    productos_list = catalog_queryset()
 
     # 2. Aplicar filtros (Lógica unificada y corregida)
     categoria_slug = request.GET.get("categoria")
     producto_unico_id = request.GET.get('producto')
     productos_multi = request.GET.get('productos')  # coma separada
+    filtros = {}
     if productos_multi:
         ids = [p for p in productos_multi.split(',') if p.isdigit()]
         if ids:
             productos_list = productos_list.filter(pk__in=ids)
-            print(f"DEBUG_PRODUCTOS_MULTI: filtrando ids={ids}")
     elif producto_unico_id:
         if producto_unico_id.isdigit():
             productos_list = productos_list.filter(pk=int(producto_unico_id))
-            print(f"DEBUG_PRODUCTO_UNICO: filtrando producto id={producto_unico_id}")
         # Si se pasa producto, ignoramos el resto de filtros de categoría
     elif categoria_slug:
         if categoria_slug == "nueva_coleccion":
-            productos_list = productos_list.filter(es_nueva_coleccion=True)
+            filtros['nueva_coleccion'] = True
         else:
-            try:
-                cat = Categoria.objects.get(slug=categoria_slug)
-                categorias_a_filtrar = cat.get_descendants(include_self=True)
-                productos_list = productos_list.filter(categoria__in=categorias_a_filtrar)
-            except Categoria.DoesNotExist:
-                pass
+            cat = Categoria.objects.filter(slug=categoria_slug).first()
+            if cat is not None:
+                filtros['categoria'] = cat
 
     q = request.GET.get("q", "").strip()
     if q:
-        # Buscar sobre campos normalizados + fallback original
-        terms = [t.strip().lower() for t in q.split() if t.strip()]
-        q_obj = Q()
-        for t in terms:
-            q_obj |= Q(nombre_norm__contains=t) | Q(descripcion_norm__contains=t)
-        # Fallback por si faltan norm fields en algún registro
-        q_obj |= Q(nombre__icontains=q) | Q(descripcion__icontains=q)
-        productos_list = productos_list.filter(q_obj)
+        # Búsqueda de texto completo sobre campos normalizados (anota search_rank)
+        productos_list = search_queryset(productos_list, q)
 
     try:
         pmin = request.GET.get("precio_min")
         if pmin:
-            productos_list = productos_list.filter(precio_efectivo__gte=Decimal(pmin))
+            filtros['precio_min'] = Decimal(pmin)
         pmax = request.GET.get("precio_max")
         if pmax:
-            productos_list = productos_list.filter(precio_efectivo__lte=Decimal(pmax))
+            filtros['precio_max'] = Decimal(pmax)
     except (InvalidOperation, TypeError):
         pass
 
@@ -142,35 +127,17 @@ def catalogo_publico(request):
 
     # 3. Filtro solo_ofertas (checkbox es_oferta)
     if request.GET.get('solo_ofertas') == '1':
-        try:
-            marcados = list(Producto.objects.filter(es_oferta=True).values_list('id', flat=True))
-            print(f"DEBUG_OFERTAS2: ids_marcados={marcados}")
-        except Exception as e:
-            print(f"DEBUG_OFERTAS2 error listando marcados: {e}")
-        antes = productos_list.count()
-        productos_list = productos_list.filter(es_oferta=True)
-        try:
-            ids_res = list(productos_list.values_list('id', flat=True))
-            print(f"SOLO_OFERTAS2 FILTRO: antes={antes} despues={len(ids_res)} ids={ids_res}")
-        except Exception:
-            pass
+        filtros['solo_ofertas'] = True
 
-    # 4. Aplicar orden
-    orden = request.GET.get("orden")
-    if orden == "price-asc":
-        productos_list = productos_list.order_by("precio_efectivo")
-    elif orden == "price-desc":
-        productos_list = productos_list.order_by("-precio_efectivo")
-    else:
-        productos_list = productos_list.order_by("-id")
+    productos_list = filter_catalog(productos_list, **filtros)
 
-    productos_list = productos_list.distinct()
+    # 4. Aplicar orden
+    productos_list = order_catalog(productos_list, request.GET.get("orden"), relevancia=bool(q))
 
-    # 5. Paginación (calculamos coincidencias antes)
-    matched_count = productos_list.count()
-    paginator = Paginator(productos_list, 12)
-    page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
+    # 5. Paginación por cursor (sin OFFSET) y conteo cacheado; ?page=N mantiene el modo numérico
+    page_obj, matched_count, next_page_url = paginate_catalog(
+        request, productos_list, request.GET.get("orden"), relevancia=bool(q)
+    )
 
     # 6. Banner y flag mostrar_titulo_banner (mismo criterio que versión pública)
     banner_obj = Banner.objects.filter(activo=True).first()
@@ -185,11 +152,12 @@ def catalogo_publico(request):
         "page_obj": page_obj,
         "banner": banner_obj,
         "filtros_activos": request.GET,
-    "categorias_menu": Categoria.objects.filter(parent__isnull=True).prefetch_related('children'),
+        # categorias_menu lo provee common_context desde el snapshot cacheado
         "solo_ofertas": request.GET.get('solo_ofertas') == '1',
         "producto_unico": bool(producto_unico_id) and not productos_multi,
         "productos_multi": productos_multi,
         "matched_count": matched_count,
+        "next_page_url": next_page_url,
         "mostrar_titulo_banner": mostrar_titulo_banner,
     }
     
@@ -77,7 +77,7 @@ except Exception:
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'mi_app.middleware.AsyncWhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -114,6 +114,45 @@ if IS_PRODUCTION:
 else:
     DATABASES = { 'default': { 'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db.sqlite3' } }
 
+# --- Cache ---
+# El cache DEBE ser compartido cuando hay más de un proceso (varios workers de
+# uvicorn + el worker de reservas): las versiones de invalidación
+# (mi_app.versioning), el cache de página/ETags, el cache del chatbot y el
+# pool de claves de IA solo son coherentes entre procesos con Redis.
+# Sin REDIS_URL se usa memoria local por proceso (válido solo con un proceso).
+REDIS_URL = os.environ.get('REDIS_URL')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'fantasia-intima',
+    }
+}
+if REDIS_URL:
+    import importlib.util
+    if importlib.util.find_spec('redis') is None:
+        from django.core.exceptions import ImproperlyConfigured
+        raise ImproperlyConfigured("REDIS_URL está definido pero el paquete 'redis' no está instalado (requirements.txt).")
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'fi',
+    }
+elif IS_PRODUCTION:
+    import logging
+    logging.getLogger(__name__).warning(
+        "REDIS_URL no definido en producción: cache en memoria por proceso; "
+        "con varios workers las invalidaciones y el cache de páginas no se comparten."
+    )
+
+# Segundos que un CDN puede servir las páginas públicas anónimas (mi_app.http_cache)
+HTTP_CACHE_S_MAXAGE = int(os.environ.get('HTTP_CACHE_S_MAXAGE', '300'))
+# Segundos que se reutiliza el HTML anónimo ya renderizado (caché de página completa)
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', '60'))
+# Peticiones por clave de IA y día antes de darla por agotada (0 = sin límite; mi_app.key_pool)
+AI_KEY_DAILY_QUOTA = int(os.environ.get('AI_KEY_DAILY_QUOTA', '0'))
+# Segundos que se reutiliza una respuesta del chatbot a la misma pregunta (mi_app.chat_cache)
+CHAT_CACHE_TTL = int(os.environ.get('CHAT_CACHE_TTL', str(6 * 3600)))
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
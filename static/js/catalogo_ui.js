@@ -29,7 +29,56 @@
     fetchReplace(u.toString() + '#product-list-section');
   }
 
+  // Scroll infinito por cursor: el parcial deja un .js-load-more con la URL de la siguiente página
+  let loadingMore = false;
+  function loadMore(sentinel){
+    if(loadingMore || !sentinel || !sentinel.dataset.nextUrl) return;
+    loadingMore = true;
+    sentinel.setAttribute('aria-busy','true');
+    fetch(sentinel.dataset.nextUrl, { headers:{'X-Requested-With':'fetch'} })
+      .then(r=>r.text())
+      .then(html=>{
+        const doc = new DOMParser().parseFromString(html,'text/html');
+        const newList = doc.getElementById('product-list');
+        const list = document.getElementById('product-list');
+        if(!newList || !list){ window.location.href = sentinel.dataset.nextUrl; return; }
+        sentinel.remove();
+        Array.from(newList.children).forEach(el=>{
+          if(el.id === 'no-products-found') return;
+          list.appendChild(el);
+        });
+        armLoadMore();
+      })
+      .catch(()=>{ window.location.href = sentinel.dataset.nextUrl; })
+      .finally(()=>{ loadingMore = false; });
+  }
+  let observer = null;
+  function armLoadMore(){
+    const sentinel = document.querySelector('#product-list .js-load-more');
+    if(!sentinel) return;
+    if('IntersectionObserver' in window){
+      if(observer) observer.disconnect();
+      observer = new IntersectionObserver(entries=>{
+        entries.forEach(e=>{ if(e.isIntersecting) loadMore(e.target); });
+      }, { rootMargin:'600px 0px' });
+      observer.observe(sentinel);
+    }
+  }
+
   ready(function(){
+    document.addEventListener('click', function(e){
+      const a = e.target.closest('.js-load-more a');
+      if(!a) return;
+      e.preventDefault();
+      loadMore(a.closest('.js-load-more'));
+    });
+    armLoadMore();
+    // Otros scripts reemplazan la lista (filtros, categorías): volver a enganchar el sentinel
+    const section = document.getElementById('product-list-section');
+    if(section && 'MutationObserver' in window){
+      new MutationObserver(()=>{ if(!loadingMore) armLoadMore(); }).observe(section, { childList:true, subtree:true });
+    }
+
     const sort = document.getElementById('sort-by');
     if(sort){
       sort.addEventListener('change', function(){
@@ -37,6 +86,7 @@
           if(this.value==='default'){ u.searchParams.delete('orden'); }
           else { u.searchParams.set('orden', this.value); }
           u.searchParams.delete('page');
+          u.searchParams.delete('cursor');
         });
       });
     }
@@ -53,6 +103,7 @@
             else u.searchParams.set(k, v);
           }
           u.searchParams.delete('page');
+          u.searchParams.delete('cursor');
         });
       });
     });